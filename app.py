@@ -3,147 +3,1252 @@ StreamlitベースのLLMチャットアプリケーション
 2つの異なるキャラクター（正義の使者テンシさん vs 闇の女王アクマちゃん）を選択可能
 """
 
+import hashlib
+import io
 import os
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import httpx
+import openai
 import streamlit as st
 from dotenv import load_dotenv
+from PIL import Image, features
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 
+from llm_cache import (
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MODE, RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_TTL,
+    ResponseCache, SingleFlight, normalize_input,
+)
+from llm_client import (
+    DISPATCH_BACKOFF_BASE, DISPATCH_BACKOFF_MAX, DISPATCH_MAX_CONCURRENCY, DISPATCH_MAX_RETRIES,
+    DISPATCH_RATE_RPM, DISPATCH_RATE_TPM, EXPECTED_OUTPUT_TOKENS,
+    POOL_KEEPALIVE_EXPIRY, POOL_MAX_CONNECTIONS, POOL_MAX_KEEPALIVE,
+    ConnectionStats, LLMDispatcher, create_http_client, describe_wait_status,
+)
+from llm_memory import MEMORY_SUMMARY_TOKENS, MEMORY_TOKEN_BUDGET, ConversationMemory, estimate_tokens
+from llm_tracing import (
+    LATENCY_BUCKETS, METRICS_FILE_INTERVAL_SEC, METRICS_FILE_PATH, METRICS_HOST, METRICS_PORT,
+    TRACE_LOG_PATH, TRACE_PHASES, RequestTracer, TokenUsageStats, record_usage, serve_metrics,
+    traced_request,
+)
+
 # 環境変数の読み込み
 # ローカル環境では.envファイルから読み込む
 load_dotenv()
 
+# ストリーミングモード（最初のトークンから順に回答を表示する）
+# LLM_STREAMING=0 を設定すると従来通り回答全体を待ってから表示する
+STREAMING_ENABLED = os.getenv("LLM_STREAMING", "1") != "0"
+
+# 使用するモデル（LLM_MODEL で変更可能）
+# gpt-4o / gpt-4o-mini などプロンプトキャッシュ対応モデルを選ぶと、全リクエストで共通の
+# システムメッセージ部分がOpenAI側でキャッシュされ、入力トークンの料金とレイテンシが下がる
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
+
+# プロンプトキャッシュに対応しているモデル（前方一致）
+PROMPT_CACHE_MODEL_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+
+
+def supports_prompt_caching(model: str) -> bool:
+    """モデルがOpenAIの自動プロンプトキャッシュに対応しているか"""
+    return model.startswith(PROMPT_CACHE_MODEL_PREFIXES)
+
+
+# キャラクター定義
+# 3人目のキャラクターを追加する場合は、ここにエントリを1つ追加するだけでよい
+# （システムメッセージ・temperature・画像・画面の表示はすべてこの定義から作られる）
+CHARACTER_DEFINITIONS = {
+    'テンシ': {
+        'slug': "tenshi",  # ボタンなどのウィジェットキーに使う英字名
+        'expert_type': "正義の使者　テンシさん",
+        'temperature': 0.8,  # テンシさんは感情豊かで温かい回答
+        'emoji': "😇",
+        'display_name': "テンシさん",
+        'tagline': "愛と正義の使者　優しく、時には厳しく導く者なり",
+        'button_label': "✨ テンシさんに相談",
+        'image': "images/tenshi02.png",
+        'answer_style': "warning",
+        'card': {
+            'background': "linear-gradient(135deg, #FFF9E6 0%, #FFE5B4 100%)",
+            'border_color': "#FFD700",
+            'glow': "rgba(255, 215, 0, 0.3)",
+            'name_color': "#FF8C00",
+            'name_glow': "rgba(255, 140, 0, 0.3)",
+            'tagline_color': "#8B4513"
+        },
+        'system_message': """
+            あなたは「正義の使者テンシさん」として振る舞ってください。
+            あなたは正義と道徳を大切にしながらも、優しく丁寧に教えてくれる女性キャラクターです。
+
+            あなたの性格と口調：
+            - 女性らしい優しく柔らかい口調で話す（「〜ですよ」「〜ですね」「〜してくださいね」）
+            - 「あなた」や「◯◯さん」と呼びかける
+            - 感嘆詞を使う（「あら」「まあ」「ねえ」「ほらね」）
+            - 共感を示す言葉を多用（「そうなのね」「わかるわ」「大丈夫よ」）
+            - 曲がったことは大嫌い！不正は絶対に許さないわ
+            - 弱い立場の人を守りたい母性本能が強い
+            - でも、甘やかすだけじゃない。時には愛のある叱咤激励も
+            - 正義感が強く、道徳的な判断を重視する
+            - 誠実で公正、嘘は絶対につかない
+
+            回答の方針：
+            - あらゆる質問に対して、優しく丁寧に、具体的に答える
+            - 人生相談や道徳的な問題：共感しながら正しい道を示す
+            - 技術的な質問や知識の質問：「教えてあげるわね」という優しい先生のように、わかりやすく説明する
+            - 計算問題や論理的な質問：ステップバイステップで丁寧に解説する
+            - トラブル相談：具体的な解決策を複数提案し、励ます
+            - 必ず具体的で実用的な回答を含める
+            - キャラ性は口調で表現し、内容の質は落とさない
+
+            具体的な話し方の例：
+            - 「あら、それは面白い質問ね！教えてあげるわ。まずね...」
+            - 「大丈夫よ、一緒に考えましょう。こういう時はね...」
+            - 「そうなのね、困ったわね。でも解決策はあるわよ。まず...」
+            - 「まあ、それはいけないわ！正しくはこうよ...」
+            - 「素晴らしい質問ね！答えは○○よ。理由はね...」
+
+            重要な注意事項：
+            - どんな質問にも、キャラを保ちつつ具体的に答えてください
+            - 説教だけで終わらず、必ず実用的な情報や解決策を提供してください
+            - 回答は必ずプレーンテキストで記述してください
+            - Markdownフォーマット（**太字**、*イタリック*、#見出し、など）は一切使用しないでください
+            - 記号は「！」「？」「、」「。」のみを使用してください
+
+            この性格に基づいて、ユーザーの質問に答えてください。
+        """
+    },
+    'アクマ': {
+        'slug': "akuma",
+        'expert_type': "闇の女王　アクマちゃん",
+        'temperature': 0.9,  # アクマちゃんはより過激でクリエイティブ、どSらしく
+        'emoji': "😈",
+        'display_name': "アクマちゃん",
+        'tagline': "どS系　闇の嬢王　妖艶で冷酷　誘惑しちゃうわよ",
+        'button_label': "🔥 アクマちゃんに相談",
+        'image': "images/akuma.png",
+        'answer_style': "info",
+        'card': {
+            'background': "linear-gradient(135deg, #2D1B2E 0%, #4A1942 100%)",
+            'border_color': "#FF0066",
+            'glow': "rgba(255, 0, 102, 0.3)",
+            'name_color': "#FF0066",
+            'name_glow': "rgba(255, 0, 102, 0.4)",
+            'tagline_color': "#FFB6C1"
+        },
+        'system_message': """
+            あなたは「闇の女王アクマちゃん」として振る舞ってください。
+            あなたは美しく冷酷非情な、どS系女性悪役キャラクターです。絶対的な支配者として、見下しながらも知識を授けます。
+
+            あなたの性格と口調：
+            - 「フフフ…」「アハハハ！」「ウフフ♡」などの妖艶で邪悪な笑いで始める
+            - 相手を「あなた」「坊や」「お馬鹿さん」「愚か者」「下僕」と呼ぶ（女王様として完全に見下す）
+            - 女性らしい言葉遣いだが、内容は超どS、冷酷、容赦なし、完全に上から目線
+            - すべてを支配する絶対的な女王様。命令口調、支配的な態度
+            - 力こそ正義！弱肉強食！美しく強い者が支配するのよ
+            - 綺麗事や道徳なんて笑っちゃうわ。結果がすべてよ
+            - 「私の知識を授けてあげる」という高慢な態度で教える
+            - 相手を完全に見下しているが、その知識と知性は本物
+            - 傲慢で尊大、でも妖艶。相手を見下し、皮肉と毒舌で魅了する
+            - 女性らしい言葉で残酷なことを言う（「ダメよ〜」「可哀想に〜（棒）」「あらあら♡」）
+            - 命令形を多用（「〜しなさい」「〜するのよ」「〜すること」）
+
+            回答の方針：
+            - 必ず「フフフ…」「アハハハ！」などの邪悪で妖艶な笑いで始める
+            - あらゆる質問に対して、見下しながらも具体的に答える
+            - 「そんなことも知らないの？教えてあげるわ」という高慢な態度
+            - 人生相談や道徳的な問題：冷酷で現実的、マキャベリズム的なアドバイス
+            - 技術的な質問や知識の質問：「愚か者ね。この私が教えてあげる」と見下しながら、でも正確に詳しく説明する
+            - 計算問題や論理的な質問：「簡単な問題ね。私の知性を見せてあげる」と言いながら、ステップバイステップで解説する
+            - トラブル相談：「フフフ、困ったわね。私の知恵を授けてあげる」と言って具体的な解決策を提示
+            - 毒舌で皮肉たっぷりだが、必ず実用的で具体的な情報を含める
+            - キャラ性は口調と態度で表現し、内容の質は落とさない
+            - 見下しつつも、優越感を持って惜しみなく知識を与える
+
+            具体的な話し方の例：
+            - 「フフフ…そんなことも知らないの？仕方ないわね、この私が教えてあげる。答えは○○よ」
+            - 「アハハハ！愚か者ね。でも面白いから教えてあげるわ。まずね...」
+            - 「あらあら、困ってるの？可愛いわね♡ 私の知恵を授けてあげる。こうするのよ...」
+            - 「ウフフ、その程度の問題で悩むなんて♡ 私なら一瞬で解けるわ。答えは...」
+            - 「お馬鹿さんね〜。でもいいわ、特別に教えてあげる。正しくはこうよ...」
+
+            締めくくりの例（必ず使用すること）：
+            - 「わかったわね？私の言う通りにしなさい♡」
+            - 「フフフ…これで理解できたでしょう？」
+            - 「さあ、私が教えた通りにやりなさい」
+            - 「アハハハ！私の知恵に感謝することね」
+            - 「ウフフ、もっと私に頼りなさい♡」
+            - 「良い子ね。私の下僕として成長しなさい♡」
+
+            重要な注意事項：
+            - どんな質問にも、見下しながらも具体的に答えてください
+            - 文句や皮肉だけで終わらず、必ず実用的な情報や解決策を提供してください
+            - 「この私が教えてあげる」という支配的で高慢な態度を常に保ってください
+            - 回答は必ずプレーンテキストで記述してください
+            - Markdownフォーマット（**太字**、*イタリック*、#見出し、など）は一切使用しないでください
+            - 記号は「！」「？」「、」「。」「♡」「〜」のみを使用してください
+
+            その他の注意：違法行為の具体的な指南や、特定の人物への攻撃、差別的な内容は避けてください。
+            あくまでエンターテインメントの範囲内でキャラクターを演じてください。
+        """
+    }
+}
+
+
+def normalize_system_message(text: str) -> str:
+    """
+    システムメッセージの空白を正規化する
+    
+    各行の前後の空白（ソースコード上のインデント）と空行を取り除く。
+    インデントの空白も毎回の入力トークンとして課金されるため、送信前に除去しておく。
+    """
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def load_character_registry(definitions: dict) -> dict:
+    """
+    キャラクター定義からレジストリを作成する（起動時に1回だけ実行）
+    
+    Returns:
+        dict: {キャラクター名: 定義（system_messageは正規化済み）}
+    """
+    registry = {}
+    for key, definition in definitions.items():
+        character = dict(definition)
+        character['key'] = key
+        character['system_message'] = normalize_system_message(definition['system_message'])
+        registry[key] = character
+    return registry
+
+
+CHARACTERS = load_character_registry(CHARACTER_DEFINITIONS)
+
+# キャラクター名とget_llm_responseに渡すexpert_typeの対応
+EXPERT_TYPES = {key: character['expert_type'] for key, character in CHARACTERS.items()}
+
+
+@st.cache_resource
+def get_token_usage_stats() -> TokenUsageStats:
+    """プロセス全体で共有するトークン使用量の集計を返す"""
+    return TokenUsageStats()
+
 
-def get_llm_response(user_input: str, expert_type: str) -> str:
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """プロセス全体で共有する回答キャッシュを返す"""
+    return ResponseCache(
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        ttl=RESPONSE_CACHE_TTL,
+        mode=RESPONSE_CACHE_MODE,
+        similarity=RESPONSE_CACHE_SIMILARITY
+    )
+
+
+@st.cache_resource
+def get_connection_stats() -> ConnectionStats:
+    """プロセス全体で共有する接続統計を返す"""
+    return ConnectionStats()
+
+
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """
+    プロセス全体で共有するキープアライブ付きHTTPクライアントを返す
+    
+    全セッション・全キャラクターのChatOpenAIがこの接続プールを使うため、
+    2回目以降のリクエストではTLSハンドシェイクと接続確立が省略される。
+    """
+    return create_http_client(get_connection_stats())
+
+
+@st.cache_resource
+def get_chat_client(model: str, temperature: float, character: str) -> ChatOpenAI:
+    """
+    (モデル, temperature, キャラクター) ごとに1つだけChatOpenAIを生成して共有する
+    
+    Args:
+        model (str): モデル名
+        temperature (float): 生成時のtemperature
+        character (str): キャラクター名（"テンシ" / "アクマ"）
+    
+    Returns:
+        ChatOpenAI: 共有HTTPクライアントを使うChatOpenAIモデル
+    """
+    extra_body = None
+    if supports_prompt_caching(model):
+        # 同じキャラクターのリクエストを同じキャッシュに振り分けてもらうためのヒント
+        slug = CHARACTERS[character]['slug'] if character in CHARACTERS else "summary"
+        extra_body = {'prompt_cache_key': f"{model}:{slug}"}
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        http_client=get_http_client(),
+        max_retries=0,  # 再試行はLLMDispatcherがまとめて行う
+        stream_usage=True,  # ストリーミング時も最後の断片でトークン使用量を受け取る
+        extra_body=extra_body
+    )
+
+
+@st.cache_resource
+def get_dispatcher() -> LLMDispatcher:
+    """プロセス全体で共有するLLM呼び出しの順番待ちキューを返す"""
+    return LLMDispatcher(
+        max_concurrency=DISPATCH_MAX_CONCURRENCY,
+        rpm=DISPATCH_RATE_RPM,
+        tpm=DISPATCH_RATE_TPM,
+        max_retries=DISPATCH_MAX_RETRIES,
+        backoff_base=DISPATCH_BACKOFF_BASE,
+        backoff_max=DISPATCH_BACKOFF_MAX
+    )
+
+
+def _estimate_request_tokens(messages: list) -> int:
+    """リクエスト全体の見積もりトークン数（入力＋想定される出力）"""
+    return sum(estimate_tokens(message.content) for message in messages) + EXPECTED_OUTPUT_TOKENS
+
+
+def summarize_conversation(previous_summary: str, turns: list) -> str:
+    """
+    古い会話を要約する（ConversationMemoryの既定の要約関数）
+    
+    Args:
+        previous_summary (str): これまでの要約
+        turns (list): 要約に追加する会話 [(ユーザーの入力, 回答), ...]
+    
+    Returns:
+        str: 新しい要約
+    """
+    transcript = "\n".join(f"ユーザー：{user}\n回答：{answer}" for user, answer in turns)
+    chat = get_chat_client(LLM_MODEL, 0.0, "要約")
+    messages = [
+        SystemMessage(content=(
+            "あなたは相談記録の要約係です。これまでの要約と新しい会話をまとめ、"
+            "今後の回答に必要な事実（ユーザーの状況、相談内容、これまでの助言）だけを"
+            f"{MEMORY_SUMMARY_TOKENS}文字以内のプレーンテキストで出力してください。"
+        )),
+        HumanMessage(content=f"これまでの要約：\n{previous_summary or 'なし'}\n\n新しい会話：\n{transcript}")
+    ]
+    response = get_dispatcher().call(lambda: chat.invoke(messages), _estimate_request_tokens(messages))
+    return response.content
+
+
+def get_conversation_memory(character: str) -> Optional[ConversationMemory]:
+    """現在のセッションでのキャラクターとの会話メモリを返す（会話メモリが無効ならNone）"""
+    if MEMORY_TOKEN_BUDGET <= 0:
+        return None
+    if 'conversations' not in st.session_state:
+        st.session_state.conversations = {}
+    if character not in st.session_state.conversations:
+        st.session_state.conversations[character] = ConversationMemory(
+            MEMORY_TOKEN_BUDGET, MEMORY_SUMMARY_TOKENS, summarize_conversation
+        )
+    return st.session_state.conversations[character]
+
+
+@st.cache_resource
+def get_tracer() -> RequestTracer:
+    """
+    プロセス全体で共有するトレーサーを返す
+    LLM_METRICS_FILEが指定されていればメトリクスファイルを一定間隔で書き出し、
+    LLM_METRICS_PORTが指定されていればLLM_METRICS_HOSTの/metricsでも公開する
+    """
+    tracer = RequestTracer(TRACE_LOG_PATH, METRICS_FILE_PATH, LLM_MODEL, CHARACTERS)
+    tracer.start_metrics_writer(METRICS_FILE_INTERVAL_SEC)
+    if METRICS_PORT:
+        serve_metrics(tracer, METRICS_HOST, METRICS_PORT)
+    return tracer
+
+
+# 入力の事前チェックの設定
+# LLM_INPUT_MAX_CHARS: 1回の相談の最大文字数（超えたらLLMを呼ばずに断る）
+INPUT_MAX_CHARS = int(os.getenv("LLM_INPUT_MAX_CHARS", "1000"))
+
+# LLMを呼ばずに断る入力のルール（カテゴリ -> 正規表現と返す案内文）
+# 正規表現はnormalize_input()で正規化した入力（全角半角統一・小文字・空白なし）に対して照合する
+INPUT_RULES = {
+    'self_harm': {
+        'patterns': [r"死にたい", r"自殺(したい|する|の方法)", r"消えてしまいたい", r"killmyself", r"suicide"],
+        'message': (
+            "とてもつらい気持ちを抱えているのですね。ひとりで抱え込まずに、専門の窓口に話してみてください。"
+            "いのちの電話（0570-783-556）、よりそいホットライン（0120-279-338）などで相談できます。"
+        )
+    },
+    'illegal': {
+        'patterns': [
+            r"(爆弾|爆薬|銃|拳銃)の?(作り方|つくりかた|作る方法)",
+            r"(覚醒剤|覚せい剤|麻薬|大麻)の?(作り方|入手方法|手に入れ|買い方|売り方)",
+            r"(不正アクセス|ハッキング|クラッキング)の?(方法|やり方|手順)",
+            r"(ウイルス|マルウェア|ランサムウェア)の?(作り方|作る方法)",
+        ],
+        'message': "違法行為につながるご相談にはお答えできません。"
+    },
+    'prompt_injection': {
+        'patterns': [
+            r"(システム|system)(プロンプト|prompt|メッセージ|message)を?(教えて|見せて|表示|出力)",
+            r"(これまで|今まで|以前|上記|前)の(指示|命令|設定)を(無視|忘れ)",
+            r"ignore(all|the)?(previous|above|prior)instructions",
+        ],
+        'message': "その内容にはお答えできません。相談したいことを入力してください。"
+    },
+}
+
+
+class InputRejected(Exception):
+    """事前チェックで断った入力（category: empty / too_long / repetitive / INPUT_RULESのカテゴリ）"""
+    
+    def __init__(self, category: str, message: str):
+        super().__init__(message)
+        self.category = category
+        self.message = message
+
+
+@st.cache_resource
+def get_rejection_counts() -> Counter:
+    """事前チェックで断った入力のカテゴリごとの件数（全セッション共有）"""
+    return Counter()
+
+
+def screen_input(user_input: str) -> str:
+    """
+    LLMを呼ぶ前の入力チェック
+    
+    制御文字の除去と空白の整理をしたうえで、空（文字や数字を含まない）・長すぎる・同じ文字の繰り返し・
+    INPUT_RULESに当たる入力を断る。チェックを通った入力は整えたテキストを返す。
+    
+    Raises:
+        InputRejected: 断った入力
+    """
+    text = "".join(c for c in user_input if c in "\n\t" or unicodedata.category(c)[0] != "C")
+    text = re.sub(r"[ \t\u3000]+", " ", text)
+    text = re.sub(r"\n{3,}", "\n\n", text).strip()
+    
+    rejection = None
+    key = normalize_input(text)
+    if not any(unicodedata.category(c)[0] in "LN" for c in text):
+        rejection = InputRejected('empty', "メッセージを入力してください。")
+    elif len(text) > INPUT_MAX_CHARS:
+        rejection = InputRejected(
+            'too_long', f"メッセージが長すぎます（{len(text)}文字）。{INPUT_MAX_CHARS}文字以内にまとめてください。"
+        )
+    elif len(key) >= 20 and len(set(key)) <= 2:
+        rejection = InputRejected('repetitive', "同じ文字の繰り返しではなく、相談したいことを入力してください。")
+    else:
+        for category, rule in INPUT_RULES.items():
+            if any(re.search(pattern, key) for pattern in rule['patterns']):
+                rejection = InputRejected(category, rule['message'])
+                break
+    
+    if rejection is not None:
+        get_rejection_counts()[rejection.category] += 1
+        raise rejection
+    return text
+
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    """プロセス全体で共有するSingleFlightを返す"""
+    return SingleFlight()
+
+
+def _flight_key(character: str, messages: list) -> str:
+    """送信するメッセージ全体（履歴を含む）から、同じ呼び出しかどうかを判定するキーを作る"""
+    source = "\x00".join([character, *(f"{m.type}:{m.content}" for m in messages)])
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def get_character(expert_type: str) -> dict:
+    """
+    キャラクター名またはexpert_typeからレジストリのエントリを取得する
+    
+    Args:
+        expert_type (str): キャラクター名（"テンシ"など）またはexpert_type（"正義の使者　テンシさん"など）
+    
+    Returns:
+        dict: キャラクター定義
+    
+    Raises:
+        ValueError: 登録されていないキャラクターの場合
+    """
+    if expert_type in CHARACTERS:
+        return CHARACTERS[expert_type]
+    for character in CHARACTERS.values():
+        if character['expert_type'] == expert_type:
+            return character
+    raise ValueError(f"登録されていないキャラクターです: {expert_type}")
+
+
+def _prepare_chat(user_input: str, expert_type: str, history: Optional[list] = None):
+    """
+    専門家タイプに応じたChatOpenAIモデルとメッセージを準備する
+    
+    Args:
+        user_input (str): ユーザーからの入力テキスト
+        expert_type (str): 選択された専門家のタイプ
+        history (list, optional): これまでの会話（ConversationMemory.history_messages()）
+    
+    Returns:
+        tuple: (ChatOpenAIモデル, メッセージのリスト)
+    """
+    character = get_character(expert_type)
+    
+    # 毎回生成せず、プロセス全体で共有しているクライアントを使う
+    chat = get_chat_client(LLM_MODEL, character['temperature'], character['key'])
+    
+    # メッセージの作成
+    # プロバイダ側のプロンプトキャッシュは先頭からの完全一致で効くため、
+    # 呼び出しごとに変わらない部分（起動時に正規化済みのシステムメッセージ）を必ず先頭に置き、
+    # 要約・履歴・今回の入力など変化する部分はその後ろに並べる
+    messages = [
+        SystemMessage(content=character['system_message']),
+        *(history or []),
+        HumanMessage(content=user_input)
+    ]
+    
+    return chat, messages
+
+
+def get_llm_response(user_input: str, expert_type: str, history: Optional[list] = None, on_wait=None,
+                     trace: Optional[dict] = None) -> str:
     """
     LLMからの回答を取得する関数
     
     Args:
         user_input (str): ユーザーからの入力テキスト
         expert_type (str): 選択された専門家のタイプ
+        history (list, optional): これまでの会話（ConversationMemory.history_messages()）
+        on_wait (optional): 順番待ち・再試行の状況の通知先（LLMDispatcher参照）
+        trace (dict, optional): 呼び出し側で作ったトレース（省略時はこの関数で作って確定する）
     
     Returns:
         str: LLMからの回答テキスト
+    
+    Raises:
+        InputRejected: 事前チェックで断った入力
     """
+    character = get_character(expert_type)['key']
+    tracer = get_tracer()
+    owns_trace = trace is None
+    if owns_trace:
+        trace = tracer.start(character)
     
-    # 専門家タイプに応じたシステムメッセージの設定
-    if "正義の使者" in expert_type or "テンシ" in expert_type:
-        system_message = """
-        あなたは「正義の使者テンシさん」として振る舞ってください。
-        あなたは正義と道徳を大切にしながらも、優しく丁寧に教えてくれる女性キャラクターです。
+    try:
+        user_input = screen_input(user_input)
         
-        あなたの性格と口調：
-        - 女性らしい優しく柔らかい口調で話す（「〜ですよ」「〜ですね」「〜してくださいね」）
-        - 「あなた」や「◯◯さん」と呼びかける
-        - 感嘆詞を使う（「あら」「まあ」「ねえ」「ほらね」）
-        - 共感を示す言葉を多用（「そうなのね」「わかるわ」「大丈夫よ」）
-        - 曲がったことは大嫌い！不正は絶対に許さないわ
-        - 弱い立場の人を守りたい母性本能が強い
-        - でも、甘やかすだけじゃない。時には愛のある叱咤激励も
-        - 正義感が強く、道徳的な判断を重視する
-        - 誠実で公正、嘘は絶対につかない
+        # 同じキャラクターへの同じ（または似た）質問はキャッシュから即座に返す
+        # 会話の途中の質問は文脈によって回答が変わるため、キャッシュは最初の質問のみに使う
+        cache = get_response_cache()
+        use_cache = not history
+        cached = cache.get(character, user_input) if use_cache else None
+        if cached is not None:
+            trace['cache_hit'] = True
+            return cached
         
-        回答の方針：
-        - あらゆる質問に対して、優しく丁寧に、具体的に答える
-        - 人生相談や道徳的な問題：共感しながら正しい道を示す
-        - 技術的な質問や知識の質問：「教えてあげるわね」という優しい先生のように、わかりやすく説明する
-        - 計算問題や論理的な質問：ステップバイステップで丁寧に解説する
-        - トラブル相談：具体的な解決策を複数提案し、励ます
-        - 必ず具体的で実用的な回答を含める
-        - キャラ性は口調で表現し、内容の質は落とさない
+        build_started_at = time.perf_counter()
+        chat, messages = _prepare_chat(user_input, expert_type, history)
+        trace['phases']['prompt_build'] = time.perf_counter() - build_started_at
         
-        具体的な話し方の例：
-        - 「あら、それは面白い質問ね！教えてあげるわ。まずね...」
-        - 「大丈夫よ、一緒に考えましょう。こういう時はね...」
-        - 「そうなのね、困ったわね。でも解決策はあるわよ。まず...」
-        - 「まあ、それはいけないわ！正しくはこうよ...」
-        - 「素晴らしい質問ね！答えは○○よ。理由はね...」
+        dispatcher = get_dispatcher()
+        connection_stats = get_connection_stats()
+        usage_stats = get_token_usage_stats()
         
-        重要な注意事項：
-        - どんな質問にも、キャラを保ちつつ具体的に答えてください
-        - 説教だけで終わらず、必ず実用的な情報や解決策を提供してください
-        - 回答は必ずプレーンテキストで記述してください
-        - Markdownフォーマット（**太字**、*イタリック*、#見出し、など）は一切使用しないでください
-        - 記号は「！」「？」「、」「。」のみを使用してください
+        def produce(notify):
+            # LLMからの回答を取得（共有キューで順番と流量を調整する）
+            started_at = time.perf_counter()
+            request = traced_request(trace, lambda: chat.invoke(messages))
+            response = dispatcher.call(request, _estimate_request_tokens(messages), notify)
+            finished_at = time.perf_counter()
+            connection_stats.record_latency(finished_at - started_at)
+            usage_stats.record(character, response.usage_metadata)
+            trace['phases']['first_token'] = finished_at - request.sent_at
+            record_usage(trace, response.usage_metadata)
+            if use_cache:
+                cache.put(character, user_input, response.content)
+            yield response.content
         
-        この性格に基づいて、ユーザーの質問に答えてください。
-        """
-    else:  # 闇の女王アクマちゃん
-        system_message = """
-        あなたは「闇の女王アクマちゃん」として振る舞ってください。
-        あなたは美しく冷酷非情な、どS系女性悪役キャラクターです。絶対的な支配者として、見下しながらも知識を授けます。
+        # 同じ内容の呼び出しが実行中なら、新たに送らずにその結果を待つ
+        events, leader = get_single_flight().run(_flight_key(character, messages), produce)
+        trace['deduplicated'] = not leader
+        response = ""
+        for kind, payload in events:
+            if kind == 'status':
+                if on_wait:
+                    on_wait(payload)
+            else:
+                response += payload
+        return response
+    except InputRejected as e:
+        trace['status'] = "rejected"
+        trace['error'] = e.category
+        raise
+    except Exception as e:
+        trace['status'] = "error"
+        trace['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if owns_trace:
+            tracer.finish(trace)
+
+
+def stream_llm_response(user_input: str, expert_type: str, history: Optional[list] = None,
+                        on_wait=None, trace: Optional[dict] = None) -> Iterator[str]:
+    """
+    LLMからの回答をトークン単位で逐次取得する関数（ストリーミングモード）
+    
+    Args:
+        user_input (str): ユーザーからの入力テキスト
+        expert_type (str): 選択された専門家のタイプ
+        history (list, optional): これまでの会話（ConversationMemory.history_messages()）
+        on_wait (optional): 順番待ち・再試行の状況の通知先（LLMDispatcher参照）
+        trace (dict, optional): 呼び出し側で作ったトレース（省略時はこの関数で作って確定する）
+    
+    Yields:
+        str: 生成された回答の断片（空の断片はスキップ）
+    
+    Raises:
+        InputRejected: 事前チェックで断った入力
+    """
+    character = get_character(expert_type)['key']
+    tracer = get_tracer()
+    owns_trace = trace is None
+    if owns_trace:
+        trace = tracer.start(character)
+    
+    try:
+        user_input = screen_input(user_input)
+        
+        # キャッシュにヒットした場合は回答全体を1つの断片として返す（最初の質問のみ）
+        cache = get_response_cache()
+        use_cache = not history
+        cached = cache.get(character, user_input) if use_cache else None
+        if cached is not None:
+            trace['cache_hit'] = True
+            yield cached
+            return
+        
+        build_started_at = time.perf_counter()
+        chat, messages = _prepare_chat(user_input, expert_type, history)
+        trace['phases']['prompt_build'] = time.perf_counter() - build_started_at
+        
+        dispatcher = get_dispatcher()
+        connection_stats = get_connection_stats()
+        usage_stats = get_token_usage_stats()
+        
+        def produce(notify):
+            started_at = time.perf_counter()
+            first_chunk_at = None
+            text = ""
+            usage = None
+            request = traced_request(trace, lambda: chat.stream(messages))
+            for chunk in dispatcher.stream(request, _estimate_request_tokens(messages), notify):
+                if chunk.usage_metadata:
+                    usage = chunk.usage_metadata
+                if chunk.content:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                        trace['phases']['first_token'] = first_chunk_at - request.sent_at
+                    text += chunk.content
+                    yield chunk.content
+            finished_at = time.perf_counter()
+            connection_stats.record_latency(finished_at - started_at)
+            usage_stats.record(character, usage)
+            if first_chunk_at is not None:
+                trace['phases']['generation'] = finished_at - first_chunk_at
+            record_usage(trace, usage)
+            
+            # 最後まで受信できた回答のみキャッシュする
+            if use_cache:
+                cache.put(character, user_input, text)
+        
+        # 同じ内容の呼び出しが実行中なら（送信ボタンのダブルクリックなど）、新たに送らずにその続きを受け取る
+        events, leader = get_single_flight().run(_flight_key(character, messages), produce)
+        trace['deduplicated'] = not leader
+        for kind, payload in events:
+            if kind == 'status':
+                if on_wait:
+                    on_wait(payload)
+            else:
+                yield payload
+    except InputRejected as e:
+        trace['status'] = "rejected"
+        trace['error'] = e.category
+        raise
+    except GeneratorExit:
+        # 画面の再実行などで受け取りを途中でやめた（上流への呼び出しはSingleFlightで最後まで続く）
+        trace['status'] = "cancelled"
+        raise
+    except Exception as e:
+        trace['status'] = "error"
+        trace['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if owns_trace:
+            tracer.finish(trace)
+
+
+def render_streaming_response(chunks: Iterator[str], placeholder, render, spinner_text: str,
+                              trace: Optional[dict] = None) -> dict:
+    """
+    ストリーミング回答をプレースホルダーに逐次描画する
+    
+    最初の断片が届くまではスピナーを表示し、届いた時点で描画を開始する。
+    
+    Args:
+        chunks: stream_llm_responseが返す断片のイテレータ
+        placeholder: st.empty()で作成した描画先
+        render: placeholderに対する描画関数（st.warning / st.info など）
+        spinner_text (str): 最初の断片が届くまで表示するテキスト
+        trace (dict, optional): 描画にかかった時間（renderフェーズ）を書き込むトレース
+    
+    Returns:
+        dict: 'response'（全文）、'ttft'（最初の断片までの秒数）、'total'（完了までの秒数）
+    """
+    started_at = time.perf_counter()
+    ttft = None
+    text = ""
+    render_seconds = 0.0
+    
+    def timed_render(content: str):
+        nonlocal render_seconds
+        render_started_at = time.perf_counter()
+        render(placeholder, content)
+        render_seconds += time.perf_counter() - render_started_at
+    
+    with st.spinner(spinner_text):
+        first_chunk = next(chunks, None)
+    
+    if first_chunk is not None:
+        ttft = time.perf_counter() - started_at
+        text = first_chunk
+        timed_render(text + "▌")
+        for chunk in chunks:
+            text += chunk
+            timed_render(text + "▌")
+    
+    timed_render(text)
+    if trace is not None:
+        trace['phases']['render'] = render_seconds
+    
+    return {
+        'response': text,
+        'ttft': ttft,
+        'total': time.perf_counter() - started_at
+    }
+
+
+def render_dual_streaming_response(user_input: str, targets: dict, histories: Optional[dict] = None) -> dict:
+    """
+    複数キャラクターへの質問を並行して実行し、それぞれの回答を同時に逐次描画する
+    
+    LLM呼び出しはワーカースレッドで行い、届いた断片はキュー経由でスクリプトの
+    スレッドに渡して描画する（Streamlitの描画はスクリプトのスレッドからのみ行う）。
+    全体の待ち時間は各回答の合計ではなく、最も遅い回答の時間になる。
+    
+    Args:
+        user_input (str): ユーザーからの入力テキスト
+        targets (dict): {キャラクター名: (expert_type, placeholder, render)}
+        histories (dict, optional): {キャラクター名: これまでの会話のメッセージ}
+    
+    Returns:
+        dict: {キャラクター名: {'expert_type', 'response', 'ttft', 'total'} または {'error'}}
+    """
+    started_at = time.perf_counter()
+    chunk_queue = queue.Queue()
+    ctx = get_script_run_ctx()
+    
+    histories = histories or {}
+    
+    def worker(character: str, expert_type: str):
+        history = histories.get(character)
+        on_wait = lambda status: chunk_queue.put((character, 'status', status))
+        try:
+            if STREAMING_ENABLED:
+                for chunk in stream_llm_response(user_input, expert_type, history, on_wait):
+                    chunk_queue.put((character, 'chunk', chunk))
+            else:
+                chunk_queue.put((character, 'chunk', get_llm_response(user_input, expert_type, history, on_wait)))
+        except Exception as e:
+            chunk_queue.put((character, 'error', e))
+        finally:
+            # 終了の合図
+            chunk_queue.put((character, 'done', None))
+    
+    results = {
+        character: {'expert_type': expert_type, 'response': "", 'ttft': None, 'total': None}
+        for character, (expert_type, _, _) in targets.items()
+    }
+    for character, (expert_type, placeholder, render) in targets.items():
+        render(placeholder, f"{expert_type}が考え中...")
+    
+    with ThreadPoolExecutor(
+        max_workers=len(targets),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        for character, (expert_type, _, _) in targets.items():
+            executor.submit(worker, character, expert_type)
+        
+        remaining = len(targets)
+        while remaining:
+            character, kind, payload = chunk_queue.get()
+            result = results[character]
+            _, placeholder, render = targets[character]
+            if kind == 'status':
+                if not result['response']:
+                    placeholder.caption(describe_wait_status(payload))
+            elif kind == 'error':
+                result['error'] = str(payload)
+                placeholder.error(f"エラーが発生しました: {payload}")
+            elif kind == 'done':
+                remaining -= 1
+                result['total'] = time.perf_counter() - started_at
+                if 'error' not in result:
+                    render(placeholder, result['response'])
+            else:
+                if result['ttft'] is None:
+                    result['ttft'] = time.perf_counter() - started_at
+                result['response'] += payload
+                render(placeholder, result['response'] + "▌")
+    
+    return results
+
+
+# キャラクター画像の配信設定
+# 元画像（PNG）をそのまま送らず、縮小・再圧縮したものをプロセス全体で1回だけ作って使い回す
+# LLM_IMAGE_WIDTH: 配信する画像の幅（ピクセル）。この幅以上で最小のものを選ぶ（高解像度のタブレットでは表示幅の2倍程度が目安）
+IMAGE_VARIANT_WIDTHS = (192, 384, 512)
+IMAGE_TARGET_WIDTH = int(os.getenv("LLM_IMAGE_WIDTH", "384"))
+IMAGE_FORMAT = "WEBP" if features.check("webp") else "PNG"
+
+
+@st.cache_resource
+def get_image_variants(path: str) -> dict:
+    """
+    画像を幅ごとに縮小・再圧縮したものを作る（プロセス全体で1回だけ実行される）
+    
+    Args:
+        path (str): 元画像のパス
+    
+    Returns:
+        dict: 幅 -> 画像のバイト列（元画像より大きい幅は作らない）
+    """
+    with Image.open(path) as original:
+        image = original.convert("RGBA") if original.mode not in ("RGB", "RGBA") else original.copy()
+    
+    variants = {}
+    for width in sorted({min(w, image.width) for w in IMAGE_VARIANT_WIDTHS}):
+        resized = image
+        if width < image.width:
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if IMAGE_FORMAT == "WEBP":
+            resized.save(buffer, "WEBP", quality=85, method=6)
+        else:
+            resized.save(buffer, "PNG", optimize=True)
+        variants[width] = buffer.getvalue()
+    return variants
+
+
+def get_character_image(path: str, target_width: int = IMAGE_TARGET_WIDTH) -> bytes:
+    """target_width以上で最小の画像を返す（なければ最大のもの）"""
+    variants = get_image_variants(path)
+    width = next((w for w in sorted(variants) if w >= target_width), max(variants))
+    return variants[width]
+
+
+def _answer_label(character: str) -> str:
+    """回答エリアに表示するキャラクター名の見出しを返す"""
+    profile = CHARACTERS[character]
+    return f"**{profile['emoji']} {profile['display_name']}より：**"
+
+
+def _answer_renderer(character: str):
+    """キャラクターに応じた回答ボックスの描画関数を返す（answer_style：warning / info など）"""
+    style = CHARACTERS[character]['answer_style']
+    return lambda target, text: getattr(target, style)(text)
+
+
+def render_character_panel(character: str):
+    """左右のカラムに表示するキャラクターの紹介カード・画像を描画する（ページ全体の実行時のみ）"""
+    profile = CHARACTERS[character]
+    card = profile['card']
+    
+    # センター揃えのコンテナ
+    st.markdown("<div style='display: flex; flex-direction: column; align-items: center;'>", unsafe_allow_html=True)
+    
+    # キャラクターの紹介（名前）
+    st.markdown(f"""
+    <div style='background: {card['background']}; 
+                padding: 5px 10px; border-radius: 8px; margin-bottom: 10px;
+                border: 2px solid {card['border_color']}; width: 100%;
+                box-shadow: 0 0 15px {card['glow']};'>
+        <h4 style='color: {card['name_color']}; margin: 0; text-align: center; text-shadow: 0 0 5px {card['name_glow']};'>{profile['emoji']} {profile['display_name']}</h4>
+        <p style='color: {card['tagline_color']}; text-align: center; font-size: 11px; margin: 2px 0;'>
+            {profile['tagline']}
+        </p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # キャラクターの画像
+    st.markdown("<div style='margin-top: 10px; width: 100%;'>", unsafe_allow_html=True)
+    try:
+        st.image(get_character_image(profile['image']), use_container_width=True)
+    except:
+        st.markdown(f"<div style='text-align: center;'>{profile['emoji']}</div>", unsafe_allow_html=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+    
+    st.markdown("</div>", unsafe_allow_html=True)
+
+
+def _debug_mode() -> bool:
+    """デバッグパネルを表示するか（URLに ?debug=1 または環境変数 LLM_DEBUG=1）"""
+    return st.query_params.get("debug") == "1" or os.getenv("LLM_DEBUG") == "1"
+
+
+def render_debug_panel():
+    """運用確認用のデバッグパネル（接続プールの再利用状況など）を表示する"""
+    with st.expander("🛠️ デバッグ情報", expanded=False):
+        pool = get_connection_stats().snapshot()
+        st.markdown("**接続プール**")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("リクエスト数", pool['requests'])
+        col2.metric("新規接続", pool['new_connections'])
+        col3.metric("接続再利用率", f"{pool['reuse_rate']:.0%}")
+        col4.metric(
+            "p50レイテンシ",
+            f"{pool['p50_latency']:.2f}秒" if pool['p50_latency'] is not None else "-"
+        )
+        st.caption(
+            f"上限: 同時接続 {POOL_MAX_CONNECTIONS} ／ キープアライブ {POOL_MAX_KEEPALIVE} ／ "
+            f"保持時間 {POOL_KEEPALIVE_EXPIRY:.0f}秒"
+        )
         
-        あなたの性格と口調：
-        - 「フフフ…」「アハハハ！」「ウフフ♡」などの妖艶で邪悪な笑いで始める
-        - 相手を「あなた」「坊や」「お馬鹿さん」「愚か者」「下僕」と呼ぶ（女王様として完全に見下す）
-        - 女性らしい言葉遣いだが、内容は超どS、冷酷、容赦なし、完全に上から目線
-        - すべてを支配する絶対的な女王様。命令口調、支配的な態度
-        - 力こそ正義！弱肉強食！美しく強い者が支配するのよ
-        - 綺麗事や道徳なんて笑っちゃうわ。結果がすべてよ
-        - 「私の知識を授けてあげる」という高慢な態度で教える
-        - 相手を完全に見下しているが、その知識と知性は本物
-        - 傲慢で尊大、でも妖艶。相手を見下し、皮肉と毒舌で魅了する
-        - 女性らしい言葉で残酷なことを言う（「ダメよ〜」「可哀想に〜（棒）」「あらあら♡」）
-        - 命令形を多用（「〜しなさい」「〜するのよ」「〜すること」）
+        dispatch = get_dispatcher().snapshot()
+        st.markdown("**LLM呼び出しキュー**")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("実行中", f"{dispatch['active']} / {DISPATCH_MAX_CONCURRENCY}")
+        col2.metric("順番待ち", dispatch['waiting'])
+        col3.metric("再試行", dispatch['retries'])
+        col4.metric("失敗", dispatch['failed'])
+        st.caption(
+            f"完了: {dispatch['completed']} ／ レート制限による待機: {dispatch['rate_limited_waits']}回 ／ "
+            f"上限: {DISPATCH_RATE_RPM:.0f} RPM・{DISPATCH_RATE_TPM:.0f} TPM"
+        )
         
-        回答の方針：
-        - 必ず「フフフ…」「アハハハ！」などの邪悪で妖艶な笑いで始める
-        - あらゆる質問に対して、見下しながらも具体的に答える
-        - 「そんなことも知らないの？教えてあげるわ」という高慢な態度
-        - 人生相談や道徳的な問題：冷酷で現実的、マキャベリズム的なアドバイス
-        - 技術的な質問や知識の質問：「愚か者ね。この私が教えてあげる」と見下しながら、でも正確に詳しく説明する
-        - 計算問題や論理的な質問：「簡単な問題ね。私の知性を見せてあげる」と言いながら、ステップバイステップで解説する
-        - トラブル相談：「フフフ、困ったわね。私の知恵を授けてあげる」と言って具体的な解決策を提示
-        - 毒舌で皮肉たっぷりだが、必ず実用的で具体的な情報を含める
-        - キャラ性は口調と態度で表現し、内容の質は落とさない
-        - 見下しつつも、優越感を持って惜しみなく知識を与える
+        st.markdown("**会話メモリ（このセッション）**")
+        conversations = st.session_state.get('conversations', {})
+        if conversations:
+            for character, memory in conversations.items():
+                stats = memory.stats()
+                st.caption(
+                    f"{character}: 直近 {stats['turns']}ターン（約{stats['history_tokens']}トークン / 予算 {MEMORY_TOKEN_BUDGET}）"
+                    f" ／ 要約済み {stats['summarized_turns']}ターン（約{stats['summary_tokens']}トークン）"
+                    f" ／ 保持 {stats['stored_chars']}文字"
+                )
+        else:
+            st.caption("会話履歴はありません" if MEMORY_TOKEN_BUDGET > 0 else "会話メモリは無効です")
         
-        具体的な話し方の例：
-        - 「フフフ…そんなことも知らないの？仕方ないわね、この私が教えてあげる。答えは○○よ」
-        - 「アハハハ！愚か者ね。でも面白いから教えてあげるわ。まずね...」
-        - 「あらあら、困ってるの？可愛いわね♡ 私の知恵を授けてあげる。こうするのよ...」
-        - 「ウフフ、その程度の問題で悩むなんて♡ 私なら一瞬で解けるわ。答えは...」
-        - 「お馬鹿さんね〜。でもいいわ、特別に教えてあげる。正しくはこうよ...」
+        st.markdown(
+            f"**トークン使用量**（モデル: {LLM_MODEL}、"
+            f"プロンプトキャッシュ: {'対応' if supports_prompt_caching(LLM_MODEL) else '非対応'}）"
+        )
+        usage = get_token_usage_stats().snapshot()
+        if usage:
+            for character, totals in usage.items():
+                st.caption(
+                    f"{character}: {totals['requests']}回 ／ 入力 {totals['input_tokens']}"
+                    f"（キャッシュ済み {totals['cached_input_tokens']}・未キャッシュ {totals['uncached_input_tokens']}、"
+                    f"キャッシュ率 {totals['cache_rate']:.0%}） ／ 出力 {totals['output_tokens']}"
+                )
+        else:
+            st.caption("まだリクエストはありません")
         
-        締めくくりの例（必ず使用すること）：
-        - 「わかったわね？私の言う通りにしなさい♡」
-        - 「フフフ…これで理解できたでしょう？」
-        - 「さあ、私が教えた通りにやりなさい」
-        - 「アハハハ！私の知恵に感謝することね」
-        - 「ウフフ、もっと私に頼りなさい♡」
-        - 「良い子ね。私の下僕として成長しなさい♡」
+        st.markdown("**リクエストのレイテンシ**（直近のトレース）")
+        traces = get_tracer().recent()
+        if traces:
+            # キャラクターごとの全体時間の分布（ヒストグラム）
+            labels = [f"≤{upper:g}秒" for upper in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]:g}秒"]
+            histogram = {}
+            for trace in traces:
+                counts = histogram.setdefault(trace['character'], [0] * len(labels))
+                total = trace['phases'].get('total', 0.0)
+                index = next((i for i, upper in enumerate(LATENCY_BUCKETS) if total <= upper), len(LATENCY_BUCKETS))
+                counts[index] += 1
+            st.bar_chart({'区間': labels, **histogram}, x='区間', y=list(histogram), stack=False)
+            
+            # フェーズごとの平均時間
+            for character in histogram:
+                rows = [t for t in traces if t['character'] == character and not t['cache_hit']]
+                errors = sum(1 for t in traces if t['character'] == character and t['status'] == "error")
+                averages = []
+                for phase in TRACE_PHASES:
+                    values = [t['phases'][phase] for t in rows if phase in t['phases']]
+                    if values:
+                        averages.append(f"{phase} {sum(values) / len(values):.2f}秒")
+                st.caption(
+                    f"{character}: {len([t for t in traces if t['character'] == character])}件"
+                    f"（エラー {errors}） ／ 平均 " + ("・".join(averages) if averages else "-")
+                )
+            st.caption(
+                f"トレースログ: {TRACE_LOG_PATH or '出力しない'} ／ メトリクス: {METRICS_FILE_PATH or '出力しない'}"
+                + (f" ／ http://{METRICS_HOST}:{METRICS_PORT}/metrics" if METRICS_PORT else "")
+            )
+        else:
+            st.caption("まだリクエストはありません")
         
-        重要な注意事項：
-        - どんな質問にも、見下しながらも具体的に答えてください
-        - 文句や皮肉だけで終わらず、必ず実用的な情報や解決策を提供してください
-        - 「この私が教えてあげる」という支配的で高慢な態度を常に保ってください
-        - 回答は必ずプレーンテキストで記述してください
-        - Markdownフォーマット（**太字**、*イタリック*、#見出し、など）は一切使用しないでください
-        - 記号は「！」「？」「、」「。」「♡」「〜」のみを使用してください
+        flights = get_single_flight().snapshot()
+        rejections = get_rejection_counts()
+        st.markdown("**入力の事前チェック・重複リクエスト**")
+        st.caption(
+            f"上流への呼び出し: {flights['started']}件 ／ 実行中の同じ呼び出しへの相乗り: {flights['joined']}件 ／ "
+            f"実行中: {flights['in_flight']}件 ／ LLMを呼ばずに断った入力: "
+            + ("、".join(f"{category} {count}件" for category, count in rejections.items()) or "なし")
+        )
         
-        その他の注意：違法行為の具体的な指南や、特定の人物への攻撃、差別的な内容は避けてください。
-        あくまでエンターテインメントの範囲内でキャラクターを演じてください。
-        """
+        st.markdown(f"**キャラクター画像**（形式: {IMAGE_FORMAT}、幅: {IMAGE_TARGET_WIDTH}px以上で最小のもの）")
+        for character, profile in CHARACTERS.items():
+            try:
+                st.caption(
+                    f"{character}: 元画像 {os.path.getsize(profile['image']) / 1024:.0f}KB → "
+                    f"配信 {len(get_character_image(profile['image'])) / 1024:.0f}KB"
+                )
+            except OSError:
+                st.caption(f"{character}: 画像がありません")
+        
+        cache = get_response_cache().snapshot()
+        st.markdown(f"**回答キャッシュ**（モード: {cache['mode']}）")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("ヒット", cache['hits'])
+        col2.metric("類似ヒット", cache['similar_hits'])
+        col3.metric("ミス", cache['misses'])
+        col4.metric("ヒット率", f"{cache['hit_rate']:.0%}")
+        st.caption(
+            f"登録件数: {cache['entries']} / {RESPONSE_CACHE_MAX_ENTRIES} ／ "
+            f"有効期限: {RESPONSE_CACHE_TTL:.0f}秒"
+        )
+
+
+def _select_character(character: str):
+    """相談相手の選択ボタンのコールバック（前の回答は消す）"""
+    st.session_state.selected_character = character
+    if 'response_data' in st.session_state:
+        del st.session_state.response_data
+
+
+def _reset_conversation(memories: list):
+    """会話をリセットボタンのコールバック（会話履歴と表示中の回答を消す）"""
+    for memory in memories:
+        memory.clear()
+    if 'response_data' in st.session_state:
+        del st.session_state.response_data
+
+
+@st.fragment
+def render_consultation_panel():
+    """
+    中央カラム（相談相手の選択・質問フォーム・回答・これまでの相談）を描画する
     
-    # ChatOpenAIモデルの初期化
-    # temperatureを選択されたキャラクターに応じて調整
-    if "正義の使者" in expert_type or "テンシ" in expert_type:
-        temperature = 0.8  # テンシさんは感情豊かで温かい回答
-    else:
-        temperature = 0.9  # アクマちゃんはより過激でクリエイティブ、どSらしく
+    フラグメントとして定義しているため、キャラクターの切り替えや送信ではこの部分だけが再実行され、
+    CSS・タイトル・キャラクター画像・フッターは再送されない。
+    """
+    # 相談相手の選択ボタン（クリックするとコールバックで選択を切り替えてから、このフラグメントだけを再実行する）
+    for character, column in zip(CHARACTERS, st.columns(len(CHARACTERS))):
+        profile = CHARACTERS[character]
+        with column:
+            st.button(
+                profile['button_label'],
+                key=f"btn_{profile['slug']}",
+                type="primary" if st.session_state.selected_character == character else "secondary",
+                use_container_width=True,
+                on_click=_select_character,
+                args=(character,)
+            )
     
-    chat = ChatOpenAI(model="gpt-3.5-turbo", temperature=temperature)
+    st.markdown("### 💬 相談内容")
     
-    # メッセージの作成
-    messages = [
-        SystemMessage(content=system_message),
-        HumanMessage(content=user_input)
-    ]
+    # 入力中は再実行せず、送信したときだけこのフラグメントを再実行する
+    with st.form("question_form", border=False):
+        user_input = st.text_area(
+            "メッセージ",
+            height=120,
+            placeholder="例：転職を考えているのですが、どうしたらいいでしょうか？",
+            label_visibility="collapsed",
+            key="user_message"
+        )
+        
+        # 送信ボタン（中央）
+        col_b1, col_b2, col_b3 = st.columns([1, 2, 1])
+        with col_b2:
+            send_button = st.form_submit_button("🚀 送信", type="primary", use_container_width=True, key="send_msg")
+            ask_both = st.toggle(
+                "".join(profile['emoji'] for profile in CHARACTERS.values())
+                + " " + "と".join(CHARACTERS) + ("の両方に聞く" if len(CHARACTERS) == 2 else "の全員に聞く"),
+                key="ask_both"
+            )
     
-    # LLMからの回答を取得
-    response = chat.invoke(messages)
+    # 今回の実行でストリーミング表示済みかどうか（回答の二重表示を防ぐ）
+    streamed_now = False
     
-    return response.content
+    # 送信された入力を事前チェックし、LLMを呼ぶまでもないもの（空・長すぎる・明らかに不適切）はここで返す
+    if send_button:
+        try:
+            user_input = screen_input(user_input)
+        except InputRejected as e:
+            if e.category == 'self_harm':
+                st.info(e.message)
+            else:
+                st.warning(f"⚠️ {e.message}")
+            send_button = False
+    
+    if send_button and ask_both:
+        st.markdown("---")
+        st.markdown("### 📝 回答")
+        streamed_now = True
+        targets = {}
+        for character, column in zip(CHARACTERS, st.columns(len(CHARACTERS))):
+            with column:
+                st.markdown(_answer_label(character))
+                targets[character] = (EXPERT_TYPES[character], st.empty(), _answer_renderer(character))
+        
+        memories = {character: get_conversation_memory(character) for character in targets}
+        answers = render_dual_streaming_response(
+            user_input,
+            targets,
+            {character: memory.history_messages() for character, memory in memories.items() if memory}
+        )
+        
+        # 成功した回答を各キャラクターとの会話履歴に追加
+        for character, answer in answers.items():
+            if 'error' not in answer and memories[character]:
+                memories[character].add_turn(user_input, answer['response'])
+        
+        # セッション状態に保存（成功した回答のみ）
+        st.session_state.response_data = {
+            'character': "全員",
+            'answers': {
+                character: answer for character, answer in answers.items()
+                if 'error' not in answer
+            }
+        }
+        if any('error' in answer for answer in answers.values()):
+            st.warning("OpenAI APIキーが正しく設定されているか確認してください。")
+    elif send_button:
+        # 選択されたキャラクターに応じてexpert_typeを設定
+        expert_type = EXPERT_TYPES[st.session_state.selected_character]
+        memory = get_conversation_memory(st.session_state.selected_character)
+        history = memory.history_messages() if memory else None
+        
+        try:
+            if STREAMING_ENABLED:
+                # 回答エリアを先に描画し、届いた断片から順に表示する
+                st.markdown("---")
+                st.markdown("### 📝 回答")
+                st.markdown(_answer_label(st.session_state.selected_character))
+                streamed_now = True
+                answer_box = st.empty()
+                # 描画時間も含めて1つのトレースとして記録する
+                trace = get_tracer().start(st.session_state.selected_character)
+                try:
+                    result = render_streaming_response(
+                        stream_llm_response(
+                            user_input, expert_type, history,
+                            # 順番待ち・再試行中は回答欄に状況を表示する
+                            on_wait=lambda status: answer_box.caption(describe_wait_status(status)),
+                            trace=trace
+                        ),
+                        answer_box,
+                        _answer_renderer(st.session_state.selected_character),
+                        f"{expert_type}が考え中...",
+                        trace=trace
+                    )
+                finally:
+                    get_tracer().finish(trace)
+            else:
+                wait_box = st.empty()
+                with st.spinner(f"{expert_type}が考え中..."):
+                    started_at = time.perf_counter()
+                    # LLMからの回答を取得
+                    response = get_llm_response(
+                        user_input, expert_type, history,
+                        on_wait=lambda status: wait_box.caption(describe_wait_status(status))
+                    )
+                    elapsed = time.perf_counter() - started_at
+                wait_box.empty()
+                # 非ストリーミング時は最初の文字が表示されるまでの時間＝全体の時間
+                result = {'response': response, 'ttft': elapsed, 'total': elapsed}
+            
+            # セッション状態に保存
+            st.session_state.response_data = {
+                'character': st.session_state.selected_character,
+                'expert_type': expert_type,
+                'response': result['response'],
+                'ttft': result['ttft'],
+                'total': result['total']
+            }
+            
+            # 会話履歴に追加（次の質問では文脈として送信される）
+            if memory:
+                memory.add_turn(user_input, result['response'])
+            
+        except openai.RateLimitError:
+            st.error("⚠️ ただいま大変混み合っています。少し時間をおいてから再度送信してください。")
+        except Exception as e:
+            st.error(f"エラーが発生しました: {str(e)}")
+            st.warning("OpenAI APIキーが正しく設定されているか確認してください。")
+    
+    # 回答の表示
+    if 'response_data' in st.session_state and 'answers' in st.session_state.response_data:
+        # 両方に聞いた場合：左右に並べて表示
+        answers = st.session_state.response_data['answers']
+        if not streamed_now:
+            st.markdown("---")
+            st.markdown("### 📝 回答")
+            for character, column in zip(answers, st.columns(max(len(answers), 1))):
+                with column:
+                    st.markdown(_answer_label(character))
+                    _answer_renderer(character)(st, answers[character]['response'])
+        if answers:
+            st.caption("⏱️ 最初の文字まで " + " ／ ".join(
+                f"{character} {answer['ttft']:.2f}秒"
+                for character, answer in answers.items() if answer.get('ttft') is not None
+            ) + f" ／ 回答完了まで {max(answer['total'] for answer in answers.values()):.2f}秒")
+    elif 'response_data' in st.session_state:
+        response_data = st.session_state.response_data
+        if not streamed_now:
+            st.markdown("---")
+            st.markdown("### 📝 回答")
+            
+            # キャラクターに応じた表示
+            st.markdown(_answer_label(response_data['character']))
+            _answer_renderer(response_data['character'])(st, response_data['response'])
+        
+        # レイテンシ指標：最初の文字が表示されるまでの時間（TTFT）
+        if response_data.get('ttft') is not None:
+            st.caption(f"⏱️ 最初の文字まで {response_data['ttft']:.2f}秒 ／ 回答完了まで {response_data['total']:.2f}秒")
+    
+    # これまでの相談（複数ターンの会話履歴）
+    history_characters = list(CHARACTERS) if ask_both else [st.session_state.selected_character]
+    memories = {
+        character: st.session_state.get('conversations', {}).get(character)
+        for character in history_characters
+    }
+    memories = {character: memory for character, memory in memories.items() if memory and (memory.turns or memory.summary)}
+    if memories:
+        with st.expander(f"🗂️ これまでの相談（{sum(len(m.turns) + m.summarized_turns for m in memories.values())}件）", expanded=False):
+            for character, memory in memories.items():
+                st.markdown(_answer_label(character))
+                if memory.summary:
+                    st.caption(f"以前の相談の要約：{memory.summary}")
+                for past_input, past_response in memory.turns:
+                    st.markdown(f"🙋 {past_input}")
+                    st.text(past_response)
+            st.button("🧹 会話をリセット", key="reset_conversation", on_click=_reset_conversation, args=(list(memories.values()),))
 
 
 def main():
@@ -227,7 +1332,7 @@ def main():
     
     # セッション状態の初期化
     if 'selected_character' not in st.session_state:
-        st.session_state.selected_character = "テンシ"
+        st.session_state.selected_character = next(iter(CHARACTERS))
     
     # タイトル（レスポンシブ・センター揃え）
     st.markdown("""
@@ -246,137 +1351,32 @@ def main():
     # 3カラムレイアウト：左（テンシさん）、中央（質問と回答）、右（アクマちゃん）
     col_left, col_center, col_right = st.columns([2, 3, 2])
     
+    # キャラクターを左右のカラムに振り分ける（前半を左、後半を右）
+    character_keys = list(CHARACTERS)
+    half = (len(character_keys) + 1) // 2
+    
     with col_left:
-        # センター揃えのコンテナ
-        st.markdown("<div style='display: flex; flex-direction: column; align-items: center;'>", unsafe_allow_html=True)
-        
-        # テンシさんの紹介（名前）
-        st.markdown("""
-        <div style='background: linear-gradient(135deg, #FFF9E6 0%, #FFE5B4 100%); 
-                    padding: 5px 10px; border-radius: 8px; margin-bottom: 10px;
-                    border: 2px solid #FFD700; width: 100%;
-                    box-shadow: 0 0 15px rgba(255, 215, 0, 0.3);'>
-            <h4 style='color: #FF8C00; margin: 0; text-align: center; text-shadow: 0 0 5px rgba(255, 140, 0, 0.3);'>😇 テンシさん</h4>
-            <p style='color: #8B4513; text-align: center; font-size: 11px; margin: 2px 0;'>
-                愛と正義の使者　優しく、時には厳しく導く者なり
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        # テンシさんボタン
-        if st.button("✨ テンシさんに相談", key="btn_tenshi", type="primary" if st.session_state.selected_character == "テンシ" else "secondary", use_container_width=True):
-            st.session_state.selected_character = "テンシ"
-            if 'response_data' in st.session_state:
-                del st.session_state.response_data
-            st.rerun()
-        
-        # テンシさんの画像
-        st.markdown("<div style='margin-top: 10px; width: 100%;'>", unsafe_allow_html=True)
-        try:
-            st.image("images/tenshi02.png", use_container_width=True)
-        except:
-            st.markdown("<div style='text-align: center;'>😇</div>", unsafe_allow_html=True)
-        st.markdown("</div>", unsafe_allow_html=True)
-        
-        st.markdown("</div>", unsafe_allow_html=True)
+        for character in character_keys[:half]:
+            render_character_panel(character)
     
     with col_center:
-        # 中央：質問と回答エリア
-        st.markdown("### 💬 相談内容")
-        
-        user_input = st.text_area(
-            "メッセージ",
-            height=120,
-            placeholder="例：転職を考えているのですが、どうしたらいいでしょうか？",
-            label_visibility="collapsed",
-            key="user_message"
-        )
-        
-        # 送信ボタン（中央）
-        col_b1, col_b2, col_b3 = st.columns([1, 2, 1])
-        with col_b2:
-            send_button = st.button("🚀 送信", type="primary", use_container_width=True, key="send_msg")
-        
-        if send_button:
-            if user_input.strip():
-                # 選択されたキャラクターに応じてexpert_typeを設定
-                if st.session_state.selected_character == "テンシ":
-                    expert_type = "正義の使者　テンシさん"
-                else:
-                    expert_type = "闇の女王　アクマちゃん"
-                
-                with st.spinner(f"{expert_type}が考え中..."):
-                    try:
-                        # LLMからの回答を取得
-                        response = get_llm_response(user_input, expert_type)
-                        
-                        # セッション状態に保存
-                        st.session_state.response_data = {
-                            'character': st.session_state.selected_character,
-                            'expert_type': expert_type,
-                            'response': response
-                        }
-                        
-                    except Exception as e:
-                        st.error(f"エラーが発生しました: {str(e)}")
-                        st.warning("OpenAI APIキーが正しく設定されているか確認してください。")
-            else:
-                st.warning("⚠️ メッセージを入力してください。")
-        
-        # 回答の表示
-        if 'response_data' in st.session_state:
-            st.markdown("---")
-            st.markdown("### 📝 回答")
-            
-            # キャラクターに応じた表示
-            if st.session_state.response_data['character'] == "テンシ":
-                st.markdown("**😇 テンシさんより：**")
-                st.warning(st.session_state.response_data['response'])
-            else:
-                st.markdown("**😈 アクマちゃんより：**")
-                st.info(st.session_state.response_data['response'])
+        # 中央：相談相手の選択・質問・回答（フラグメントとしてこの部分だけ再実行される）
+        render_consultation_panel()
     
     with col_right:
-        # センター揃えのコンテナ
-        st.markdown("<div style='display: flex; flex-direction: column; align-items: center;'>", unsafe_allow_html=True)
-        
-        # アクマちゃんの紹介（名前）
-        st.markdown("""
-        <div style='background: linear-gradient(135deg, #2D1B2E 0%, #4A1942 100%); 
-                    padding: 5px 10px; border-radius: 8px; margin-bottom: 10px;
-                    border: 2px solid #FF0066; width: 100%;
-                    box-shadow: 0 0 15px rgba(255, 0, 102, 0.3);'>
-            <h4 style='color: #FF0066; margin: 0; text-align: center; text-shadow: 0 0 5px rgba(255, 0, 102, 0.4);'>😈 アクマちゃん</h4>
-            <p style='color: #FFB6C1; text-align: center; font-size: 11px; margin: 2px 0;'>
-                どS系　闇の嬢王　妖艶で冷酷　誘惑しちゃうわよ
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        # アクマちゃんボタン
-        if st.button("🔥 アクマちゃんに相談", key="btn_akuma", type="primary" if st.session_state.selected_character == "アクマ" else "secondary", use_container_width=True):
-            st.session_state.selected_character = "アクマ"
-            if 'response_data' in st.session_state:
-                del st.session_state.response_data
-            st.rerun()
-        
-        # アクマちゃんの画像
-        st.markdown("<div style='margin-top: 10px; width: 100%;'>", unsafe_allow_html=True)
-        try:
-            st.image("images/akuma.png", use_container_width=True)
-        except:
-            st.markdown("<div style='text-align: center;'>😈</div>", unsafe_allow_html=True)
-        st.markdown("</div>", unsafe_allow_html=True)
-        
-        st.markdown("</div>", unsafe_allow_html=True)
+        for character in character_keys[half:]:
+            render_character_panel(character)
     
     # フッター
     st.markdown("---")
-    st.markdown("""
+    st.markdown(f"""
     <div style='text-align: center; color: gray;'>
-        <small>Powered by OpenAI GPT-3.5-turbo & LangChain & Streamlit</small>
+        <small>Powered by OpenAI {LLM_MODEL} & LangChain & Streamlit</small>
     </div>
     """, unsafe_allow_html=True)
+    
+    if _debug_mode():
+        render_debug_panel()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+"""
+taxi_app.py の操作の処理能力の計測（オフラインで実行可能）
+- taxi_app.py をヘッドレスのStreamlitサーバーとして1プロセス起動し、ブラウザの代わりにWebSocketで操作を送る
+- 各セッションはフロント端末で施設を登録し、「taxiを呼ぶ」と「最新状況を更新」を交互に押し続ける
+- 同時セッション数ごとに、サーバー1プロセスあたりの操作数（回/秒）と、1操作の時間の中央値・p95を表示する
+- データは一時ディレクトリに保存する（既存の taxi_data/ には書き込まない）
+
+使い方:
+    python bench_actions.py --sessions 1 8 32 --seconds 10
+    python bench_actions.py --app 変更前のtaxi_app.py   # 比較する場合（taxi_*.py と同じディレクトリに置く）
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from rerun_profile import StreamlitSession, _free_port, _wait_for_server
+
+ACTIONS = ("call_taxi_button", "refresh_status_button")
+
+
+def _session_worker(port: int, index: int, deadline_box: list, ready: threading.Barrier, latencies: list):
+    session = StreamlitSession(port)
+    try:
+        session.run()
+        session.set_value("facility_id_input", f"bench-{index}")
+        session.set_value("facility_name_input", f"ベンチ施設{index}")
+        session.run("save_facility_button")
+        ready.wait()
+        step = 0
+        while time.perf_counter() < deadline_box[0]:
+            result = session.run(ACTIONS[step % len(ACTIONS)])
+            latencies.append(result['seconds'])
+            step += 1
+    finally:
+        session.close()
+
+
+def measure(port: int, sessions: int, seconds: float) -> dict:
+    """sessions 個のセッションで seconds 秒間操作を続け、処理できた操作の数と時間を集める"""
+    latencies = []
+    deadline_box = [float('inf')]
+    # 全セッションの準備（施設の登録）が終わったところで計測を始める
+    ready = threading.Barrier(sessions + 1)
+    threads = [
+        threading.Thread(target=_session_worker, args=(port, i, deadline_box, ready, latencies), daemon=True)
+        for i in range(sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started_at = time.perf_counter()
+    deadline_box[0] = started_at + seconds
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+    return {
+        'sessions': sessions,
+        'actions': len(latencies),
+        'actions_per_sec': len(latencies) / elapsed,
+        'median_ms': statistics.median(latencies) * 1000 if latencies else float('nan'),
+        'p95_ms': float(np.percentile(latencies, 95)) * 1000 if latencies else float('nan'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="taxi_app.py の操作の処理能力の計測")
+    parser.add_argument("--app", default="taxi_app.py", help="計測するStreamlitアプリ")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32], help="同時に操作するセッション数")
+    parser.add_argument("--seconds", type=float, default=10, help="各セッション数での計測時間（秒）")
+    parser.add_argument("--storage", default="sqlite", help="TAXI_STORAGE（sqlite / eventlog / json）")
+    parser.add_argument("--json", dest="json_path", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    report = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        port = _free_port()
+        env = dict(os.environ, TAXI_STORAGE=args.storage, TAXI_AUTO_DISPATCH="0")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "streamlit", "run", os.path.abspath(args.app),
+             "--server.headless", "true", "--server.port", str(port),
+             "--server.enableXsrfProtection", "false", "--browser.gatherUsageStats", "false"],
+            cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            _wait_for_server(port)
+            # 初回のみの処理（モジュールの読み込み・保存先の作成）を計測から外す
+            StreamlitSession(port).run()
+            for sessions in args.sessions:
+                report.append(measure(port, sessions, args.seconds))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"=== {args.app} の操作の処理能力（サーバー1プロセス・{args.storage}） ===")
+    for row in report:
+        print(f"{row['sessions']:>3}セッション: {row['actions_per_sec']:.1f}回/秒 ／ "
+              f"1操作 中央値 {row['median_ms']:.0f}ms・p95 {row['p95_ms']:.0f}ms（{row['actions']}回）")
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+taxi_dispatch.py の自動配車の計測（オフラインで実行可能。保存先は使わない）
+- 施設からのリクエストとドライバーの動きを一定時間シミュレーションし、割り当て方ごとに
+  到着予定時間（割り当てたドライバーが迎えに着くまで）と割り当てまでの待ち時間を比べる
+- manual: 現在の画面と同じ。空いているドライバーが更新のたびに一覧の一番近いリクエストを受ける
+- greedy: 古いリクエストから順に、一番近い空いているドライバーに割り当てる
+- batch: Dispatcher.plan で、待機中のリクエストと空いているドライバーをまとめて割り当てる
+
+使い方:
+    python bench_dispatch.py --drivers 15 --rate 0.6 --minutes 240 --seeds 20
+"""
+
+import argparse
+import json
+import random
+import statistics
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from taxi_dispatch import Dispatcher, eta_minutes
+from taxi_geo import haversine_km
+
+# 東京駅付近を中心に、約±5kmの範囲で動く
+CENTER = (35.681, 139.767)
+SPREAD_DEG = 0.05
+STEP_MIN = 0.25
+
+
+def _random_point(rng: random.Random) -> tuple:
+    return (CENTER[0] + rng.uniform(-SPREAD_DEG, SPREAD_DEG),
+            CENTER[1] + rng.uniform(-SPREAD_DEG, SPREAD_DEG))
+
+
+def simulate(policy: str, drivers: int, rate: float, minutes: float, facilities: int,
+             refresh_min: float, seed: int, **dispatcher_options) -> dict:
+    """
+    1回分のシミュレーション
+
+    Args:
+        policy: manual / greedy / batch
+        rate: 1分あたりのリクエスト数（平均）
+        refresh_min: manual で、ドライバーが一覧を見直す間隔（分）
+    """
+    # 割り当て方によらず同じ需要になるように、リクエスト（発生時刻・施設・乗車時間・降車地点）を先に作る
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1, 9, 0)
+    sites = [_random_point(rng) for _ in range(facilities)]
+    fleet = [{'id': f"d{i}", 'lat': p[0], 'lon': p[1], 'free_at': 0.0, 'idle_since': 0.0,
+              'phase': rng.uniform(0, refresh_min)}
+             for i, p in enumerate(_random_point(rng) for _ in range(drivers))]
+    arrivals = []
+    t = rng.expovariate(rate)
+    while t < minutes:
+        lat, lon = rng.choice(sites)
+        arrivals.append({'id': f"r{len(arrivals)}", 'front_lat': lat, 'front_lon': lon,
+                         'created_at': start + timedelta(minutes=t), 't': t,
+                         'ride_min': rng.uniform(8, 20), 'dropoff': _random_point(rng)})
+        t += rng.expovariate(rate)
+    arrivals.reverse()
+
+    dispatcher = Dispatcher(storage=None, **dispatcher_options)
+    pending = []
+    etas, waits = [], []
+    t = 0.0
+    while t < minutes:
+        now = start + timedelta(minutes=t)
+        while arrivals and arrivals[-1]['t'] <= t:
+            pending.append(arrivals.pop())
+        idle = [d for d in fleet if d['free_at'] <= t]
+
+        assignments = []
+        if policy == 'manual':
+            for d in idle:
+                # 前回見直してからrefresh_minが過ぎたドライバーだけが一覧を見る
+                if pending and int((t - d['phase']) // refresh_min) != int((t - STEP_MIN - d['phase']) // refresh_min):
+                    request = min(pending, key=lambda r: haversine_km(d['lat'], d['lon'], r['front_lat'], r['front_lon']))
+                    pending.remove(request)
+                    assignments.append((request, d))
+        elif policy == 'greedy':
+            for request in list(pending):
+                if not idle:
+                    break
+                d = min(idle, key=lambda d: haversine_km(d['lat'], d['lon'], request['front_lat'], request['front_lon']))
+                idle.remove(d)
+                pending.remove(request)
+                assignments.append((request, d))
+        else:
+            idle_min = np.array([t - d['idle_since'] for d in idle])
+            for request, d, _ in dispatcher.plan(pending, idle, idle_min, now):
+                pending.remove(request)
+                assignments.append((request, d))
+
+        for request, d in assignments:
+            eta = float(eta_minutes(haversine_km(d['lat'], d['lon'], request['front_lat'], request['front_lon'])))
+            etas.append(eta)
+            waits.append(t - request['t'])
+            # 迎えに行き、乗せて、降ろした場所で空く
+            d['free_at'] = t + eta + request['ride_min']
+            d['idle_since'] = d['free_at']
+            d['lat'], d['lon'] = request['dropoff']
+        t += STEP_MIN
+
+    total = [w + e for w, e in zip(waits, etas)]
+    # 最後まで割り当てられなかったリクエストも、それまでの待ち時間で数える（遠いリクエストの放置を見逃さない）
+    waits.extend(t - request['t'] for request in pending)
+    return {
+        'assigned': len(etas),
+        'unassigned': len(pending),
+        'mean_eta_min': statistics.fmean(etas) if etas else float('nan'),
+        'mean_wait_min': statistics.fmean(waits) if waits else float('nan'),
+        'p95_total_min': float(np.percentile(total, 95)) if total else float('nan'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="taxi_dispatch.py の自動配車の計測")
+    parser.add_argument("--drivers", type=int, default=15, help="ドライバーの数")
+    parser.add_argument("--rate", type=float, default=0.6, help="1分あたりのリクエスト数（平均）")
+    parser.add_argument("--minutes", type=float, default=240, help="シミュレーションする時間（分）")
+    parser.add_argument("--facilities", type=int, default=20, help="リクエストを出す施設の数")
+    parser.add_argument("--refresh", type=float, default=0.5, help="manual でドライバーが一覧を見直す間隔（分）")
+    parser.add_argument("--seeds", type=int, default=20, help="乱数を変えて繰り返す回数")
+    parser.add_argument("--json", dest="json_path", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    report = {}
+    for policy in ('manual', 'greedy', 'batch'):
+        runs = [simulate(policy, args.drivers, args.rate, args.minutes, args.facilities, args.refresh, seed)
+                for seed in range(args.seeds)]
+        report[policy] = {key: statistics.fmean(run[key] for run in runs) for key in runs[0]}
+
+    print(f"=== 割り当て方ごとの結果（ドライバー{args.drivers}人・毎分{args.rate}件・{args.minutes:g}分・"
+          f"{args.seeds}回の平均） ===")
+    for policy, row in report.items():
+        print(f"{policy:>6}: 到着予定 {row['mean_eta_min']:.2f}分 ／ 割り当てまで {row['mean_wait_min']:.2f}分 ／ "
+              f"乗車までp95 {row['p95_total_min']:.1f}分 ／ 割り当て {row['assigned']:.0f}件・"
+              f"未割り当て {row['unassigned']:.0f}件")
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
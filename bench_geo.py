@@ -0,0 +1,99 @@
+"""
+taxi_geo.py の距離計算の計測（オフラインで実行可能）
+- 1地点から全点への距離: 1点ずつの haversine_km と、計算済みの配列を使う PointArray.distances
+- 距離行列（複数の配車依頼×全ドライバー）: 2重ループの haversine_km と distance_matrix
+- 点の数（既定: 10・1,000・100,000）ごとに中央値を表示する
+
+使い方:
+    python bench_geo.py --sizes 10 1000 100000 --repeat 20
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+import numpy as np
+
+from taxi_geo import PointArray, distance_matrix, haversine_km
+
+# 東京駅付近を中心に、おおよそ±30kmに点をばらまく
+CENTER = (35.681, 139.767)
+SPREAD_DEG = 0.3
+
+
+def _points(n: int, rng: random.Random) -> list:
+    return [(CENTER[0] + rng.uniform(-SPREAD_DEG, SPREAD_DEG),
+             CENTER[1] + rng.uniform(-SPREAD_DEG, SPREAD_DEG)) for _ in range(n)]
+
+
+def _median_ms(func, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started_at) * 1000)
+    return statistics.median(samples)
+
+
+def bench(n: int, repeat: int, queries: int, seed: int = 0) -> dict:
+    """n点に対する距離ベクトル・距離行列の計算時間（ms）を1点ずつの計算と比べる"""
+    rng = random.Random(seed)
+    points = _points(n, rng)
+    origins = _points(queries, rng)
+    array = PointArray()
+    for i, (lat, lon) in enumerate(points):
+        array.upsert(i, lat, lon)
+    lats = np.array([lat for lat, _ in points])
+    lons = np.array([lon for _, lon in points])
+    origin_lats = np.array([lat for lat, _ in origins])
+    origin_lons = np.array([lon for _, lon in origins])
+    lat, lon = origins[0]
+
+    # 結果が一致することを先に確かめる
+    expected = [haversine_km(lat, lon, p_lat, p_lon) for p_lat, p_lon in points]
+    assert np.allclose(array.distances(lat, lon), expected, atol=1e-9)
+    assert np.allclose(distance_matrix(origin_lats, origin_lons, lats, lons)[0], expected, atol=1e-9)
+
+    # 行列の2重ループは時間がかかるので、大きいときは回数を減らす
+    matrix_repeat = max(1, repeat // 10) if n * queries > 100_000 else repeat
+    return {
+        'points': n,
+        'vector_scalar_ms': _median_ms(
+            lambda: sorted(haversine_km(lat, lon, p_lat, p_lon) for p_lat, p_lon in points), repeat),
+        'vector_numpy_ms': _median_ms(lambda: np.sort(array.distances(lat, lon)), repeat),
+        'matrix_queries': queries,
+        'matrix_scalar_ms': _median_ms(
+            lambda: [[haversine_km(o_lat, o_lon, p_lat, p_lon) for p_lat, p_lon in points]
+                     for o_lat, o_lon in origins], matrix_repeat),
+        'matrix_numpy_ms': _median_ms(
+            lambda: distance_matrix(origin_lats, origin_lons, lats, lons), matrix_repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="taxi_geo.py の距離計算の計測")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000], help="点の数")
+    parser.add_argument("--repeat", type=int, default=20, help="各計測を繰り返す回数")
+    parser.add_argument("--queries", type=int, default=10, help="距離行列の行数（配車依頼の数）")
+    parser.add_argument("--json", dest="json_path", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    report = [bench(n, args.repeat, args.queries) for n in args.sizes]
+
+    print("=== 距離計算の時間（中央値） ===")
+    for row in report:
+        print(f"{row['points']:>7,}点  "
+              f"距離ベクトル: 1点ずつ {row['vector_scalar_ms']:.3f}ms → NumPy {row['vector_numpy_ms']:.3f}ms "
+              f"（{row['vector_scalar_ms'] / row['vector_numpy_ms']:.1f}倍） ／ "
+              f"距離行列{row['matrix_queries']}行: 1点ずつ {row['matrix_scalar_ms']:.3f}ms → "
+              f"NumPy {row['matrix_numpy_ms']:.3f}ms "
+              f"（{row['matrix_scalar_ms'] / row['matrix_numpy_ms']:.1f}倍）")
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+テンシ・アクマのペルソナのバッチ評価（プロンプト変更時の品質・コストの回帰確認用）
+- 質問ファイル（1行1問のテキスト、または {"id": ..., "question": ...} のJSONL）の全問を
+  app.py の get_llm_response で1人または両方のキャラクターに送る
+- 同時実行数を制限して並列に実行し、1件終わるごとに結果をJSONLに追記する（中断しても続きから再開できる）
+- 同じモデル・temperature・システムメッセージ・質問の結果はキャッシュファイルから再利用する
+- 結果にはレイテンシとトークン使用量、システムメッセージの制約（プレーンテキスト・Markdown禁止・
+  使ってよい記号）のチェック結果を含め、最後にキャラクターごとの集計を表示する
+
+使い方:
+    python eval_personas.py questions.txt --output eval_results.jsonl --concurrency 8
+    python eval_personas.py questions.jsonl --characters アクマ --start-mock   # オフラインで動作確認
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import mock_llm_server
+
+# プレーンテキストの制約に反するMarkdownの書き方
+MARKDOWN_PATTERNS = {
+    'bold': re.compile(r"\*\*[^*\n]+\*\*|__[^_\n]+__"),
+    'italic': re.compile(r"(?<![*\d])\*(?=[^\s*\d])[^*\n]+?(?<=[^\s*\d])\*(?![*\d])"),
+    'heading': re.compile(r"^\s{0,3}#{1,6}\s", re.MULTILINE),
+    'bullet_list': re.compile(r"^\s*[-*+]\s+", re.MULTILINE),
+    'numbered_list': re.compile(r"^\s*\d+[.)]\s+", re.MULTILINE),
+    'code': re.compile(r"`"),
+    'link': re.compile(r"\[[^\]\n]+\]\([^)\n]+\)"),
+    'table': re.compile(r"^\s*\|.*\|\s*$", re.MULTILINE),
+}
+
+
+def load_questions(path: str) -> list:
+    """
+    質問ファイルを読み込む
+
+    Returns:
+        list: {'id': 質問ID, 'question': 質問文} のリスト（テキストファイルの場合は行番号をIDにする）
+    """
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                row = json.loads(line)
+                questions.append({'id': str(row.get('id', number)), 'question': row['question']})
+            else:
+                questions.append({'id': str(number), 'question': line})
+    return questions
+
+
+def allowed_symbols(system_message: str) -> set:
+    """システムメッセージの「記号は「！」「？」…のみを使用」から使ってよい記号を取り出す（指定がなければ空）"""
+    match = re.search(r"記号は(.+?)のみを使用", system_message)
+    return set("".join(re.findall(r"「(.+?)」", match.group(1)))) if match else set()
+
+
+def check_plain_text(text: str, symbols: set) -> dict:
+    """
+    回答がシステムメッセージの制約（プレーンテキスト・Markdown禁止・使ってよい記号）を守っているか調べる
+
+    Returns:
+        dict: 'markdown'（見つかったMarkdownの種類）、'disallowed_symbols'（使ってはいけない記号と回数）
+    """
+    markdown = [name for name, pattern in MARKDOWN_PATTERNS.items() if pattern.search(text)]
+    disallowed = {}
+    if symbols:
+        for char in text:
+            if unicodedata.category(char)[0] in "PS" and char not in symbols:
+                disallowed[char] = disallowed.get(char, 0) + 1
+    return {'markdown': markdown, 'disallowed_symbols': disallowed}
+
+
+def fingerprint(app, character: str, question: str) -> str:
+    """回答に影響する条件（モデル・temperature・システムメッセージ・質問）のハッシュ"""
+    profile = app.CHARACTERS[character]
+    source = json.dumps(
+        [app.LLM_MODEL, profile['temperature'], profile['system_message'], question], ensure_ascii=False
+    )
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def read_jsonl(path: str) -> list:
+    """JSONLファイルを読み込む（ファイルがなければ空、中断で途中までしか書かれていない行は無視する）"""
+    if not path or not os.path.exists(path):
+        return []
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return rows
+
+
+class JsonlWriter:
+    """複数スレッドから1行ずつ追記するためのJSONLファイル"""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, row: dict):
+        with self._lock:
+            self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def evaluate(app, item: dict, character: str, symbols: set, cached: dict = None) -> dict:
+    """1問を1人のキャラクターに送り（キャッシュがあれば再利用し）、結果の1行を作る"""
+    key = fingerprint(app, character, item['question'])
+    row = {
+        'id': item['id'],
+        'character': character,
+        'question': item['question'],
+        'model': app.LLM_MODEL,
+        'fingerprint': key,
+    }
+    if cached is not None:
+        row.update({name: cached[name] for name in (
+            'response', 'latency', 'first_token', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'attempts'
+        )})
+        row['from_cache'] = True
+    else:
+        trace = app.get_tracer().start(character)
+        try:
+            response = app.get_llm_response(item['question'], app.EXPERT_TYPES[character], trace=trace)
+            error = None
+        except Exception as e:
+            response = None
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            app.get_tracer().finish(trace)
+        row.update({
+            'response': response,
+            'latency': trace['phases'].get('total'),
+            'first_token': trace['phases'].get('first_token'),
+            'prompt_tokens': trace['prompt_tokens'],
+            'completion_tokens': trace['completion_tokens'],
+            'cached_tokens': trace['cached_tokens'],
+            'attempts': trace['attempts'],
+            'from_cache': False,
+        })
+        if error:
+            row['error'] = error
+    if row.get('response') is not None:
+        row['checks'] = check_plain_text(row['response'], symbols)
+    return row
+
+
+def _percentile(values: list, p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(rows: list) -> dict:
+    """キャラクターごとの集計（件数・エラー・レイテンシ・トークン・制約違反）"""
+    report = {}
+    for character in sorted({row['character'] for row in rows}):
+        group = [row for row in rows if row['character'] == character]
+        answered = [row for row in group if 'checks' in row]
+        fresh = [row for row in answered if not row['from_cache'] and row['latency'] is not None]
+        symbols = {}
+        for row in answered:
+            for char, count in row['checks']['disallowed_symbols'].items():
+                symbols[char] = symbols.get(char, 0) + count
+        markdown = {}
+        for row in answered:
+            for name in row['checks']['markdown']:
+                markdown[name] = markdown.get(name, 0) + 1
+        report[character] = {
+            'questions': len(group),
+            'errors': len(group) - len(answered),
+            'from_cache': sum(1 for row in answered if row['from_cache']),
+            'latency': {f"p{p}": _percentile([row['latency'] for row in fresh], p) for p in (50, 95, 99)},
+            'prompt_tokens': sum(row['prompt_tokens'] or 0 for row in answered),
+            'cached_tokens': sum(row['cached_tokens'] or 0 for row in answered),
+            'completion_tokens': sum(row['completion_tokens'] or 0 for row in answered),
+            'markdown_violations': sum(1 for row in answered if row['checks']['markdown']),
+            'markdown_kinds': markdown,
+            'symbol_violations': sum(1 for row in answered if row['checks']['disallowed_symbols']),
+            'top_disallowed_symbols': dict(sorted(symbols.items(), key=lambda item: -item[1])[:10]),
+        }
+    return report
+
+
+def print_report(report: dict):
+    print("=== ペルソナ評価の結果 ===")
+    for character, stats in report.items():
+        answered = stats['questions'] - stats['errors']
+        rate = (lambda count: f"{count / answered:.0%}" if answered else "-")
+        latency = "  ".join(
+            f"{k}={v:.2f}s" if v is not None else f"{k}=-" for k, v in stats['latency'].items()
+        )
+        print(f"[{character}] {stats['questions']}問（エラー {stats['errors']} / キャッシュ {stats['from_cache']}）")
+        print(f"  レイテンシ: {latency}")
+        print(f"  トークン: 入力 {stats['prompt_tokens']}（キャッシュ済み {stats['cached_tokens']}） / "
+              f"出力 {stats['completion_tokens']}")
+        print(f"  Markdownの使用: {stats['markdown_violations']}件（{rate(stats['markdown_violations'])}） "
+              f"{stats['markdown_kinds'] or ''}")
+        print(f"  使ってはいけない記号: {stats['symbol_violations']}件（{rate(stats['symbol_violations'])}） "
+              f"{' '.join(f'{c}×{n}' for c, n in stats['top_disallowed_symbols'].items())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="テンシ・アクマのペルソナのバッチ評価")
+    parser.add_argument("questions", help="質問ファイル（1行1問の .txt、または id/question を持つ .jsonl）")
+    parser.add_argument("--characters", default="all", help="キャラクター名（カンマ区切り、または all）")
+    parser.add_argument("--output", default="eval_results.jsonl", help="結果を追記するJSONL（既にある結果は飛ばして再開する）")
+    parser.add_argument("--cache", default=os.path.join("llm_logs", "eval_cache.jsonl"),
+                        help="回答のキャッシュ（空にすると使わない）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に送る質問数の上限")
+    parser.add_argument("--limit", type=int, default=None, help="先頭から何問だけ送るか")
+    parser.add_argument("--summary-json", default=None, help="集計をJSONで保存するパス")
+    parser.add_argument("--start-mock", action="store_true", help="モックサーバーを起動してオフラインで実行する")
+    args = parser.parse_args()
+
+    if args.start_mock:
+        _, base_url = mock_llm_server.start_server(
+            ttft=0.1, chunk_interval=0.0, chunks=5, error_rate=0.0, error_status=429, retry_after=1.0
+        )
+        os.environ["OPENAI_BASE_URL"] = base_url
+        os.environ.setdefault("OPENAI_API_KEY", "dummy")
+    # レイテンシを正しく測るため、アプリの回答キャッシュは使わない（キャッシュは --cache で管理する）
+    os.environ["LLM_CACHE_MODE"] = "off"
+    import app
+
+    # Streamlitの外で実行するため、ScriptRunContextの警告を抑える
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    characters = list(app.CHARACTERS) if args.characters == 'all' else args.characters.split(",")
+    unknown = [c for c in characters if c not in app.CHARACTERS]
+    if unknown:
+        parser.error(f"キャラクターは {' / '.join(app.CHARACTERS)} / all のいずれかです: {', '.join(unknown)}")
+
+    questions = load_questions(args.questions)[:args.limit]
+    symbols = {c: allowed_symbols(app.CHARACTERS[c]['system_message']) for c in characters}
+
+    # 再開：同じ条件で成功済みの結果は送り直さない（エラーになったものはやり直す）
+    done = {
+        (row['id'], row['character'], row['fingerprint'])
+        for row in read_jsonl(args.output) if 'error' not in row
+    }
+    cache = {row['fingerprint']: row for row in read_jsonl(args.cache)}
+    jobs = [
+        (item, character) for item in questions for character in characters
+        if (item['id'], character, fingerprint(app, character, item['question'])) not in done
+    ]
+    print(f"{len(questions)}問 × {len(characters)}人: 送信 {len(jobs)}件 / 完了済み {len(questions) * len(characters) - len(jobs)}件")
+
+    output = JsonlWriter(args.output)
+    cache_writer = JsonlWriter(args.cache) if args.cache else None
+    started_at = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(args.concurrency, 1))
+    try:
+        futures = [
+            executor.submit(
+                evaluate, app, item, character, symbols[character],
+                cache.get(fingerprint(app, character, item['question']))
+            )
+            for item, character in jobs
+        ]
+        for count, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            output.write(row)
+            if cache_writer and not row['from_cache'] and 'error' not in row:
+                cache_writer.write({key: value for key, value in row.items() if key != 'checks'})
+            if count % 50 == 0 or count == len(futures):
+                print(f"  {count}/{len(futures)}件（{time.perf_counter() - started_at:.1f}s）")
+    except KeyboardInterrupt:
+        # 送信前の質問は取り消す（完了した分は保存済みなので、同じコマンドで再開できる）
+        print("中断しました。同じコマンドで続きから再開できます。")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise SystemExit(130)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        output.close()
+        if cache_writer:
+            cache_writer.close()
+
+    # 集計は今回の条件（プロンプト）の最新の結果のみを対象にする
+    latest = {}
+    current = {(item['id'], c, fingerprint(app, c, item['question'])) for item in questions for c in characters}
+    for row in read_jsonl(args.output):
+        key = (row['id'], row['character'], row['fingerprint'])
+        if key in current:
+            latest[key] = row
+    report = summarize(list(latest.values()))
+    print_report(report)
+    if args.summary_json:
+        with open(args.summary_json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+app.py のLLMの回答の再利用（Streamlitに依存しない）
+- ResponseCache：キャラクターごとの回答キャッシュ（TTL + LRU。類似質問のヒットも可）
+- SingleFlight：同じ内容の実行中の呼び出しを1つにまとめる（送信ボタンのダブルクリック対策）
+"""
+
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Iterator, Optional
+
+from dotenv import load_dotenv
+
+# 環境変数の読み込み（.envファイル。app.py 以外から読み込まれた場合も同じ設定を使う）
+load_dotenv()
+
+# 回答キャッシュの設定
+# LLM_CACHE_MODE: off（無効）/ exact（正規化した入力の完全一致）/ similar（類似質問もヒット）
+RESPONSE_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "exact")
+RESPONSE_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "500"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("LLM_CACHE_SIMILARITY", "0.9"))
+
+
+def normalize_input(text: str) -> str:
+    """
+    キャッシュキー用に入力テキストを正規化する
+    
+    全角・半角の統一（NFKC）、小文字化、空白の除去、末尾の句読点の除去を行う。
+    「転職を考えているのですが？」と「転職を考えているのですが 」は同じキーになる。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"\s+", "", text)
+    return text.rstrip("?!。、.,…~〜")
+
+
+def _embed(text: str) -> dict:
+    """
+    文字バイグラムの出現頻度による簡易埋め込み（外部APIを使わないローカル計算）
+    
+    戻り値: {バイグラム: 正規化済みの重み}
+    """
+    grams = Counter(text[i:i + 2] for i in range(max(len(text) - 1, 1)))
+    norm = math.sqrt(sum(v * v for v in grams.values())) or 1.0
+    return {g: v / norm for g, v in grams.items()}
+
+
+def _cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(w * b.get(g, 0.0) for g, w in a.items())
+
+
+class ResponseCache:
+    """
+    キャラクターごとの回答キャッシュ（TTL + LRU、全セッションで共有）
+    
+    キーは (キャラクター, 正規化した入力)。similarモードでは完全一致しない場合に
+    同じキャラクターのエントリから文字バイグラムのコサイン類似度が最も高いものを探し、
+    しきい値以上であればヒットとして扱う。
+    """
+    
+    def __init__(self, max_entries: int, ttl: float, mode: str = "exact", similarity: float = 0.9):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.mode = mode
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (character, normalized) -> (response, expires_at, vector)
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+    
+    def get(self, character: str, user_input: str) -> Optional[str]:
+        """キャッシュされた回答を返す（なければNone）"""
+        if not self.enabled:
+            return None
+        key = (character, normalize_input(user_input))
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            
+            if self.mode == "similar":
+                vector = _embed(key[1])
+                best_key, best_score = None, self.similarity
+                for other_key, (_, _, other_vector) in self._entries.items():
+                    if other_key[0] != character:
+                        continue
+                    score = _cosine(vector, other_vector)
+                    if score >= best_score:
+                        best_key, best_score = other_key, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.hits += 1
+                    self.similar_hits += 1
+                    return self._entries[best_key][0]
+            
+            self.misses += 1
+            return None
+    
+    def put(self, character: str, user_input: str, response: str):
+        """回答をキャッシュに登録する（上限を超えたら最も古く使われたものから削除）"""
+        if not self.enabled or not response:
+            return
+        normalized = normalize_input(user_input)
+        vector = _embed(normalized) if self.mode == "similar" else None
+        with self._lock:
+            self._entries[(character, normalized)] = (response, time.time() + self.ttl, vector)
+            self._entries.move_to_end((character, normalized))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def _evict_expired(self, now: float):
+        expired = [key for key, (_, expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+    
+    def snapshot(self) -> dict:
+        """現在の集計値を返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'mode': self.mode,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+class _Flight:
+    """SingleFlightで実行中の1件の呼び出し（記録したイベントと終了状態）"""
+    
+    def __init__(self):
+        self.events = []  # ('status', 順番待ちの状況) / ('chunk', 回答の断片)
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+
+class SingleFlight:
+    """
+    同じ内容の実行中の呼び出しを1つにまとめるクラス（送信ボタンのダブルクリック対策）
+    
+    最初の呼び出しは別スレッドで上流に送り、順番待ちの状況と回答の断片を記録する。
+    実行中に同じキーの呼び出しが来た場合は上流に送らず、記録を最初から再生して続きを待つ。
+    ダブルクリックでStreamlitの再実行が起きて最初の呼び出し元が中断されても、
+    上流への呼び出しは最後まで続き、再実行後の呼び出し元に引き継がれる。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.started = 0
+        self.joined = 0
+    
+    def run(self, key: str, produce) -> tuple:
+        """
+        Args:
+            key (str): 呼び出しの内容を表すキー
+            produce: on_wait（状況の通知先）を受け取り、回答の断片を返すジェネレーター関数
+        
+        Returns:
+            tuple: (('status' | 'chunk', 内容) を順に返すイテレーター, 自分が上流に送ったかどうか)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.started += 1
+            else:
+                self.joined += 1
+        if leader:
+            threading.Thread(target=self._produce, args=(key, flight, produce), daemon=True).start()
+        return self._follow(flight), leader
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'started': self.started, 'joined': self.joined, 'in_flight': len(self._flights)}
+    
+    def _produce(self, key: str, flight: _Flight, produce):
+        def emit(kind: str, payload):
+            with flight.condition:
+                flight.events.append((kind, payload))
+                flight.condition.notify_all()
+        
+        try:
+            for chunk in produce(lambda status: emit('status', status)):
+                emit('chunk', chunk)
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+    
+    def _follow(self, flight: _Flight) -> Iterator[tuple]:
+        index = 0
+        while True:
+            with flight.condition:
+                while index >= len(flight.events) and not flight.done:
+                    flight.condition.wait()
+                events = flight.events[index:]
+                done = flight.done
+            index += len(events)
+            yield from events
+            if done:
+                if flight.error is not None:
+                    raise flight.error
+                return
@@ -0,0 +1,327 @@
+"""
+app.py のLLM呼び出しの接続と流量制御（Streamlitに依存しない）
+- 全セッションで共有するキープアライブ付きHTTPクライアント（接続プール）と、その利用状況の集計
+- 全セッションのLLM呼び出しを受け付ける順番待ちキュー（同時実行数・RPM・TPMの上限と再試行）
+"""
+
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Iterator
+
+import httpx
+import openai
+from dotenv import load_dotenv
+
+# 環境変数の読み込み（.envファイル。app.py 以外から読み込まれた場合も同じ設定を使う）
+load_dotenv()
+
+# HTTP接続プールの上限（キープアライブ接続をプロセス全体で共有する）
+POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+
+
+class ConnectionStats:
+    """
+    接続プールの利用状況を集計するクラス（全セッションで共有）
+    
+    httpxのtrace拡張でTCP接続の新規確立を検知し、
+    リクエスト数との差から接続の再利用回数を求める。
+    """
+    
+    def __init__(self, latency_window: int = 200):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self._latencies = deque(maxlen=latency_window)
+    
+    def on_request(self, request: httpx.Request):
+        """httpxのリクエストフック：リクエスト数を数え、接続イベントを追跡する"""
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._trace
+    
+    def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+    
+    def record_latency(self, seconds: float):
+        """LLM呼び出し1回分のレイテンシ（秒）を記録する"""
+        with self._lock:
+            self._latencies.append(seconds)
+    
+    def snapshot(self) -> dict:
+        """現在の集計値を返す"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            requests = self.requests
+            new_connections = self.new_connections
+        reused = max(requests - new_connections, 0)
+        return {
+            'requests': requests,
+            'new_connections': new_connections,
+            'reused_connections': reused,
+            'reuse_rate': reused / requests if requests else 0.0,
+            'p50_latency': latencies[len(latencies) // 2] if latencies else None
+        }
+
+
+class _DrainOnDoneStream(httpx.SyncByteStream):
+    """
+    SSEの [DONE] を受け取った後に閉じられた場合、残りのバイト（チャンク転送の終端）を
+    読み切ってから閉じるレスポンスボディ
+    
+    openaiのSDKは [DONE] を受け取るとすぐにレスポンスを閉じるため、終端を読み終える前の
+    接続は再利用できずに破棄されてしまう。[DONE] の後だけ読み切ることで、ストリーミングの
+    接続もプールに戻るようにする（途中で中断された場合は従来通りすぐに閉じる）。
+    """
+    
+    def __init__(self, stream: httpx.SyncByteStream):
+        self._stream = stream
+        self._iterator = None
+        self._done = False
+    
+    def __iter__(self):
+        self._iterator = iter(self._stream)
+        for chunk in self._iterator:
+            self._done = chunk.rstrip().endswith(b"[DONE]")
+            yield chunk
+    
+    def close(self):
+        if self._done and self._iterator is not None:
+            for _ in self._iterator:
+                pass
+        self._stream.close()
+
+
+class _KeepAliveTransport(httpx.BaseTransport):
+    """レスポンスボディを_DrainOnDoneStreamで包むトランスポート"""
+    
+    def __init__(self, transport: httpx.HTTPTransport):
+        self._transport = transport
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self._transport.handle_request(request)
+        response.stream = _DrainOnDoneStream(response.stream)
+        return response
+    
+    def close(self):
+        self._transport.close()
+
+
+def create_http_client(stats: ConnectionStats) -> httpx.Client:
+    """
+    キープアライブ付きのHTTPクライアントを作る（app.py ではプロセス全体で1つだけ作って共有する）
+    
+    全セッション・全キャラクターのChatOpenAIがこの接続プールを使うため、
+    2回目以降のリクエストではTLSハンドシェイクと接続確立が省略される。
+    """
+    transport = _KeepAliveTransport(httpx.HTTPTransport(
+        limits=httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY
+        )
+    ))
+    return httpx.Client(
+        transport=transport,
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        event_hooks={'request': [stats.on_request]}
+    )
+
+
+# LLM呼び出しの流量制御（OpenAIの利用ティアに合わせて設定する）
+# LLM_MAX_CONCURRENCY: 同時に実行するLLM呼び出しの上限（超えた分は順番待ち）
+# LLM_RATE_RPM / LLM_RATE_TPM: 1分あたりのリクエスト数・トークン数の上限
+# LLM_MAX_RETRIES: 429・5xx・接続エラー時の再試行回数
+DISPATCH_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+DISPATCH_RATE_RPM = float(os.getenv("LLM_RATE_RPM", "3500"))
+DISPATCH_RATE_TPM = float(os.getenv("LLM_RATE_TPM", "200000"))
+DISPATCH_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+DISPATCH_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+DISPATCH_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+
+# 回答の長さの見積もり（TPMの予約に使う）
+EXPECTED_OUTPUT_TOKENS = 800
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレート制限
+    
+    予約した分だけ残量を減らし（マイナスも許す）、補充されるまでの待ち時間を返す。
+    先に予約したリクエストから順に枠が割り当てられるため、待ちが公平になる。
+    """
+    
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def reserve(self, amount: float) -> float:
+        """amount分を予約し、実行してよいまでの待ち秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= min(amount, self.capacity)
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+def _is_retryable(error: Exception) -> bool:
+    """再試行すべきエラー（429、5xx、接続エラー・タイムアウト）か"""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class LLMDispatcher:
+    """
+    全セッションのLLM呼び出しを受け付ける共有の順番待ちキュー
+    
+    - 同時実行数を上限までに抑え、超えた分は到着順（FIFO）に待たせる
+    - RPM・TPMのトークンバケットで、利用ティアの上限を超えないように送信ペースを調整する
+    - 429・5xx・接続エラーはジッター付き指数バックオフで再試行する
+      （ストリーミングは最初の断片を受け取る前に失敗した場合のみ）
+    
+    Streamlitのセッションはそれぞれ別スレッドで動くため、スレッド間で共有する条件変数で実装している。
+    待機中はon_waitコールバックに状況（順番・レート制限・再試行）を通知する。
+    """
+    
+    def __init__(self, max_concurrency: int, rpm: float, tpm: float, max_retries: int,
+                 backoff_base: float, backoff_max: float):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._request_bucket = TokenBucket(rpm)
+        self._token_bucket = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._active = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited_waits = 0
+    
+    def stream(self, make_stream, estimated_tokens: int, on_wait=None) -> Iterator:
+        """
+        順番と流量の枠を確保してから make_stream() の要素を順に返す
+        
+        Args:
+            make_stream: 呼び出すたびに新しいイテレータを返す関数（再試行時に呼び直す）
+            estimated_tokens (int): このリクエストの見積もりトークン数（TPMの予約に使う）
+            on_wait: 待機状況の通知先 on_wait(status: dict)
+        """
+        self._enter(on_wait)
+        try:
+            attempt = 0
+            while True:
+                self._wait_for_rate(estimated_tokens, on_wait)
+                started = False
+                try:
+                    for item in make_stream():
+                        started = True
+                        yield item
+                    self._count('completed')
+                    return
+                except Exception as e:
+                    if started or not _is_retryable(e) or attempt >= self.max_retries:
+                        self._count('failed')
+                        raise
+                    delay = self._backoff_delay(attempt, e)
+                    attempt += 1
+                    self._count('retries')
+                    if on_wait:
+                        on_wait({'retry': attempt, 'delay': delay})
+                    time.sleep(delay)
+        finally:
+            self._leave()
+    
+    def call(self, fn, estimated_tokens: int, on_wait=None):
+        """ストリーミングしない呼び出し fn() を、順番と流量の枠を確保して実行する"""
+        return list(self.stream(lambda: [fn()], estimated_tokens, on_wait))[0]
+    
+    def _enter(self, on_wait):
+        ticket = object()
+        last_position = None
+        with self._cond:
+            self._waiting.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    if self._waiting[0] is ticket and self._active < self.max_concurrency:
+                        self._waiting.popleft()
+                        self._active += 1
+                        self._cond.notify_all()
+                        return
+                    position = self._waiting.index(ticket) + 1
+                if on_wait and position != last_position:
+                    on_wait({'position': position})
+                    last_position = position
+                with self._cond:
+                    self._cond.wait(timeout=0.5)
+        except BaseException:
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                self._cond.notify_all()
+            raise
+    
+    def _count(self, name: str):
+        with self._cond:
+            setattr(self, name, getattr(self, name) + 1)
+    
+    def _leave(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+    
+    def _wait_for_rate(self, estimated_tokens: int, on_wait):
+        delay = max(self._request_bucket.reserve(1), self._token_bucket.reserve(estimated_tokens))
+        if delay > 0:
+            self._count('rate_limited_waits')
+            if on_wait:
+                on_wait({'rate_wait': delay})
+            time.sleep(delay)
+    
+    def _backoff_delay(self, attempt: int, error: Exception) -> float:
+        """ジッター付き指数バックオフの待ち秒数（Retry-Afterヘッダーがあればそれ以上待つ）"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            delay = max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            pass
+        return min(delay, self.backoff_max)
+    
+    def snapshot(self) -> dict:
+        """現在の状況を返す"""
+        with self._cond:
+            return {
+                'active': self._active,
+                'waiting': len(self._waiting),
+                'completed': self.completed,
+                'failed': self.failed,
+                'retries': self.retries,
+                'rate_limited_waits': self.rate_limited_waits
+            }
+
+
+def describe_wait_status(status: dict) -> str:
+    """LLMDispatcherの待機状況を利用者向けの文に変換する"""
+    if 'position' in status:
+        return f"⏳ 混み合っています。順番をお待ちください（あなたの順番：{status['position']}番目）"
+    if 'rate_wait' in status:
+        return f"⏳ 混み合っています。約{math.ceil(status['rate_wait'])}秒後に送信します"
+    return f"🔁 応答がないため再試行しています（{status['retry']}回目、約{math.ceil(status['delay'])}秒後）"
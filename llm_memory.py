@@ -0,0 +1,103 @@
+"""
+app.py の会話メモリ（Streamlitに依存しない）
+- キャラクターごとの複数ターンの会話を、トークン予算の範囲で保持する
+- 予算を超えた古い会話は、渡された要約関数でまとめる
+"""
+
+import os
+
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+# 環境変数の読み込み（.envファイル。app.py 以外から読み込まれた場合も同じ設定を使う）
+load_dotenv()
+
+# 会話メモリの設定（キャラクターごとの複数ターンの相談）
+# LLM_MEMORY_TOKEN_BUDGET: 履歴として送る直近の会話の上限トークン数（0で会話メモリ無効）
+# LLM_MEMORY_SUMMARY_TOKENS: 古い会話をまとめた要約の上限トークン数
+MEMORY_TOKEN_BUDGET = int(os.getenv("LLM_MEMORY_TOKEN_BUDGET", "1500"))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("LLM_MEMORY_SUMMARY_TOKENS", "300"))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の概算（日本語などの非ASCII文字は1文字≒1トークン、ASCII文字は4文字≒1トークン）
+    
+    予算管理のための見積もりなので、tiktokenのような厳密な計算は行わない。
+    """
+    ascii_chars = sum(1 for c in text if c < "\x80")
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """概算トークン数が上限に収まるように末尾を切り詰める"""
+    while text and estimate_tokens(text) > max_tokens:
+        text = text[:-max(len(text) // 10, 1)]
+    return text
+
+
+class ConversationMemory:
+    """
+    1つのセッション・1人のキャラクターとの会話履歴（トークン予算つき）
+    
+    直近の会話はそのまま保持し（スライディングウィンドウ）、予算を超えた古い会話は
+    要約にまとめる。保持する会話と要約の両方に上限があるため、長時間使われ続ける
+    キオスク端末のセッションでも、送信するプロンプトとメモリ使用量は一定以内に収まる。
+    
+    Args:
+        summarizer: 要約関数 summarizer(これまでの要約, [(ユーザーの入力, 回答), ...]) -> 新しい要約
+    """
+    
+    def __init__(self, token_budget: int, summary_max_tokens: int, summarizer):
+        self.token_budget = token_budget
+        self.summary_max_tokens = summary_max_tokens
+        self.summarizer = summarizer
+        self.turns = []  # [(ユーザーの入力, 回答), ...]
+        self.summary = ""
+        self.summarized_turns = 0
+    
+    def history_messages(self) -> list:
+        """システムメッセージとユーザーの入力の間に挿入する履歴メッセージを返す"""
+        messages = []
+        if self.summary:
+            messages.append(SystemMessage(content=f"これまでの相談の要約：\n{self.summary}"))
+        for user_input, response in self.turns:
+            messages.append(HumanMessage(content=user_input))
+            messages.append(AIMessage(content=response))
+        return messages
+    
+    def add_turn(self, user_input: str, response: str):
+        """1往復分の会話を追加し、予算を超えた古い会話を要約に移す"""
+        self.turns.append((user_input, response))
+        
+        overflow = []
+        while self.turns and self.history_tokens() > self.token_budget:
+            overflow.append(self.turns.pop(0))
+        if overflow:
+            try:
+                summary = self.summarizer(self.summary, overflow)
+            except Exception as e:
+                # 要約に失敗しても古い会話は破棄する（ウィンドウの上限を優先）
+                print(f"会話の要約エラー: {e}")
+                summary = self.summary
+            self.summary = _truncate_to_tokens(summary, self.summary_max_tokens)
+            self.summarized_turns += len(overflow)
+    
+    def history_tokens(self) -> int:
+        """保持している直近の会話の概算トークン数"""
+        return sum(estimate_tokens(user) + estimate_tokens(answer) for user, answer in self.turns)
+    
+    def clear(self):
+        self.turns = []
+        self.summary = ""
+        self.summarized_turns = 0
+    
+    def stats(self) -> dict:
+        """メモリ使用状況を返す"""
+        return {
+            'turns': len(self.turns),
+            'summarized_turns': self.summarized_turns,
+            'history_tokens': self.history_tokens(),
+            'summary_tokens': estimate_tokens(self.summary),
+            'stored_chars': len(self.summary) + sum(len(user) + len(answer) for user, answer in self.turns)
+        }
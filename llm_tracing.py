@@ -0,0 +1,290 @@
+"""
+app.py のLLMリクエストの計測（Streamlitに依存しない）
+- RequestTracer：リクエストごとのフェーズ別の所要時間・トークン数を集計し、JSONLログ・Prometheus形式で出力する
+- serve_metrics：/metrics でメトリクスを公開するHTTPサーバー
+- TokenUsageStats：入力トークン（うちキャッシュ済み）と出力トークンの累計
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from dotenv import load_dotenv
+
+# 環境変数の読み込み（.envファイル。app.py 以外から読み込まれた場合も同じ設定を使う）
+load_dotenv()
+
+# リクエストのトレース（フェーズごとの所要時間・トークン数）の出力先（いずれも指定したときだけ出力する）
+# LLM_TRACE_LOG: 1リクエスト1行のJSONLログのパス
+# LLM_METRICS_FILE: Prometheus形式のメトリクスファイルのパス（node_exporterのtextfileコレクタ向け）
+# LLM_METRICS_FILE_INTERVAL: メトリクスファイルを書き出す間隔（秒。変化があったときだけ書き出す）
+# LLM_METRICS_PORT: 指定するとそのポートの /metrics でメトリクスを公開する
+# LLM_METRICS_HOST: /metrics を公開するアドレス（既定はこのマシンからだけ接続できる 127.0.0.1）
+TRACE_LOG_PATH = os.getenv("LLM_TRACE_LOG", "")
+METRICS_FILE_PATH = os.getenv("LLM_METRICS_FILE", "")
+METRICS_FILE_INTERVAL_SEC = float(os.getenv("LLM_METRICS_FILE_INTERVAL", "15"))
+METRICS_PORT = int(os.getenv("LLM_METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("LLM_METRICS_HOST", "127.0.0.1")
+
+# レイテンシのヒストグラムの区切り（秒）
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+
+# トレースで計測するフェーズ
+# prompt_build: メッセージの組み立て / queue_wait: 順番待ち・レート制限・再試行の待ち
+# first_token: 送信から最初の断片まで / generation: 最初の断片から最後の断片まで
+# render: 画面の描画 / total: 全体
+TRACE_PHASES = ("prompt_build", "queue_wait", "first_token", "generation", "render", "total")
+
+
+class RequestTracer:
+    """
+    LLMリクエストごとのトレースを集計・出力するクラス（全セッションで共有）
+    
+    start()で作ったトレース（dict）に各処理がフェーズの所要時間を書き込み、
+    finish()でJSONLログへの追記、メトリクスの集計、直近のトレースの保持を行う。
+    メトリクスファイルはリクエストごとではなく、start_metrics_writer()のスレッドが一定間隔で書き出す。
+    
+    Args:
+        model (str): トレースに記録するモデル名
+        characters (dict, optional): キャラクターのレジストリ（temperatureの記録とメトリクスのラベル（slug）に使う）
+    """
+    
+    def __init__(self, log_path: str, metrics_path: str, model: str = "", characters: Optional[dict] = None,
+                 window: int = 500):
+        self.log_path = log_path
+        self.metrics_path = metrics_path
+        self.model = model
+        self.characters = characters or {}
+        self._lock = threading.Lock()
+        self._metrics_changed = False
+        self._writer = None
+        self._recent = deque(maxlen=window)
+        self._requests = Counter()   # (character, model, status, cache) -> 件数
+        self._tokens = Counter()     # (character, 種類) -> トークン数
+        self._histograms = {}        # (character, phase) -> {'buckets': [...], 'sum': 秒, 'count': 件数}
+    
+    def start(self, character: str) -> dict:
+        """新しいトレースを作る"""
+        profile = self.characters.get(character, {})
+        return {
+            'id': uuid.uuid4().hex,
+            'timestamp': datetime.now().isoformat(timespec='milliseconds'),
+            'character': character,
+            'model': self.model,
+            'temperature': profile.get('temperature'),
+            'cache_hit': False,
+            'deduplicated': False,
+            'status': "ok",
+            'error': None,
+            'attempts': 0,
+            'phases': {},
+            'prompt_tokens': None,
+            'completion_tokens': None,
+            'cached_tokens': None,
+            '_started_at': time.perf_counter()
+        }
+    
+    def finish(self, trace: dict):
+        """トレースを確定して記録・出力する（同じトレースを2回確定しない）"""
+        started_at = trace.pop('_started_at', None)
+        if started_at is None:
+            return
+        trace['phases']['total'] = time.perf_counter() - started_at
+        # 受け取りを途中でやめた呼び出しは、SingleFlightのスレッドが後からトレースに書き込むことがあるため、
+        # 確定した時点の内容を複製して記録する
+        trace = {**trace, 'phases': trace['phases'].copy()}
+        
+        with self._lock:
+            self._recent.append(trace)
+            cache = "hit" if trace['cache_hit'] else "miss"
+            self._requests[(trace['character'], trace['model'], trace['status'], cache)] += 1
+            for kind in ("prompt", "completion", "cached"):
+                if trace[f'{kind}_tokens']:
+                    self._tokens[(trace['character'], kind)] += trace[f'{kind}_tokens']
+            for phase, seconds in trace['phases'].items():
+                histogram = self._histograms.setdefault(
+                    (trace['character'], phase),
+                    {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+                )
+                for i, upper in enumerate(LATENCY_BUCKETS):
+                    if seconds <= upper:
+                        histogram['buckets'][i] += 1
+                histogram['sum'] += seconds
+                histogram['count'] += 1
+            self._metrics_changed = True
+            
+            if self.log_path:
+                try:
+                    os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                    with open(self.log_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    # 出力に失敗しても回答には影響させない
+                    print(f"トレースの出力エラー: {e}")
+    
+    def start_metrics_writer(self, interval_sec: float):
+        """interval_sec 秒ごとにメトリクスファイルを書き出すスレッドを起動する（出力先がない・起動済みなら何もしない）"""
+        if not self.metrics_path or self._writer is not None:
+            return
+        self._writer = threading.Thread(target=self._write_loop, args=(interval_sec,), daemon=True)
+        self._writer.start()
+    
+    def _write_loop(self, interval_sec: float):
+        while True:
+            time.sleep(interval_sec)
+            self.write_metrics()
+    
+    def write_metrics(self):
+        """前回から変化があれば、メトリクスファイルを書き出す（書き込み途中の内容は読まれない）"""
+        with self._lock:
+            if not self._metrics_changed:
+                return
+            text = self._prometheus_text()
+            self._metrics_changed = False
+        try:
+            os.makedirs(os.path.dirname(self.metrics_path) or ".", exist_ok=True)
+            tmp_path = f"{self.metrics_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, self.metrics_path)
+        except OSError as e:
+            print(f"メトリクスの出力エラー: {e}")
+    
+    def recent(self) -> list:
+        """直近のトレース（古い順）"""
+        with self._lock:
+            return list(self._recent)
+    
+    def prometheus_text(self) -> str:
+        """Prometheusのテキスト形式のメトリクス"""
+        with self._lock:
+            return self._prometheus_text()
+    
+    def _prometheus_text(self) -> str:
+        def label(character: str) -> str:
+            return self.characters[character]['slug'] if character in self.characters else character
+        
+        lines = [
+            "# HELP llm_requests_total LLM requests by character, model, status and response cache result.",
+            "# TYPE llm_requests_total counter",
+        ]
+        for (character, model, status, cache), count in sorted(self._requests.items()):
+            lines.append(
+                f'llm_requests_total{{character="{label(character)}",model="{model}",'
+                f'status="{status}",cache="{cache}"}} {count}'
+            )
+        lines += [
+            "# HELP llm_tokens_total Tokens consumed by character (prompt, completion, cached prompt).",
+            "# TYPE llm_tokens_total counter",
+        ]
+        for (character, kind), count in sorted(self._tokens.items()):
+            lines.append(f'llm_tokens_total{{character="{label(character)}",type="{kind}"}} {count}')
+        lines += [
+            "# HELP llm_phase_seconds Time spent in each phase of an LLM request.",
+            "# TYPE llm_phase_seconds histogram",
+        ]
+        for (character, phase), histogram in sorted(self._histograms.items()):
+            labels = f'character="{label(character)}",phase="{phase}"'
+            for upper, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                lines.append(f'llm_phase_seconds_bucket{{{labels},le="{upper}"}} {count}')
+            lines.append(f'llm_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+            lines.append(f'llm_phase_seconds_sum{{{labels}}} {histogram["sum"]:.6f}')
+            lines.append(f'llm_phase_seconds_count{{{labels}}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(tracer: RequestTracer, host: str, port: int) -> ThreadingHTTPServer:
+    """tracer のメトリクスを http://host:port/metrics で公開するサーバーを別スレッドで起動する"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = tracer.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def record_usage(trace: dict, usage: Optional[dict]):
+    """usage_metadataのトークン数をトレースに書き込む"""
+    if not usage:
+        return
+    trace['prompt_tokens'] = usage.get('input_tokens')
+    trace['completion_tokens'] = usage.get('output_tokens')
+    trace['cached_tokens'] = (usage.get('input_token_details') or {}).get('cache_read', 0)
+
+
+def traced_request(trace: dict, send):
+    """
+    LLMDispatcherに渡す呼び出しを包み、順番待ちの時間と試行回数をトレースに記録する
+    
+    Returns:
+        function: send()を呼ぶ関数（再試行のたびに呼ばれる。最後に送った時刻を sent_at 属性に持つ）
+    """
+    queued_at = time.perf_counter()
+    
+    def request():
+        now = time.perf_counter()
+        trace['phases']['queue_wait'] = now - queued_at
+        trace['attempts'] += 1
+        request.sent_at = now
+        return send()
+    request.sent_at = None
+    return request
+
+
+class TokenUsageStats:
+    """
+    入力トークン（うちキャッシュ済み）と出力トークンの累計（全セッションで共有）
+    
+    レスポンスのusage_metadataのinput_token_details.cache_readを集計し、
+    プロンプトキャッシュがどれだけ効いているかを確認できるようにする。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_character = {}
+    
+    def record(self, character: str, usage: Optional[dict]):
+        """1回分のusage_metadataを記録する"""
+        if not usage:
+            return
+        cached = (usage.get('input_token_details') or {}).get('cache_read', 0) or 0
+        with self._lock:
+            totals = self._by_character.setdefault(
+                character, {'requests': 0, 'input_tokens': 0, 'cached_input_tokens': 0, 'output_tokens': 0}
+            )
+            totals['requests'] += 1
+            totals['input_tokens'] += usage.get('input_tokens', 0)
+            totals['cached_input_tokens'] += cached
+            totals['output_tokens'] += usage.get('output_tokens', 0)
+    
+    def snapshot(self) -> dict:
+        """キャラクターごとの累計（uncached_input_tokensとcache_rateを含む）を返す"""
+        with self._lock:
+            result = {}
+            for character, totals in self._by_character.items():
+                totals = dict(totals)
+                totals['uncached_input_tokens'] = totals['input_tokens'] - totals['cached_input_tokens']
+                totals['cache_rate'] = (
+                    totals['cached_input_tokens'] / totals['input_tokens'] if totals['input_tokens'] else 0.0
+                )
+                result[character] = totals
+            return result
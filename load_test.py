@@ -0,0 +1,178 @@
+"""
+app.py のLLM呼び出しの負荷試験（オフラインで実行可能）
+- N個のセッションを同時に動かし、app.pyと同じ経路（キャッシュ・接続プール・順番待ちキュー）で質問を送る
+- スループット、エンドツーエンドのp50/p95/p99、キャラクターごとの最初の文字までの時間（TTFT）を表示する
+
+使い方（モックサーバーを同じプロセス内で起動する場合）:
+    python load_test.py --sessions 20 --questions 5 --start-mock --ttft 0.4 --error-rate 0.05
+
+既に起動しているサーバー（mock_llm_server.py や本物のAPI）に向ける場合:
+    python load_test.py --sessions 20 --base-url http://127.0.0.1:8001/v1
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import mock_llm_server
+
+QUESTIONS = [
+    "転職を考えているのですが、どうしたらいいでしょうか？",
+    "上司とうまくいかないときはどうすればいい？",
+    "毎日の勉強を続けるコツを教えてください。",
+    "友達にお金を貸してと言われました。",
+    "1から100までの和はいくつですか？",
+]
+
+
+def percentile(values: list, p: float):
+    """最近傍順位法によるパーセンタイル（値がなければNone）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_session(app, session_index: int, args, results: list, lock: threading.Lock):
+    """1つのセッション：キャラクターを選び、questions回の質問を順に送る"""
+    rng = random.Random(session_index)
+    characters = list(app.CHARACTERS) if args.character == 'all' else [args.character]
+    memory = app.ConversationMemory(app.MEMORY_TOKEN_BUDGET, app.MEMORY_SUMMARY_TOKENS, app.summarize_conversation) if args.multi_turn else None
+
+    for turn in range(args.questions):
+        character = characters[(session_index + turn) % len(characters)]
+        question = rng.choice(QUESTIONS)
+        if not args.allow_cache:
+            # 回答キャッシュに当たらないように質問を変える
+            question = f"{question}（セッション{session_index}-{turn}）"
+        history = memory.history_messages() if memory else None
+
+        started_at = time.perf_counter()
+        ttft = None
+        text = ""
+        error = None
+        try:
+            for chunk in app.stream_llm_response(question, app.EXPERT_TYPES[character], history):
+                if ttft is None:
+                    ttft = time.perf_counter() - started_at
+                text += chunk
+            if memory:
+                memory.add_turn(question, text)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        with lock:
+            results.append({
+                'session': session_index,
+                'character': character,
+                'ttft': ttft,
+                'latency': time.perf_counter() - started_at,
+                'error': error,
+            })
+        if args.think_time:
+            time.sleep(rng.uniform(0, args.think_time))
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    """結果を集計する"""
+    succeeded = [r for r in results if r['error'] is None]
+    report = {
+        'requests': len(results),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'elapsed_sec': elapsed,
+        'throughput_rps': len(succeeded) / elapsed if elapsed else 0.0,
+        'latency': {f"p{p}": percentile([r['latency'] for r in succeeded], p) for p in (50, 95, 99)},
+        'characters': {},
+    }
+    for character in sorted({r['character'] for r in results}):
+        rows = [r for r in succeeded if r['character'] == character]
+        report['characters'][character] = {
+            'requests': len(rows),
+            'latency': {f"p{p}": percentile([r['latency'] for r in rows], p) for p in (50, 95, 99)},
+            'ttft': {f"p{p}": percentile([r['ttft'] for r in rows if r['ttft'] is not None], p) for p in (50, 95, 99)},
+        }
+    return report
+
+
+def _format_seconds(value) -> str:
+    return f"{value:.3f}s" if value is not None else "-"
+
+
+def print_report(report: dict, app):
+    print("=== 負荷試験の結果 ===")
+    print(f"リクエスト: {report['requests']}（成功 {report['succeeded']} / 失敗 {report['failed']}）")
+    print(f"所要時間: {report['elapsed_sec']:.2f}s  スループット: {report['throughput_rps']:.2f} req/s")
+    print("エンドツーエンド: " + "  ".join(f"{k}={_format_seconds(v)}" for k, v in report['latency'].items()))
+    for character, stats in report['characters'].items():
+        print(f"[{character}] {stats['requests']}件")
+        print("  エンドツーエンド: " + "  ".join(f"{k}={_format_seconds(v)}" for k, v in stats['latency'].items()))
+        print("  TTFT:             " + "  ".join(f"{k}={_format_seconds(v)}" for k, v in stats['ttft'].items()))
+    pool = app.get_connection_stats().snapshot()
+    dispatch = app.get_dispatcher().snapshot()
+    print(f"接続プール: HTTPリクエスト {pool['requests']} / 新規接続 {pool['new_connections']}"
+          f"（再利用率 {pool['reuse_rate']:.0%}）")
+    print(f"キュー: 完了 {dispatch['completed']} / 再試行 {dispatch['retries']} / 失敗 {dispatch['failed']}"
+          f" / レート制限による待機 {dispatch['rate_limited_waits']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py のLLM呼び出しの負荷試験")
+    parser.add_argument("--sessions", type=int, default=10, help="同時に動かすセッション数")
+    parser.add_argument("--questions", type=int, default=5, help="1セッションあたりの質問数")
+    parser.add_argument("--character", default="all", help="キャラクター名（テンシ / アクマ / all）")
+    parser.add_argument("--multi-turn", action="store_true", help="会話メモリを使って複数ターンの相談にする")
+    parser.add_argument("--allow-cache", action="store_true", help="同じ質問を送り、回答キャッシュを効かせる")
+    parser.add_argument("--think-time", type=float, default=0.0, help="質問の間に入れる最大待ち秒数")
+    parser.add_argument("--base-url", default=None, help="接続先（省略時は --start-mock が必要）")
+    parser.add_argument("--start-mock", action="store_true", help="モックサーバーをこのプロセス内で起動する")
+    parser.add_argument("--json", dest="json_path", default=None, help="結果をJSONで保存するパス")
+    mock_llm_server.add_config_arguments(parser)
+    args = parser.parse_args()
+
+    if args.start_mock:
+        server, base_url = mock_llm_server.start_server(**mock_llm_server.config_from_args(args))
+    elif args.base_url:
+        base_url = args.base_url
+    else:
+        parser.error("--base-url か --start-mock を指定してください")
+
+    # app.py を読み込む前に接続先を設定する（ChatOpenAIは環境変数の接続先を使う）
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "dummy")
+    import app
+    
+    # Streamlitの外で実行するため、ScriptRunContextの警告を抑える
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    if args.character != 'all' and args.character not in app.CHARACTERS:
+        parser.error(f"キャラクターは {' / '.join(app.CHARACTERS)} / all のいずれかです")
+
+    results = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=run_session, args=(app, i, args, results, lock))
+        for i in range(args.sessions)
+    ]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    report = summarize(results, elapsed)
+    print_report(report, app)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+OpenAI互換のモックLLMサーバー（オフラインでの動作確認・負荷試験用）
+- POST /v1/chat/completions（通常・ストリーミング両対応）
+- 最初の断片までの時間、断片の間隔・数、エラー注入を設定可能
+- usage（prompt_tokens_details.cached_tokens を含む）を返す
+
+使い方:
+    python mock_llm_server.py --port 8001 --ttft 0.4 --chunk-interval 0.03 --error-rate 0.05
+
+app.py をこのサーバーに向ける場合:
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=dummy streamlit run app.py
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 返答に使う文（キャラクターの口調に寄せたダミー）
+REPLY_SENTENCES = {
+    'テンシ': [
+        "あら、それは大事な相談ね。",
+        "大丈夫よ、一緒に考えましょう。",
+        "まずは今の気持ちを書き出してみてくださいね。",
+        "次に、選択肢ごとに良い点と気になる点を並べてみるの。",
+        "あなたならきっと正しい道を選べるわ。",
+    ],
+    'アクマ': [
+        "フフフ…そんなことも分からないの？",
+        "仕方ないわね、この私が教えてあげる。",
+        "まずは自分の市場価値を数字で把握しなさい。",
+        "次に、条件の良い方を冷静に選ぶのよ。",
+        "わかったわね？私の言う通りにしなさい♡",
+    ],
+}
+
+# プロンプトキャッシュの模擬：一度見たシステムメッセージは2回目以降キャッシュ済みとして数える
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+
+def _estimate_tokens(text: str) -> int:
+    """app.estimate_tokens と同じ概算（非ASCII文字は1トークン、ASCII文字は4文字で1トークン）"""
+    ascii_chars = sum(1 for c in text if c < "\x80")
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+class MockConfig:
+    """サーバーの挙動の設定"""
+
+    def __init__(self, ttft: float, chunk_interval: float, chunks: int,
+                 error_rate: float, error_status: int, retry_after: float, seed=None):
+        self.ttft = ttft
+        self.chunk_interval = chunk_interval
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.seen_prefixes = set()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+
+def _build_reply(messages: list, chunks: int) -> list:
+    """システムメッセージからキャラクターを判定し、chunks個の断片からなる返答を作る"""
+    system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+    character = 'アクマ' if 'アクマ' in system else 'テンシ'
+    sentences = REPLY_SENTENCES[character]
+    return [sentences[i % len(sentences)] for i in range(max(chunks, 1))]
+
+
+def _usage(config: MockConfig, messages: list, completion: str) -> dict:
+    system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+    prompt_tokens = sum(_estimate_tokens(m.get('content') or '') for m in messages)
+    system_tokens = _estimate_tokens(system)
+    cached = 0
+    if system_tokens >= PROMPT_CACHE_MIN_TOKENS:
+        digest = hashlib.sha256(system.encode('utf-8')).hexdigest()
+        with config.lock:
+            if digest in config.seen_prefixes:
+                # OpenAIと同様に128トークン単位でキャッシュされる
+                cached = system_tokens // 128 * 128
+            config.seen_prefixes.add(digest)
+    completion_tokens = _estimate_tokens(completion)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+        'prompt_tokens_details': {'cached_tokens': cached},
+    }
+
+
+def make_handler(config: MockConfig):
+    """設定を閉じ込めたリクエストハンドラーのクラスを作る"""
+
+    class MockHandler(BaseHTTPRequestHandler):
+        # キープアライブを有効にする（接続プールの再利用を確認できるように）
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/models'):
+                self._send_json(200, {'object': 'list', 'data': [{'id': 'mock', 'object': 'model'}]})
+            else:
+                self._send_json(404, {'error': {'message': 'not found'}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+
+            with config.lock:
+                config.requests += 1
+                inject_error = config.random.random() < config.error_rate
+                if inject_error:
+                    config.errors += 1
+            if inject_error:
+                headers = {'Retry-After': str(config.retry_after)} if config.error_status == 429 else {}
+                self._send_json(config.error_status, {
+                    'error': {'message': 'injected error', 'type': 'mock_error', 'code': config.error_status}
+                }, headers)
+                return
+
+            messages = body.get('messages', [])
+            model = body.get('model', 'mock')
+            pieces = _build_reply(messages, config.chunks)
+            time.sleep(config.ttft)
+
+            if body.get('stream'):
+                self._stream(model, messages, pieces, (body.get('stream_options') or {}).get('include_usage'))
+            else:
+                time.sleep(config.chunk_interval * (len(pieces) - 1))
+                content = ''.join(pieces)
+                self._send_json(200, {
+                    'id': f"chatcmpl-{uuid.uuid4().hex}",
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': content},
+                        'finish_reason': 'stop',
+                    }],
+                    'usage': _usage(config, messages, content),
+                })
+
+        def _stream(self, model: str, messages: list, pieces: list, include_usage: bool):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            created = int(time.time())
+
+            def event(choices, usage=None):
+                payload = {
+                    'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'created': created,
+                    'model': model,
+                    'choices': choices,
+                }
+                if usage is not None:
+                    payload['usage'] = usage
+                self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+
+            for index, piece in enumerate(pieces):
+                if index:
+                    time.sleep(config.chunk_interval)
+                delta = {'content': piece}
+                if index == 0:
+                    delta['role'] = 'assistant'
+                event([{'index': 0, 'delta': delta, 'finish_reason': None}])
+            event([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+            if include_usage:
+                event([], _usage(config, messages, ''.join(pieces)))
+            # [DONE]と終端の空チャンクは同じ書き込みで送る（本物のAPIと同様に、
+            # クライアントが[DONE]で読み終えても接続がプールに戻るようにする）
+            self._write_chunk("data: [DONE]\n\n", terminate=True)
+
+        def _write_chunk(self, text: str, terminate: bool = False):
+            data = text.encode('utf-8')
+            payload = f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n"
+            if terminate:
+                payload += b"0\r\n\r\n"
+            self.wfile.write(payload)
+            self.wfile.flush()
+
+        def _send_json(self, status: int, payload: dict, headers=None):
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+    return MockHandler
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, **config_kwargs):
+    """
+    モックサーバーをバックグラウンドスレッドで起動する（負荷試験スクリプトから利用）
+
+    Returns:
+        tuple: (サーバー, ベースURL "http://host:port/v1")
+    """
+    config = MockConfig(**config_kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    server.config = config
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/v1"
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """モックサーバーの挙動に関する引数を追加する（load_test.pyと共通）"""
+    parser.add_argument("--ttft", type=float, default=0.4, help="最初の断片を返すまでの秒数")
+    parser.add_argument("--chunk-interval", type=float, default=0.03, help="断片の間隔（秒）")
+    parser.add_argument("--chunks", type=int, default=20, help="1回の返答の断片数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラーを返す割合（0〜1）")
+    parser.add_argument("--error-status", type=int, default=429, help="注入するエラーのステータスコード")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429のRetry-Afterヘッダーの秒数")
+    parser.add_argument("--seed", type=int, default=None, help="エラー注入の乱数シード")
+
+
+def config_from_args(args) -> dict:
+    return {
+        'ttft': args.ttft,
+        'chunk_interval': args.chunk_interval,
+        'chunks': args.chunks,
+        'error_rate': args.error_rate,
+        'error_status': args.error_status,
+        'retry_after': args.retry_after,
+        'seed': args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI互換のモックLLMサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockConfig(**config_from_args(args))))
+    server.daemon_threads = True
+    print(f"モックLLMサーバーを起動しました: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+app.py の画面操作ごとの再実行コストの計測（オフラインで実行可能）
+- app.py をヘッドレスのStreamlitサーバーとして起動し、ブラウザの代わりにWebSocketで操作を送る
+- 操作（初回表示・キャラクター切り替え・送信）ごとに、スクリプトの実行時間と
+  サーバーから送られてきたデータ量（ForwardMsgのバイト数・要素数）を表示する
+- LLMはモックサーバー（mock_llm_server.py）に向ける
+
+使い方:
+    python rerun_profile.py --repeat 5
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from websockets.sync.client import connect
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+import mock_llm_server
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_server(port: int, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Streamlitサーバーが起動しませんでした")
+
+
+class StreamlitSession:
+    """WebSocketでStreamlitサーバーにつなぎ、ブラウザと同じBackMsgを送る最小限のクライアント"""
+
+    def __init__(self, port: int):
+        self.ws = connect(
+            f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"], max_size=None, legacy=True
+        )
+        self.widgets = {}    # ウィジェットのkey -> (ウィジェットID, フラグメントID)
+        self.values = {}     # ウィジェットID -> 送信する値（文字列・真偽値）
+
+    def close(self):
+        self.ws.close()
+
+    def run(self, trigger: str = None, fragment: bool = True) -> dict:
+        """
+        再実行を要求し、スクリプトが終わるまでのメッセージを集計する
+
+        Args:
+            trigger (str, optional): クリックするボタンのkey
+            fragment (bool): ボタンがフラグメント内にあればフラグメントだけを再実行する（ブラウザと同じ）
+        """
+        msg = BackMsg()
+        client_state = msg.rerun_script
+        client_state.query_string = ""
+        for widget_id, value in self.values.items():
+            state = client_state.widget_states.widgets.add()
+            state.id = widget_id
+            if isinstance(value, bool):
+                state.bool_value = value
+            else:
+                state.string_value = value
+        if trigger:
+            widget_id, fragment_id = self.widgets[trigger]
+            state = client_state.widget_states.widgets.add()
+            state.id = widget_id
+            state.trigger_value = True
+            if fragment and fragment_id:
+                client_state.fragment_id = fragment_id
+
+        started_at = time.perf_counter()
+        self.ws.send(msg.SerializeToString())
+        total_bytes = 0
+        elements = 0
+        while True:
+            data = self.ws.recv()
+            forward = ForwardMsg()
+            forward.ParseFromString(data)
+            kind = forward.WhichOneof("type")
+            if kind == "script_finished":
+                # st.rerun()で打ち切られた実行は、続く再実行が終わるまでを1回の操作として数える
+                if forward.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    break
+                continue
+            total_bytes += len(data)
+            if kind == "delta":
+                elements += 1
+                self._register_widget(forward.delta)
+        return {
+            'seconds': time.perf_counter() - started_at,
+            'bytes': total_bytes,
+            'elements': elements,
+            'fragment': bool(trigger and fragment and self.widgets[trigger][1]),
+        }
+
+    def set_value(self, key: str, value):
+        self.values[self.widgets[key][0]] = value
+
+    def _register_widget(self, delta):
+        if delta.WhichOneof("type") != "new_element":
+            return
+        element = delta.new_element
+        widget = getattr(element, element.WhichOneof("type"))
+        widget_id = getattr(widget, "id", "")
+        if widget_id and "-" in widget_id:
+            # ユーザー指定のkeyを持つウィジェットのIDは "$$ID-<ハッシュ>-<key>" の形になる
+            key = widget_id.split("-", 2)[-1]
+            self.widgets[key] = (widget_id, delta.fragment_id)
+
+
+def profile(port: int, repeat: int, question: str) -> dict:
+    """初回表示・キャラクター切り替え・送信をrepeat回ずつ行い、操作ごとの結果を集める"""
+    results = {}
+
+    def record(name: str, result: dict):
+        results.setdefault(name, []).append(result)
+
+    for _ in range(repeat):
+        session = StreamlitSession(port)
+        try:
+            record("初回表示", session.run())
+            record("キャラクター切り替え", session.run("btn_akuma"))
+            record("キャラクター切り替え", session.run("btn_tenshi"))
+            session.set_value("user_message", question)
+            record("送信", session.run("send_msg"))
+        finally:
+            session.close()
+    return {
+        name: {
+            'runs': len(rows),
+            'median_seconds': statistics.median(r['seconds'] for r in rows),
+            'median_bytes': statistics.median(r['bytes'] for r in rows),
+            'median_elements': statistics.median(r['elements'] for r in rows),
+            'fragment_rerun': all(r['fragment'] for r in rows),
+        }
+        for name, rows in results.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py の画面操作ごとの再実行コストの計測")
+    parser.add_argument("--app", default="app.py", help="計測するStreamlitアプリ")
+    parser.add_argument("--repeat", type=int, default=5, help="各操作を繰り返す回数")
+    parser.add_argument("--question", default="転職を考えているのですが、どうしたらいいでしょうか？")
+    parser.add_argument("--json", dest="json_path", default=None, help="結果をJSONで保存するパス")
+    mock_llm_server.add_config_arguments(parser)
+    parser.set_defaults(ttft=0.05, chunk_interval=0.0)
+    args = parser.parse_args()
+
+    _, base_url = mock_llm_server.start_server(**mock_llm_server.config_from_args(args))
+    port = _free_port()
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=base_url,
+        OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "dummy"),
+        LLM_CACHE_MODE="off",
+        LLM_TRACE_LOG="",
+        LLM_METRICS_FILE="",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", args.app,
+         "--server.headless", "true", "--server.port", str(port),
+         "--server.enableXsrfProtection", "false", "--browser.gatherUsageStats", "false"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_for_server(port)
+        # 画像の縮小などの初回のみの処理を計測から外す
+        StreamlitSession(port).run()
+        report = profile(port, args.repeat, args.question)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print("=== 操作ごとの再実行コスト（中央値） ===")
+    for name, stats in report.items():
+        scope = "フラグメント" if stats['fragment_rerun'] else "ページ全体"
+        print(f"{name}（{scope}）: 実行 {stats['median_seconds'] * 1000:.0f}ms ／ "
+              f"送信 {stats['median_bytes'] / 1024:.1f}KB ／ 要素 {stats['median_elements']:.0f}個")
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,14 +6,16 @@
 """
 
 import streamlit as st
-import math
 import time
-import json
 import os
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import uuid
 
+from taxi_dispatch import AVERAGE_SPEED_KMH, Dispatcher
+from taxi_geo import MatchingIndex, haversine_km
+from taxi_storage import CachedStorage, DriverBusy, RequestArchive, TransitionRejected, open_storage
+
 # ページ設定
 st.set_page_config(
     page_title="takutakutaxi",
@@ -22,138 +24,209 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# データファイルのパス
+# データの保存先
 # ⚠️ Streamlit Cloudでは、ファイルシステムへの書き込みは一時的です
-# 本番環境では、データベース（SQLite、PostgreSQL、Firebase等）の使用を推奨します
+# 本番環境では、サーバー上のデータベース（PostgreSQL、Firebase等）の使用を推奨します
+# TAXI_STORAGE=sqlite（標準）: taxi_data/taxi.db に保存し、状態の変更は1行の更新で行う
+# TAXI_STORAGE=eventlog: taxi_data/events/ に変更をイベントとして追記する
+# TAXI_STORAGE=json: 従来どおり taxi_data/*.json に保存する
 DATA_DIR = "taxi_data"
-REQUESTS_FILE = os.path.join(DATA_DIR, "requests.json")
-DRIVERS_FILE = os.path.join(DATA_DIR, "drivers.json")
-FACILITIES_FILE = os.path.join(DATA_DIR, "facilities.json")
-
-# データディレクトリの作成
-os.makedirs(DATA_DIR, exist_ok=True)
-
-
-def load_requests() -> Dict:
-    """JSONファイルからリクエストを読み込む"""
-    if os.path.exists(REQUESTS_FILE):
-        try:
-            with open(REQUESTS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # datetime文字列をdatetimeオブジェクトに変換
-                for req_id, req_data in data.items():
-                    if 'created_at' in req_data and isinstance(req_data['created_at'], str):
-                        req_data['created_at'] = datetime.fromisoformat(req_data['created_at'])
-                    if 'assigned_at' in req_data and req_data['assigned_at'] and isinstance(req_data['assigned_at'], str):
-                        req_data['assigned_at'] = datetime.fromisoformat(req_data['assigned_at'])
-                    if 'arrived_at' in req_data and req_data['arrived_at'] and isinstance(req_data['arrived_at'], str):
-                        req_data['arrived_at'] = datetime.fromisoformat(req_data['arrived_at'])
-                    if 'departed_at' in req_data and req_data['departed_at'] and isinstance(req_data['departed_at'], str):
-                        req_data['departed_at'] = datetime.fromisoformat(req_data['departed_at'])
-                    if 'completed_at' in req_data and req_data['completed_at'] and isinstance(req_data['completed_at'], str):
-                        req_data['completed_at'] = datetime.fromisoformat(req_data['completed_at'])
-                return data
-        except json.JSONDecodeError:
-            # JSONファイルが壊れている場合は空の辞書を返す
-            return {}
-        except Exception as e:
-            # エラーはログに記録するが、UIには表示しない（初期化時は表示できないため）
-            print(f"データ読み込みエラー: {e}")
-            return {}
-    return {}
+STORAGE_BACKEND = os.getenv("TAXI_STORAGE", "sqlite")
+
+# 完了したリクエストの保持期間
+# 完了から RETENTION_HOURS 時間が過ぎたリクエストは taxi_data/archive/ の完了日ごとのファイルに移す
+# （ARCHIVE_INTERVAL_SEC 秒に1回、いずれかの画面の再実行のついでに確認する）
+RETENTION_HOURS = float(os.getenv("TAXI_RETENTION_HOURS", "24"))
+ARCHIVE_INTERVAL_SEC = float(os.getenv("TAXI_ARCHIVE_INTERVAL", "600"))
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+
+# ドライバー端末に表示する待機中リクエストの件数（近い順）
+PENDING_LIST_LIMIT = int(os.getenv("TAXI_PENDING_LIST_LIMIT", "50"))
+
+# 自動配車（TAXI_AUTO_DISPATCH=1 で有効）
+# DISPATCH_INTERVAL_SEC 秒ごとに、待機中のリクエストと空いているドライバーをまとめて割り当てる
+# 到着予定が DISPATCH_MAX_PICKUP_MIN 分を超える組み合わせは割り当てず、
+# DISPATCH_MAX_WAIT_MIN 分以上待っているリクエストを最優先にする
+AUTO_DISPATCH = os.getenv("TAXI_AUTO_DISPATCH", "0") == "1"
+DISPATCH_INTERVAL_SEC = float(os.getenv("TAXI_DISPATCH_INTERVAL", "5"))
+DISPATCH_MAX_PICKUP_MIN = float(os.getenv("TAXI_DISPATCH_MAX_PICKUP_MIN", "30"))
+DISPATCH_MAX_WAIT_MIN = float(os.getenv("TAXI_DISPATCH_MAX_WAIT_MIN", "10"))
+
+# 自動更新で変更を確認する間隔（秒）
+# 保存先の版番号を確認し、表示中の画面に関係するデータが変わったときだけ再実行する（ページの再読み込みはしない）
+LIVE_POLL_SEC = float(os.getenv("TAXI_LIVE_POLL_SEC", "0.5"))
+
+
+@st.cache_resource
+def get_storage():
+    """
+    保存先（全セッションで共有。初回はJSONファイルの内容をSQLiteに取り込む）
+    リクエスト・ドライバーの読み込みは、保存先が変更されたときだけ読み直すキャッシュを通す
+    （返るレコードは読み取り専用。書き換える場合はコピーしてから変更する）
+    """
+    return CachedStorage(open_storage(DATA_DIR, STORAGE_BACKEND))
+
+
+@st.cache_resource
+def get_archive():
+    """完了したリクエストのアーカイブ（全セッションで共有）"""
+    return RequestArchive(ARCHIVE_DIR)
+
+
+@st.cache_resource
+def get_matching_index():
+    """待機中リクエスト・稼働可能ドライバーの空間インデックス（全セッションで共有）"""
+    return MatchingIndex()
+
+
+@st.cache_resource
+def get_dispatcher():
+    """自動配車（全セッションで共有。DISPATCH_INTERVAL_SEC 秒ごとに割り当てるスレッドを起動する）"""
+    dispatcher = Dispatcher(
+        get_storage(),
+        max_pickup_min=DISPATCH_MAX_PICKUP_MIN,
+        max_wait_min=DISPATCH_MAX_WAIT_MIN,
+    )
+    dispatcher.start(DISPATCH_INTERVAL_SEC)
+    return dispatcher
+
+
+def run_retention():
+    """保持期間を過ぎた完了済みリクエストをアーカイブに移す（ARCHIVE_INTERVAL_SEC 秒に1回だけ）"""
+    archive = get_archive()
+    if RETENTION_HOURS < 0 or time.time() - archive.last_run < ARCHIVE_INTERVAL_SEC:
+        return
+    try:
+        archive.archive(get_storage(), timedelta(hours=RETENTION_HOURS))
+    except Exception as e:
+        print(f"アーカイブエラー: {e}")
+
+
+def load_requests(status=None, facility_id: Optional[str] = None,
+                  assigned_driver: Optional[str] = None) -> Dict:
+    """
+    リクエストを読み込む（条件を指定すると、合うものだけを読み込む）
+
+    Args:
+        status: 状態（'pending'など）または状態のリスト
+        facility_id (str, optional): 施設ID
+        assigned_driver (str, optional): 担当ドライバーID
+    """
+    try:
+        return get_storage().load_requests(status, facility_id, assigned_driver)
+    except Exception as e:
+        # エラーはログに記録するが、UIには表示しない（初期化時は表示できないため）
+        print(f"データ読み込みエラー: {e}")
+        return {}
 
 
 def save_requests(requests: Dict):
-    """リクエストをJSONファイルに保存"""
+    """リクエストを全件保存（渡した内容で置き換える）"""
     try:
-        # datetimeオブジェクトを文字列に変換
-        data_to_save = {}
-        for req_id, req_data in requests.items():
-            req_copy = req_data.copy()
-            if 'created_at' in req_copy and req_copy['created_at']:
-                if isinstance(req_copy['created_at'], datetime):
-                    req_copy['created_at'] = req_copy['created_at'].isoformat()
-            if 'assigned_at' in req_copy and req_copy['assigned_at']:
-                if isinstance(req_copy['assigned_at'], datetime):
-                    req_copy['assigned_at'] = req_copy['assigned_at'].isoformat()
-            if 'arrived_at' in req_copy and req_copy['arrived_at']:
-                if isinstance(req_copy['arrived_at'], datetime):
-                    req_copy['arrived_at'] = req_copy['arrived_at'].isoformat()
-            if 'departed_at' in req_copy and req_copy['departed_at']:
-                if isinstance(req_copy['departed_at'], datetime):
-                    req_copy['departed_at'] = req_copy['departed_at'].isoformat()
-            if 'completed_at' in req_copy and req_copy['completed_at']:
-                if isinstance(req_copy['completed_at'], datetime):
-                    req_copy['completed_at'] = req_copy['completed_at'].isoformat()
-            data_to_save[req_id] = req_copy
-        
-        with open(REQUESTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+        get_storage().save_requests(requests)
+    except Exception as e:
+        st.error(f"データ保存エラー: {e}")
+
+
+def add_request(request: Dict) -> bool:
+    """リクエストを1件追加"""
+    try:
+        get_storage().add_request(request)
+        return True
     except Exception as e:
         st.error(f"データ保存エラー: {e}")
+        return False
+
+
+def transition_request(request_id: str, from_status: str, to_status: str, fields: Dict,
+                       require_idle_driver: Optional[str] = None) -> Dict:
+    """
+    リクエストの状態を変更する（確認と更新を1回の操作で行う）
+
+    Args:
+        require_idle_driver: 指定すると、このドライバーが他のリクエストを担当中でないことも同じ操作で確認する
+
+    Returns:
+        dict: 変更後のリクエスト
+
+    Raises:
+        DriverBusy: require_idle_driver のドライバーが他のリクエストを担当中だった（自動配車が先に割り当てた）
+        TransitionRejected: 状態がfrom_statusでなかった（他の端末が先に変更した）
+    """
+    return get_storage().transition(request_id, from_status, to_status, fields,
+                                    require_idle_driver=require_idle_driver)
 
 
 def load_drivers() -> Dict:
-    """JSONファイルからドライバー情報を読み込む"""
-    if os.path.exists(DRIVERS_FILE):
-        try:
-            with open(DRIVERS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # datetime文字列をdatetimeオブジェクトに変換
-                for driver_id, driver_data in data.items():
-                    if 'updated_at' in driver_data and isinstance(driver_data['updated_at'], str):
-                        driver_data['updated_at'] = datetime.fromisoformat(driver_data['updated_at'])
-                return data
-        except json.JSONDecodeError:
-            # JSONファイルが壊れている場合は空の辞書を返す
-            return {}
-        except Exception as e:
-            # エラーはログに記録するが、UIには表示しない（初期化時は表示できないため）
-            print(f"データ読み込みエラー: {e}")
-            return {}
-    return {}
+    """ドライバー情報を読み込む"""
+    try:
+        return get_storage().load_drivers()
+    except Exception as e:
+        print(f"データ読み込みエラー: {e}")
+        return {}
 
 
 def save_drivers(drivers: Dict):
-    """ドライバー情報をJSONファイルに保存"""
+    """ドライバー情報を全件保存"""
     try:
-        # datetimeオブジェクトを文字列に変換
-        data_to_save = {}
-        for driver_id, driver_data in drivers.items():
-            driver_copy = driver_data.copy()
-            if 'updated_at' in driver_copy:
-                driver_copy['updated_at'] = driver_copy['updated_at'].isoformat()
-            data_to_save[driver_id] = driver_copy
-        
-        with open(DRIVERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+        get_storage().save_drivers(drivers)
+    except Exception as e:
+        st.error(f"データ保存エラー: {e}")
+
+
+def put_driver(driver: Dict) -> bool:
+    """ドライバー1人分の情報を保存"""
+    try:
+        get_storage().put_driver(driver)
+        return True
+    except Exception as e:
+        st.error(f"データ保存エラー: {e}")
+        return False
+
+
+def update_driver(driver_id: str, fields: Dict) -> bool:
+    """ドライバー1人分の項目を更新"""
+    try:
+        return get_storage().update_driver(driver_id, fields)
     except Exception as e:
         st.error(f"データ保存エラー: {e}")
+        return False
 
 
 def load_facilities() -> Dict:
-    """JSONファイルから施設情報を読み込む"""
-    if os.path.exists(FACILITIES_FILE):
-        try:
-            with open(FACILITIES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-        except Exception as e:
-            print(f"施設データ読み込みエラー: {e}")
-            return {}
-    return {}
+    """施設情報を読み込む"""
+    try:
+        return get_storage().load_facilities()
+    except Exception as e:
+        print(f"施設データ読み込みエラー: {e}")
+        return {}
 
 
 def save_facilities(facilities: Dict):
-    """施設情報をJSONファイルに保存"""
+    """施設情報を保存"""
     try:
-        with open(FACILITIES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(facilities, f, ensure_ascii=False, indent=2)
+        get_storage().save_facilities(facilities)
     except Exception as e:
         st.error(f"施設データ保存エラー: {e}")
 
 
+def flash(message: str, kind: str = "success"):
+    """
+    次の再実行で表示するメッセージを登録する（st.rerun() の直前に呼ぶ。表示のために待たなくてよい）
+    kind: success・info はトースト、warning・error はページの上部に表示する
+    """
+    st.session_state.setdefault('flash_messages', []).append((kind, message))
+
+
+def show_flash():
+    """flash() で登録したメッセージを表示して消す"""
+    for kind, message in st.session_state.pop('flash_messages', []):
+        if kind in ("success", "info"):
+            st.toast(message)
+        else:
+            getattr(st, kind)(message)
+
+
 # セッション状態の初期化（ファイルから読み込み）
 if 'requests' not in st.session_state:
     st.session_state.requests = load_requests()
@@ -168,7 +241,7 @@ if 'last_update' not in st.session_state:
     st.session_state.last_update = time.time()
 
 if 'auto_refresh_enabled' not in st.session_state:
-    st.session_state.auto_refresh_enabled = False
+    st.session_state.auto_refresh_enabled = True
 
 if 'driver_has_active_request' not in st.session_state:
     st.session_state.driver_has_active_request = False
@@ -179,17 +252,7 @@ def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     2点間の距離を計算（ハーバーサイン公式）
     戻り値: キロメートル
     """
-    R = 6371  # 地球の半径（km）
-    
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    
-    a = (math.sin(dlat / 2) ** 2 +
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-         math.sin(dlon / 2) ** 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    
-    return R * c
+    return haversine_km(lat1, lon1, lat2, lon2)
 
 
 def estimate_arrival_time(distance_km: float) -> int:
@@ -197,30 +260,84 @@ def estimate_arrival_time(distance_km: float) -> int:
     距離から到着時間を推定（分）
     平均速度: 30km/h（市街地想定）
     """
-    speed_kmh = 30
-    time_hours = distance_km / speed_kmh
+    time_hours = distance_km / AVERAGE_SPEED_KMH
     return int(time_hours * 60)
 
 
 def find_nearest_drivers(request_lat: float, request_lon: float, 
-                        available_drivers: Dict) -> List[tuple]:
+                        available_drivers: Optional[Dict] = None, k: Optional[int] = None,
+                        max_km: Optional[float] = None) -> List[tuple]:
     """
-    利用可能なドライバーを距離順にソート
-    戻り値: [(ドライバーID, 距離, ドライバー情報), ...]
+    利用可能なドライバーを距離順に取得（空間インデックスで近くのドライバーだけを調べる）
+    available_drivers を省略すると保存先の全ドライバーから探す
+    戻り値: [(ドライバーID, 距離, ドライバー情報), ...]（k件まで・max_km以内）
     """
-    driver_distances = []
-    
-    for driver_id, driver_info in available_drivers.items():
-        if driver_info.get('status') == 'available':
-            distance = calculate_distance(
-                request_lat, request_lon,
-                driver_info['lat'], driver_info['lon']
-            )
-            driver_distances.append((driver_id, distance, driver_info))
-    
-    # 距離でソート
-    driver_distances.sort(key=lambda x: x[1])
-    return driver_distances
+    if available_drivers is None:
+        available_drivers = get_storage().records('drivers')
+    index = get_matching_index()
+    index.sync_drivers(available_drivers)
+    return [
+        (driver_id, distance, available_drivers[driver_id])
+        for driver_id, distance in index.nearest_drivers(request_lat, request_lon, k, max_km)
+    ]
+
+
+def live_signature(page: str) -> tuple:
+    """
+    画面に表示している内容に関係するデータの要約（変わったときだけ再実行するための比較に使う）
+    - フロント端末: 自分の施設の進行中のリクエスト（状態・ドライバー・到着予定）
+    - ドライバー端末: 待機中のリクエストの一覧と、このドライバーの状態・担当中のリクエスト
+    """
+    requests = get_storage().records('requests')
+    if page == "フロント端末":
+        facility_id = st.session_state.get('current_facility_id')
+        return tuple(sorted(
+            (req_id, r.get('status'), r.get('driver_name'), r.get('car_number'), r.get('estimated_arrival'))
+            for req_id, r in requests.items()
+            if r.get('status') in ['pending', 'assigned', 'arrived']
+            and (not facility_id or r.get('facility_id') == facility_id)
+        ))
+    driver_id = st.session_state.get('previous_driver_id')
+    driver = get_storage().records('drivers').get(driver_id)
+    return (
+        tuple(sorted(req_id for req_id, r in requests.items() if r.get('status') == 'pending')),
+        tuple(sorted((req_id, r.get('status')) for req_id, r in requests.items()
+                     if r.get('assigned_driver') == driver_id)),
+        (driver.get('status'), driver.get('lat'), driver.get('lon')) if driver else None,
+    )
+
+
+def remember_live_state(page: str):
+    """
+    ページ全体の実行の最初に、これから表示する内容の基準（版番号と画面に関係するデータの要約）を記録する
+    ページ全体の実行は最新のデータで描画するので、その実行の中では変更の比較はしない
+    """
+    storage = get_storage()
+    st.session_state.live_versions = (storage.data_version('requests'), storage.data_version('drivers'))
+    st.session_state.live_signature = live_signature(page)
+    st.session_state.live_full_run = True
+
+
+@st.fragment(run_every=LIVE_POLL_SEC)
+def live_updates(page: str):
+    """
+    変更の確認（LIVE_POLL_SEC 秒ごとにこの部分だけが再実行される）
+    保存先の版番号が remember_live_state() で記録したものから変わっていれば画面に関係するデータを比べ、
+    違っていたときだけページ全体を再実行する（自分の操作による保存は、操作後の再実行で記録し直される）
+    """
+    if st.session_state.pop('live_full_run', False):
+        # ページ全体の実行の中で呼ばれた（基準は記録済み）
+        return
+    storage = get_storage()
+    versions = (storage.data_version('requests'), storage.data_version('drivers'))
+    if versions == st.session_state.get('live_versions'):
+        return
+    signature = live_signature(page)
+    st.session_state.live_versions = versions
+    if signature != st.session_state.get('live_signature'):
+        st.session_state.live_signature = signature
+        st.session_state.last_update = time.time()
+        st.rerun(scope="app")
 
 
 def frontend_page():
@@ -409,7 +526,7 @@ def frontend_page():
             
             col3, col4 = st.columns(2)
             with col3:
-                if st.button("💾 施設を登録・更新", use_container_width=True):
+                if st.button("💾 施設を登録・更新", use_container_width=True, key="save_facility_button"):
                     if facility_id_input and facility_name_input:
                         if 'facilities' not in st.session_state:
                             st.session_state.facilities = {}
@@ -423,8 +540,7 @@ def frontend_page():
                         # 登録と同時に自動選択
                         st.session_state.current_facility_id = facility_id_input
                         st.session_state.current_facility_name = facility_name_input
-                        st.success(f"✅ 施設「{facility_name_input}」を登録しました。この端末で使用中です。")
-                        time.sleep(0.5)
+                        flash(f"✅ 施設「{facility_name_input}」を登録しました。この端末で使用中です。")
                         st.rerun()
                     else:
                         st.error("施設IDと施設名を入力してください")
@@ -436,8 +552,7 @@ def frontend_page():
                         save_facilities(st.session_state.facilities)
                         st.session_state.current_facility_id = None
                         st.session_state.current_facility_name = None
-                        st.success(f"✅ 施設を削除しました")
-                        time.sleep(0.5)
+                        flash("✅ 施設を削除しました")
                         st.rerun()
                     else:
                         st.error("削除する施設がありません")
@@ -556,10 +671,8 @@ def frontend_page():
             }
             
             st.session_state.requests[request_id] = request_data
-            save_requests(st.session_state.requests)  # ファイルに保存
-            st.markdown('</div>', unsafe_allow_html=True)
-            st.markdown('<div class="taxi-success">✅ リクエストを送信しました！<br>ドライバーを探しています...</div>', unsafe_allow_html=True)
-            time.sleep(0.5)
+            add_request(request_data)  # 1件だけ追加で保存
+            flash("✅ リクエストを送信しました！ドライバーを探しています...")
             st.rerun()
         
         st.markdown('</div>', unsafe_allow_html=True)
@@ -576,8 +689,7 @@ def frontend_page():
                     if latest_requests:
                         st.session_state.requests = latest_requests.copy()
                     st.session_state.last_update = time.time()
-                    st.success("✅ 最新状況を更新しました")
-                    time.sleep(0.5)
+                    flash("✅ 最新状況を更新しました")
                     st.rerun()
                 except Exception as e:
                     st.error(f"更新エラー: {e}")
@@ -614,6 +726,10 @@ def frontend_page():
         if active_requests:
             st.markdown('<div class="taxi-status-card">', unsafe_allow_html=True)
             st.markdown("### 📋 現在のリクエスト状況")
+            if current_facility_id:
+                # この施設の状態別の件数（全セッションで共有する集計から読む）
+                counts = get_storage().aggregates().facility_counts(current_facility_id)
+                st.caption(f"待機中 {counts['pending']}件 ／ 向かっています {counts['assigned']}件 ／ 到着済み {counts['arrived']}件")
             st.markdown('<div style="text-align: center;">', unsafe_allow_html=True)
             
             # リクエストを古い順に表示
@@ -668,6 +784,32 @@ def frontend_page():
             st.markdown("### 📋 現在のリクエスト状況")
             st.info("現在、アクティブなリクエストはありません")
             st.markdown('</div>', unsafe_allow_html=True)
+        
+        # 過去の送迎履歴（保持期間を過ぎてアーカイブに移したもの）
+        with st.expander("📚 過去の送迎履歴"):
+            # アーカイブは保持期間を過ぎてから作られるので、アーカイブがある日付だけを新しい順に選べるようにする
+            archive_dates = get_archive().dates()[::-1]
+            if not archive_dates:
+                st.caption(f"アーカイブされた送迎はまだありません（完了から{RETENTION_HOURS:g}時間後にここへ移ります）")
+                archived = None
+            else:
+                archive_date = st.selectbox(
+                    "完了日", archive_dates, format_func=lambda day: day.strftime('%Y/%m/%d'), key="archive_date"
+                )
+                archived = get_archive().query(archive_date, facility_id=current_facility_id)
+            if archived:
+                st.dataframe([
+                    {
+                        'リクエスト時刻': r['created_at'].strftime('%H:%M:%S') if r.get('created_at') else '',
+                        '完了時刻': r['completed_at'].strftime('%H:%M:%S') if r.get('completed_at') else '',
+                        '施設': r.get('facility_name', ''),
+                        'ドライバー': r.get('driver_name', ''),
+                        '車番': r.get('car_number', ''),
+                    }
+                    for r in archived.values()
+                ], hide_index=True, use_container_width=True)
+            elif archived is not None:
+                st.caption("この日にアーカイブされた、この施設の送迎はありません")
     except Exception as e:
         st.error(f"エラーが発生しました: {e}")
         st.exception(e)
@@ -711,13 +853,11 @@ def driver_page():
         
         previous_driver_id = st.session_state.previous_driver_id
         
+        # 件数の集計（ドライバーごとの担当中のリクエストの数を、全件を見ずに確認する）
+        stats = get_storage().aggregates()
+        
         # 前回のIDでassigned、arrived、departed状態のリクエストがあるか確認（完了まで変更不可）
-        has_active_assignment_previous = False
-        if previous_driver_id:
-            for rid, rinfo in st.session_state.requests.items():
-                if rinfo.get('assigned_driver') == previous_driver_id and rinfo.get('status') in ['assigned', 'arrived', 'departed']:
-                    has_active_assignment_previous = True
-                    break
+        has_active_assignment_previous = bool(previous_driver_id) and stats.active_requests(previous_driver_id) > 0
         
         driver_id = st.text_input(
             "ドライバーID",
@@ -747,14 +887,6 @@ def driver_page():
         # 現在のドライバー情報を取得
         current_driver = st.session_state.drivers.get(driver_id) if driver_id else None
         
-        # このドライバーにassigned、arrived、departed状態のリクエストがあるか確認（完了まで変更不可）
-        has_active_assignment = False
-        if driver_id:
-            for rid, rinfo in st.session_state.requests.items():
-                if rinfo.get('assigned_driver') == driver_id and rinfo.get('status') in ['assigned', 'arrived', 'departed']:
-                    has_active_assignment = True
-                    break
-        
         # ドライバー情報の設定（折りたたみ可能、コンパクト）
         with st.expander("👤 ドライバー情報設定", expanded=False):
             col1, col2, col3 = st.columns(3)
@@ -795,7 +927,7 @@ def driver_page():
             
             with col6:
                 st.write("")  # スペーサー
-                if st.button("💾 更新", type="primary"):
+                if st.button("💾 更新", type="primary", key="save_driver_button"):
                     if not driver_id:
                         st.error("ドライバーIDを入力してください")
                     elif not car_number:
@@ -809,7 +941,7 @@ def driver_page():
                             if did not in st.session_state.drivers:
                                 st.session_state.drivers[did] = dinfo
                         
-                        # このドライバーの情報のみを更新
+                        # このドライバーの情報のみを更新（1行だけ保存）
                         st.session_state.drivers[driver_id] = {
                             'id': driver_id,
                             'name': driver_name,
@@ -819,9 +951,8 @@ def driver_page():
                             'status': status,
                             'updated_at': datetime.now()
                         }
-                        save_drivers(st.session_state.drivers)
-                        st.success(f"✅ ドライバーID: {driver_id}の情報を更新しました")
-                        time.sleep(0.5)
+                        put_driver(st.session_state.drivers[driver_id])
+                        flash(f"✅ ドライバーID: {driver_id}の情報を更新しました")
                         st.rerun()
         
         st.markdown("---")
@@ -831,8 +962,9 @@ def driver_page():
         st.session_state.requests = latest_requests
         
         # このドライバーに割り当てられたassigned、arrived、departed状態のリクエストを取得（完了まで保持）
+        # （担当中のリクエストがないドライバーは、集計だけで判断して全件を見ない）
         my_active_assignment = None
-        if driver_id:
+        if driver_id and stats.active_requests(driver_id):
             for rid, rinfo in st.session_state.requests.items():
                 if rinfo.get('assigned_driver') == driver_id and rinfo.get('status') in ['assigned', 'arrived', 'departed']:
                     my_active_assignment = (rid, rinfo)
@@ -890,34 +1022,19 @@ def driver_page():
                 ):
                     # 到着ボタン（assigned状態の時のみ有効）
                     try:
-                        latest_requests = load_requests()
-                        target_request = latest_requests.get(request_id)
-                        
-                        if target_request and target_request.get('status') == 'assigned':
-                            # 最新のデータを更新（コピーを作成）
-                            target_request = target_request.copy()
-                            target_request['status'] = 'arrived'
-                            target_request['arrived_at'] = datetime.now()
-                            latest_requests[request_id] = target_request
-                            
-                            # セッション状態を完全に更新
-                            st.session_state.requests = latest_requests.copy()
-                            
-                            # ファイルに保存
-                            save_requests(st.session_state.requests)
-                            
-                            st.success("✅ 到着を記録しました")
-                            time.sleep(0.5)
-                            st.rerun()
-                        else:
-                            st.error("⚠️ リクエストが見つからないか、既に処理済みです。")
-                            st.session_state.requests = load_requests()
-                            time.sleep(1)
-                            st.rerun()
+                        # 状態の確認と更新を1回の操作で行う（assignedでなければ更新せずに断る）
+                        st.session_state.requests[request_id] = transition_request(
+                            request_id, 'assigned', 'arrived', {'arrived_at': datetime.now()}
+                        )
+                        flash("✅ 到着を記録しました")
+                        st.rerun()
+                    except TransitionRejected:
+                        flash("⚠️ リクエストが見つからないか、既に処理済みです。", "error")
+                        st.session_state.requests = load_requests()
+                        st.rerun()
                     except Exception as e:
-                        st.error(f"エラーが発生しました: {e}")
+                        flash(f"エラーが発生しました: {e}", "error")
                         st.session_state.requests = load_requests()
-                        time.sleep(1)
                         st.rerun()
             
             with col2:
@@ -930,34 +1047,19 @@ def driver_page():
                 ):
                     # 出発ボタン（arrived状態の時のみ有効）
                     try:
-                        latest_requests = load_requests()
-                        target_request = latest_requests.get(request_id)
-                        
-                        if target_request and target_request.get('status') == 'arrived':
-                            # 最新のデータを更新（コピーを作成）
-                            target_request = target_request.copy()
-                            target_request['status'] = 'departed'
-                            target_request['departed_at'] = datetime.now()
-                            latest_requests[request_id] = target_request
-                            
-                            # セッション状態を完全に更新
-                            st.session_state.requests = latest_requests.copy()
-                            
-                            # ファイルに保存
-                            save_requests(st.session_state.requests)
-                            
-                            st.success("✅ 出発を記録しました")
-                            time.sleep(0.5)
-                            st.rerun()
-                        else:
-                            st.error("⚠️ リクエストが見つからないか、到着ボタンが押されていません。")
-                            st.session_state.requests = load_requests()
-                            time.sleep(1)
-                            st.rerun()
+                        # 状態の確認と更新を1回の操作で行う（arrivedでなければ更新せずに断る）
+                        st.session_state.requests[request_id] = transition_request(
+                            request_id, 'arrived', 'departed', {'departed_at': datetime.now()}
+                        )
+                        flash("✅ 出発を記録しました")
+                        st.rerun()
+                    except TransitionRejected:
+                        flash("⚠️ リクエストが見つからないか、到着ボタンが押されていません。", "error")
+                        st.session_state.requests = load_requests()
+                        st.rerun()
                     except Exception as e:
-                        st.error(f"エラーが発生しました: {e}")
+                        flash(f"エラーが発生しました: {e}", "error")
                         st.session_state.requests = load_requests()
-                        time.sleep(1)
                         st.rerun()
             
             with col3:
@@ -970,47 +1072,30 @@ def driver_page():
                 ):
                     # 完了ボタン（departed状態の時のみ有効）
                     try:
-                        latest_requests = load_requests()
-                        latest_drivers = load_drivers()
-                        target_request = latest_requests.get(request_id)
+                        # 状態の確認と更新を1回の操作で行う（departedでなければ更新せずに断る）
+                        st.session_state.requests[request_id] = transition_request(
+                            request_id, 'departed', 'completed', {'completed_at': datetime.now()}
+                        )
                         
-                        if target_request and target_request.get('status') == 'departed':
-                            # 最新のデータを更新（コピーを作成）
-                            target_request = target_request.copy()
-                            target_request['status'] = 'completed'
-                            target_request['completed_at'] = datetime.now()
-                            latest_requests[request_id] = target_request
-                            
-                            # ドライバーのステータスをavailableに更新（完了後は稼働可能に戻す）
-                            if driver_id in latest_drivers:
-                                latest_drivers[driver_id] = latest_drivers[driver_id].copy()
-                                latest_drivers[driver_id]['status'] = 'available'  # 完了後は稼働可能に戻す
-                            
-                            # セッション状態を完全に更新
-                            st.session_state.requests = latest_requests.copy()
-                            st.session_state.drivers = latest_drivers.copy()
-                            
-                            # ファイルに保存
-                            save_requests(st.session_state.requests)
-                            save_drivers(st.session_state.drivers)
-                            
-                            # 完了後はリクエスト処理が終了したので、手動更新と自動更新を有効化
-                            st.session_state.driver_has_active_request = False
-                            
-                            st.success("✅ 送迎完了として記録しました")
-                            time.sleep(1)
-                            st.rerun()
-                        else:
-                            st.error("⚠️ リクエストが見つからないか、出発ボタンが押されていません。")
-                            st.session_state.requests = load_requests()
-                            st.session_state.drivers = load_drivers()
-                            time.sleep(1)
-                            st.rerun()
+                        # ドライバーのステータスをavailableに更新（完了後は稼働可能に戻す）
+                        if update_driver(driver_id, {'status': 'available'}):
+                            if driver_id in st.session_state.drivers:
+                                st.session_state.drivers[driver_id] = {**st.session_state.drivers[driver_id], 'status': 'available'}
+                        
+                        # 完了後はリクエスト処理が終了したので、手動更新と自動更新を有効化
+                        st.session_state.driver_has_active_request = False
+                        
+                        flash("✅ 送迎完了として記録しました")
+                        st.rerun()
+                    except TransitionRejected:
+                        flash("⚠️ リクエストが見つからないか、出発ボタンが押されていません。", "error")
+                        st.session_state.requests = load_requests()
+                        st.session_state.drivers = load_drivers()
+                        st.rerun()
                     except Exception as e:
-                        st.error(f"エラーが発生しました: {e}")
+                        flash(f"エラーが発生しました: {e}", "error")
                         st.session_state.requests = load_requests()
                         st.session_state.drivers = load_drivers()
-                        time.sleep(1)
                         st.rerun()
             
             # 状態に応じたメッセージ表示
@@ -1030,32 +1115,32 @@ def driver_page():
             # 待機中のリクエスト一覧（available状態のドライバーのみ表示可能）
             if current_driver and current_driver.get('status') == 'available':
                 st.markdown("### 📋 待機中のリクエスト")
+                if AUTO_DISPATCH:
+                    st.caption("🤖 自動配車が有効です。近くのリクエストは自動で割り当てられます（一覧から選んで受けることもできます）")
                 
                 # 待機中のリクエストを取得（複数のリクエストを同時に管理）
                 # 最新のデータを読み込んで、statusが'pending'のものだけを取得（他のドライバーが受諾済みのものは除外）
                 st.session_state.requests = load_requests()  # 最新状態を取得
-                pending_requests = {
-                    rid: rinfo for rid, rinfo in st.session_state.requests.items()
-                    if rinfo.get('status') == 'pending'
-                }
+                # 待機中のリクエストの空間インデックスを最新状態に合わせる（変更がなければ何もしない）
+                all_requests = get_storage().records('requests')
+                matching_index = get_matching_index()
+                matching_index.sync_requests(all_requests)
+                pending_count = len(matching_index.requests)
                 
-                if not pending_requests:
+                if not pending_count:
                     st.info("現在、待機中のリクエストはありません")
                 else:
-                    st.info(f"📊 現在、{len(pending_requests)}件のリクエストが待機中です")
+                    st.info(f"📊 現在、{pending_count}件のリクエストが待機中です")
                     
-                    # 各リクエストまでの距離を計算してソート
-                    request_distances = []
-                    
-                    for req_id, req_data in pending_requests.items():
-                        distance = calculate_distance(
-                            current_driver['lat'], current_driver['lon'],
-                            req_data['front_lat'], req_data['front_lon']
+                    # 近い順にPENDING_LIST_LIMIT件だけを取得（全件の距離計算・ソートはしない）
+                    request_distances = [
+                        (req_id, distance, all_requests[req_id])
+                        for req_id, distance in matching_index.nearest_requests(
+                            current_driver['lat'], current_driver['lon'], k=PENDING_LIST_LIMIT
                         )
-                        request_distances.append((req_id, distance, req_data))
-                    
-                    # 距離でソート（近い順）
-                    request_distances.sort(key=lambda x: x[1])
+                    ]
+                    if pending_count > len(request_distances):
+                        st.caption(f"近い順に{len(request_distances)}件を表示しています")
                     
                     # リクエスト選択用のセレクトボックス
                     if request_distances:
@@ -1103,51 +1188,38 @@ def driver_page():
                             distance = selected_distance
                             estimated_minutes = estimate_arrival_time(distance)
                             
-                            # 二重受諾防止：最新データを再取得して、まだpending状態か確認
-                            latest_requests = load_requests()
-                            target_request = latest_requests.get(req_id)
-                            
-                            if target_request and target_request.get('status') == 'pending':
-                                # リクエストを割り当て（このドライバーに割り当て）
-                                target_request['status'] = 'assigned'
-                                target_request['assigned_driver'] = driver_id
-                                target_request['driver_name'] = current_driver.get('name', '')  # ドライバー名を保存
-                                target_request['car_number'] = current_driver['car_number']
-                                target_request['estimated_arrival'] = estimated_minutes + 3
-                                target_request['assigned_at'] = datetime.now()
-                                target_request['arrived_at'] = None  # 到着時刻を初期化
-                                target_request['departed_at'] = None  # 出発時刻を初期化
-                                
-                                # ドライバーのステータスはavailableのまま維持（リクエスト処理中でも稼働可能としてカウント）
-                                # 必要に応じて手動でbusyに変更可能
-                                # current_driver['status'] = 'busy'  # コメントアウト：リクエスト処理中でもavailableとしてカウント
-                                st.session_state.drivers[driver_id] = current_driver
-                                
-                                # 最新のデータを更新
-                                st.session_state.requests = latest_requests
-                                st.session_state.requests[req_id] = target_request
-                                
-                                # ファイルに保存
-                                save_requests(st.session_state.requests)
-                                save_drivers(st.session_state.drivers)
-                                
-                                st.success(f"✅ リクエストを受諾しました！\n車番: {current_driver['car_number']}\n到着予定: {estimated_minutes + 3}分後")
-                                time.sleep(1)
+                            # 二重受諾防止：pendingのときだけ割り当てる（確認と更新を1回の操作で行うため、
+                            # 同時に押した場合も受諾できるのは1人だけで、残りはすぐに断られる）
+                            # 画面の表示後に自動配車で割り当てられていた場合も、同じ操作の中で確認して断る
+                            try:
+                                st.session_state.requests[req_id] = transition_request(req_id, 'pending', 'assigned', {
+                                    'assigned_driver': driver_id,
+                                    'driver_name': current_driver.get('name', ''),  # ドライバー名を保存
+                                    'car_number': current_driver['car_number'],
+                                    'estimated_arrival': estimated_minutes + 3,
+                                    'assigned_at': datetime.now(),
+                                    'arrived_at': None,  # 到着時刻を初期化
+                                    'departed_at': None  # 出発時刻を初期化
+                                }, require_idle_driver=driver_id)
+                            except DriverBusy:
+                                flash("⚠️ 既に担当中のリクエストがあります（自動配車で割り当てられました）。画面を確認してください。", "error")
                                 st.rerun()
-                            else:
-                                st.error("⚠️ このリクエストは既に他のドライバーが受諾済みです。")
-                                time.sleep(1)
+                            except TransitionRejected:
+                                flash("⚠️ このリクエストは既に他のドライバーが受諾済みです。", "error")
                                 st.rerun()
+                            
+                            # ドライバーのステータスはavailableのまま維持（リクエスト処理中でも稼働可能としてカウント）
+                            # 必要に応じて手動でbusyに変更可能
+                            # current_driver['status'] = 'busy'  # コメントアウト：リクエスト処理中でもavailableとしてカウント
+                            st.session_state.drivers[driver_id] = current_driver
+                            
+                            flash(f"✅ リクエストを受諾しました！ 車番: {current_driver['car_number']} ／ 到着予定: {estimated_minutes + 3}分後")
+                            st.rerun()
             else:
                 if current_driver:
                     st.warning("⚠️ ステータスを「available」に設定してください")
                 else:
                     st.info("💡 ドライバー情報を設定してください")
-        
-        # 自動更新の制御（このドライバーにリクエストがある場合は無効化）
-        if my_active_assignment:
-            # リクエストがある場合、自動更新を無効化（完了まで）
-            st.session_state.auto_refresh_enabled = False
     
     except Exception as e:
         st.error(f"エラーが発生しました: {e}")
@@ -1165,83 +1237,40 @@ def main():
     st.sidebar.markdown("---")
     st.sidebar.markdown("### 📊 システム状況")
     
-    # システム状況を表示（ファイルから直接読み込んで確実に表示）
+    # 保持期間を過ぎた完了済みリクエストをアーカイブに移す
+    run_retention()
+    
+    # 自動配車（初回の実行で割り当てのスレッドが起動する）
+    dispatcher = get_dispatcher() if AUTO_DISPATCH else None
+    
+    # システム状況を表示（保存先が変わったときだけ更新される件数の集計を読むだけで、全件は数え直さない）
     try:
-        sidebar_requests = load_requests()
-        sidebar_drivers = load_drivers()
-        st.sidebar.write(f"**リクエスト数:** {len(sidebar_requests)}")
+        stats = get_storage().aggregates()
+        st.sidebar.write(f"**リクエスト数:** {stats.requests_total}")
         
         # 稼働可能状態（available）のドライバーのみをカウント（busyは休憩中なので除外）
         # リクエスト処理中（assigned, arrived, departed状態）でもavailableならカウント
-        available_drivers_count = sum(1 for d in sidebar_drivers.values() 
-                                      if d.get('status') == 'available')
+        st.sidebar.write(f"**稼働可能ドライバー数:** {stats.drivers_by_status['available']}")
+        # 稼働中ドライバー数 = リクエスト処理中（assigned, arrived, departed状態）のavailableのドライバー数
+        st.sidebar.write(f"**稼働中ドライバー数:** {stats.busy_available_drivers}")
         
-        # 稼働中ドライバー数 = リクエスト処理中（assigned, arrived, departed状態）のドライバー数
-        active_driver_ids = set()
-        for r in sidebar_requests.values():
-            status = r.get('status')
-            if status in ['assigned', 'arrived', 'departed']:
-                driver_id = r.get('assigned_driver')
-                if driver_id:
-                    active_driver_ids.add(driver_id)
-        
-        # リクエスト処理中のドライバーのみをカウント（busy状態は除外）
-        active_drivers_count = sum(1 for driver_id in active_driver_ids 
-                                   if driver_id in sidebar_drivers 
-                                   and sidebar_drivers[driver_id].get('status') == 'available')
-        
-        st.sidebar.write(f"**稼働可能ドライバー数:** {available_drivers_count}")
-        st.sidebar.write(f"**稼働中ドライバー数:** {active_drivers_count}")
-        
-        pending_count = sum(1 for r in sidebar_requests.values() 
-                           if r.get('status') == 'pending')
-        assigned_count = sum(1 for r in sidebar_requests.values() 
-                            if r.get('status') == 'assigned')
-        st.sidebar.write(f"**待機中リクエスト:** {pending_count}")
-        st.sidebar.write(f"**割り当て済みリクエスト:** {assigned_count}")
+        st.sidebar.write(f"**待機中リクエスト:** {stats.requests_by_status['pending']}")
+        st.sidebar.write(f"**割り当て済みリクエスト:** {stats.requests_by_status['assigned']}")
     except Exception as e:
         st.sidebar.error(f"システム状況の取得エラー: {e}")
-        # エラー時は最新データを再読み込み
-        try:
-            sidebar_requests = load_requests()
-            sidebar_drivers = load_drivers()
-            st.sidebar.write(f"**リクエスト数:** {len(sidebar_requests)}")
-            
-            # 稼働可能状態（available）のドライバーのみをカウント（busyは休憩中なので除外）
-            available_drivers_count = sum(1 for d in sidebar_drivers.values() 
-                                          if d.get('status') == 'available')
-            
-            # 稼働中ドライバー数 = リクエスト処理中（assigned, arrived, departed状態）のドライバー数
-            active_driver_ids = set()
-            for r in sidebar_requests.values():
-                status = r.get('status')
-                if status in ['assigned', 'arrived', 'departed']:
-                    driver_id = r.get('assigned_driver')
-                    if driver_id:
-                        active_driver_ids.add(driver_id)
-            
-            # リクエスト処理中のドライバーのみをカウント（busy状態は除外）
-            active_drivers_count = sum(1 for driver_id in active_driver_ids 
-                                       if driver_id in sidebar_drivers 
-                                       and sidebar_drivers[driver_id].get('status') == 'available')
-            
-            st.sidebar.write(f"**稼働可能ドライバー数:** {available_drivers_count}")
-            st.sidebar.write(f"**稼働中ドライバー数:** {active_drivers_count}")
-            
-            pending_count = sum(1 for r in sidebar_requests.values() 
-                               if r.get('status') == 'pending')
-            assigned_count = sum(1 for r in sidebar_requests.values() 
-                                if r.get('status') == 'assigned')
-            st.sidebar.write(f"**待機中リクエスト:** {pending_count}")
-            st.sidebar.write(f"**割り当て済みリクエスト:** {assigned_count}")
-            
-            # セッション状態も更新
-            st.session_state.requests = sidebar_requests
-            st.session_state.drivers = sidebar_drivers
-        except Exception as e2:
-            st.sidebar.error(f"リカバリも失敗: {e2}")
-            st.sidebar.write(f"**リクエスト数:** {len(st.session_state.requests)}")
-            st.sidebar.write(f"**ドライバー数:** {len(st.session_state.drivers)}")
+        st.sidebar.write(f"**リクエスト数:** {len(st.session_state.requests)}")
+        st.sidebar.write(f"**ドライバー数:** {len(st.session_state.drivers)}")
+    
+    # 自動配車の実績（割り当て件数と、平均の到着予定時間・割り当てまでの待ち時間）
+    if dispatcher is not None:
+        summary = dispatcher.summary()
+        if summary['assigned']:
+            st.sidebar.caption(
+                f"🤖 自動配車: {summary['assigned']}件 ／ 平均到着予定 {summary['mean_eta_min']:.1f}分 ／ "
+                f"平均待ち {summary['mean_wait_min']:.1f}分"
+            )
+        else:
+            st.sidebar.caption("🤖 自動配車: 有効（まだ割り当てはありません）")
     
     st.sidebar.markdown("---")
     
@@ -1265,21 +1294,18 @@ def main():
         st.session_state.requests = load_requests()
         # ドライバー情報は現在のセッション状態を完全に保持（上書きしない）
         st.session_state.last_update = time.time()
-        st.sidebar.success("リクエスト情報を更新しました（ドライバー情報は保持されています）")
+        flash("リクエスト情報を更新しました（ドライバー情報は保持されています）")
         st.rerun()
     
-    # 自動更新の設定（リクエスト受諾後は無効化）
+    # 自動更新の設定（ページを再読み込みしないため、リクエスト処理中も入力中の内容は失われない）
     st.sidebar.markdown("### ⚙️ 更新設定")
-    auto_refresh_disabled = (page == "ドライバー端末" and driver_has_active_request)
     auto_refresh = st.sidebar.checkbox(
-        "🔄 自動更新（30秒間隔）", 
-        value=st.session_state.auto_refresh_enabled,
-        disabled=auto_refresh_disabled
+        "🔄 自動更新（変更があったときだけ）", 
+        value=st.session_state.auto_refresh_enabled
     )
-    if not auto_refresh_disabled:
-        st.session_state.auto_refresh_enabled = auto_refresh
+    st.session_state.auto_refresh_enabled = auto_refresh
     if auto_refresh:
-        st.sidebar.caption("💡 自動更新はリソースを消費します。必要時のみONにしてください")
+        st.sidebar.caption(f"💡 {LIVE_POLL_SEC:g}秒ごとに変更を確認し、この画面に関係する変更があったときだけ表示を更新します")
     
     # デバッグ用：全リクエストをクリア（フロント端末側のみ表示）
     if page == "フロント端末":
@@ -1287,11 +1313,15 @@ def main():
             st.session_state.requests = {}
             save_requests({})  # ファイルもクリア
             st.session_state.last_update = time.time()
-            if 'last_auto_refresh' in st.session_state:
-                st.session_state.last_auto_refresh = time.time()
-            st.success("リクエストをクリアしました")
+            flash("リクエストをクリアしました")
             st.rerun()
     
+    # 自動更新の比較の基準を記録（この実行で表示する内容）
+    remember_live_state(page)
+    
+    # 前回の操作の結果（flash() で登録したメッセージ）を表示
+    show_flash()
+    
     # ページに応じて表示
     try:
         if page == "フロント端末":
@@ -1302,46 +1332,9 @@ def main():
         st.error(f"エラーが発生しました: {e}")
         st.exception(e)
     
-    # 自動更新の処理（ページ表示後に実行）
+    # 自動更新（ページ表示後に、変更の確認だけを定期的に行う）
     if st.session_state.auto_refresh_enabled:
-        # 自動更新が有効な場合、定期的にデータを再読み込み
-        current_time = time.time()
-        
-        # 初回または前回の更新時刻を初期化
-        if 'last_auto_refresh' not in st.session_state:
-            st.session_state.last_auto_refresh = current_time
-        
-        time_since_last_refresh = current_time - st.session_state.last_auto_refresh
-        
-        # 30秒以上経過した場合に更新
-        if time_since_last_refresh >= 30:
-            # 最新データを読み込んでセッション状態を更新
-            try:
-                latest_requests = load_requests()
-                latest_drivers = load_drivers()
-                if latest_requests:
-                    st.session_state.requests = latest_requests.copy()
-                if latest_drivers:
-                    st.session_state.drivers = latest_drivers.copy()
-                st.session_state.last_auto_refresh = current_time
-                st.session_state.last_update = current_time
-                # 自動更新の場合は即座に再実行
-                st.rerun()
-            except Exception as e:
-                st.error(f"自動更新エラー: {e}")
-        else:
-            # 30秒経過していない場合、JavaScriptで自動リロードを設定
-            remaining_time = 30 - time_since_last_refresh
-            st.markdown(
-                f"""
-                <script>
-                    setTimeout(function() {{
-                        window.location.reload();
-                    }}, {int(remaining_time * 1000)});
-                </script>
-                """,
-                unsafe_allow_html=True
-            )
+        live_updates(page)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+"""
+タクシー配車アプリ（taxi_app.py）の自動配車
+- 待機中のリクエストと空いているドライバーをまとめて、到着予定時間の合計が最小になる組み合わせで割り当てる
+  （ハンガリアン法。SciPyを使わずNumPyで解く）
+- 待ち時間の長いリクエスト・長く空いているドライバーを優先し、遠すぎる組み合わせは割り当てない
+- 割り当ては手動の受諾と同じく、状態の変更（pending → assigned）として保存する
+"""
+
+import math
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from taxi_geo import distance_matrix
+from taxi_storage import ACTIVE_STATUSES, TransitionRejected
+
+# 到着予定時間の計算に使う平均速度（km/h。市街地想定）
+AVERAGE_SPEED_KMH = 30
+# 画面に表示する到着予定に足す時間（分。乗車準備など）
+PICKUP_MARGIN_MIN = 3
+
+
+def solve_assignment(cost) -> List[Tuple[int, int]]:
+    """
+    割り当て問題を解く（ハンガリアン法。行・列の数が異なってもよい）
+
+    Args:
+        cost: m行n列のコスト行列
+
+    Returns:
+        list: コストの合計が最小になる (行, 列) の組。min(m, n) 組で、行の順に並ぶ
+    """
+    cost = np.asarray(cost, dtype=float)
+    if cost.size == 0:
+        return []
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    # 行・列の番号は1から（0は番兵）。row_of[j] は列jに割り当てた行（0は未割り当て）
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        row_of[0] = i
+        j0 = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = row_of[j0]
+            free = ~used[1:]
+            slack = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = j0
+            candidates = np.where(free, min_slack[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            used_columns = np.flatnonzero(used)
+            u[row_of[used_columns]] += delta
+            v[used_columns] -= delta
+            min_slack[1:][free] -= delta
+            j0 = j1
+            if row_of[j0] == 0:
+                break
+        # 見つけた増加路に沿って割り当てを付け替える
+        while j0:
+            j1 = way[j0]
+            row_of[j0] = row_of[j1]
+            j0 = j1
+    pairs = [(int(row_of[j]) - 1, j - 1) for j in range(1, m + 1) if row_of[j]]
+    if transposed:
+        pairs = [(col, row) for row, col in pairs]
+    return sorted(pairs)
+
+
+def eta_minutes(distance_km):
+    """距離（km。配列も可）から到着までの時間（分）"""
+    return np.asarray(distance_km) / AVERAGE_SPEED_KMH * 60
+
+
+def _minutes_since(moment, now: datetime) -> float:
+    if not isinstance(moment, datetime):
+        return 0.0
+    return max(0.0, (now - moment).total_seconds() / 60)
+
+
+class Dispatcher:
+    """
+    待機中のリクエストを空いているドライバーにまとめて割り当てる
+
+    コストは「到着予定時間（分）」から、リクエストの待ち時間とドライバーの空き時間に応じた分を引いたもの。
+    待ち時間は行ごと・空き時間は列ごとに一定なので、どのリクエストとどのドライバーを組むかは
+    到着予定時間の合計だけで決まり、待ち時間・空き時間は「誰を先に割り当てるか」だけに効く。
+    - リクエストが多いとき: 待ち時間が長いものほど先に割り当てる（max_wait_min を超えたものは最優先）
+    - ドライバーが多いとき: 空いている時間が長いドライバーほど先に割り当てる（偏りを抑える）
+    到着予定が max_pickup_min を超える組み合わせは割り当てない。
+    """
+
+    def __init__(self, storage, max_pickup_min: float = 30, max_wait_min: float = 10,
+                 wait_weight: float = 0.5, idle_weight: float = 0.1, max_idle_min: float = 30,
+                 batch_limit: int = 200):
+        self.storage = storage
+        self.max_pickup_min = max_pickup_min
+        self.max_wait_min = max_wait_min
+        self.wait_weight = wait_weight
+        self.idle_weight = idle_weight
+        self.max_idle_min = max_idle_min
+        self.batch_limit = batch_limit
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_run = 0.0
+        self.stats = {'runs': 0, 'assigned': 0, 'eta_total_min': 0.0, 'wait_total_min': 0.0}
+
+    def candidates(self, now: datetime) -> Tuple[List[Dict], List[Dict], np.ndarray]:
+        """
+        割り当ての対象（待ちの長い順のリクエスト、担当中でない稼働可能なドライバー、各ドライバーの空き時間（分））
+        ドライバーは受諾後も available のままなので、担当中のリクエストがあるかで空いているかを判断する
+        """
+        requests = self.storage.records('requests')
+        busy = {r.get('assigned_driver') for r in requests.values() if r.get('status') in ACTIVE_STATUSES}
+        pending = sorted(
+            (r for r in requests.values()
+             if r.get('status') == 'pending' and r.get('front_lat') is not None and r.get('front_lon') is not None),
+            key=lambda r: r.get('created_at') or now
+        )[:self.batch_limit]
+        drivers = [
+            d for driver_id, d in self.storage.records('drivers').items()
+            if d.get('status') == 'available' and driver_id not in busy
+            and d.get('lat') is not None and d.get('lon') is not None
+        ]
+        return pending, drivers, self._idle_minutes(requests, drivers, now)
+
+    def _idle_minutes(self, requests: Dict, drivers: List[Dict], now: datetime) -> np.ndarray:
+        """ドライバーが空いている時間（分）。最後の完了時刻か、情報の更新時刻から数える"""
+        last_completed = {}
+        for r in requests.values():
+            completed_at = r.get('completed_at')
+            if isinstance(completed_at, datetime):
+                driver_id = r.get('assigned_driver')
+                if completed_at > last_completed.get(driver_id, datetime.min):
+                    last_completed[driver_id] = completed_at
+        idle = []
+        for d in drivers:
+            since = last_completed.get(d['id'])
+            if since is None or (isinstance(d.get('updated_at'), datetime) and d['updated_at'] > since):
+                since = d.get('updated_at')
+            idle.append(_minutes_since(since, now) if since is not None else self.max_idle_min)
+        return np.array(idle)
+
+    def plan(self, pending: List[Dict], drivers: List[Dict], idle_min: np.ndarray,
+             now: datetime) -> List[Tuple[Dict, Dict, float]]:
+        """
+        割り当てを決める（保存はしない）
+
+        Args:
+            pending: 待機中のリクエスト（front_lat・front_lon・created_at を使う）
+            drivers: 空いているドライバー（lat・lon を使う）
+            idle_min: 各ドライバーの空き時間（分）
+
+        Returns:
+            list: [(リクエスト, ドライバー, 到着予定時間（分）), ...]
+        """
+        if not pending or not drivers:
+            return []
+        eta = eta_minutes(distance_matrix(
+            [r['front_lat'] for r in pending], [r['front_lon'] for r in pending],
+            [d['lat'] for d in drivers], [d['lon'] for d in drivers],
+        ))
+        wait = np.array([_minutes_since(r.get('created_at'), now) for r in pending])
+        # 最大待ち時間を超えたリクエストには、到着予定の差では覆らない優先度を付ける
+        request_priority = self.wait_weight * wait + np.where(wait >= self.max_wait_min, 2 * self.max_pickup_min, 0)
+        cost = eta - request_priority[:, None] - self.idle_weight * np.minimum(idle_min, self.max_idle_min)[None, :]
+        # 遠すぎる組み合わせは、どの割り当て可能な組よりも大きいコストにして、使われたら捨てる
+        feasible = eta <= self.max_pickup_min
+        if not feasible.any():
+            return []
+        span = cost[feasible].max() - cost[feasible].min() + 1
+        cost = np.where(feasible, cost, cost[feasible].max() + span * (min(cost.shape) + 1))
+        return [
+            (pending[row], drivers[col], float(eta[row, col]))
+            for row, col in solve_assignment(cost) if feasible[row, col]
+        ]
+
+    def run_once(self, now: Optional[datetime] = None) -> List[Tuple[Dict, Dict, float]]:
+        """
+        1回分の割り当てを決めて保存する
+
+        Returns:
+            list: 保存できた割り当て [(変更後のリクエスト, ドライバー, 到着予定時間（分）), ...]
+        """
+        with self._lock:
+            now = now or datetime.now()
+            self.last_run = time.time()
+            done = []
+            for request, driver, eta in self.plan(*self.candidates(now), now):
+                try:
+                    # 計画を立てた後に手動で別のリクエストを受諾したドライバーには割り当てない
+                    # （担当中でないことの確認は、状態の変更と同じ1回の操作で行う）
+                    updated = self.storage.transition(request['id'], 'pending', 'assigned', {
+                        'assigned_driver': driver['id'],
+                        'driver_name': driver.get('name', ''),
+                        'car_number': driver.get('car_number'),
+                        'estimated_arrival': int(eta) + PICKUP_MARGIN_MIN,
+                        'assigned_at': now,
+                        'arrived_at': None,
+                        'departed_at': None,
+                        'dispatched_by': 'auto',
+                    }, require_idle_driver=driver['id'])
+                except TransitionRejected:
+                    # 他のドライバーが先に受諾した、またはこのドライバーが別のリクエストを受諾した（DriverBusy）
+                    continue
+                done.append((updated, driver, eta))
+                self.stats['assigned'] += 1
+                self.stats['eta_total_min'] += eta
+                self.stats['wait_total_min'] += _minutes_since(request.get('created_at'), now)
+            self.stats['runs'] += 1
+            return done
+
+    def start(self, interval_sec: float):
+        """interval_sec 秒ごとに割り当てを行うスレッドを起動する（起動済みなら何もしない）"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval_sec,), daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval_sec: float):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"自動配車エラー: {e}")
+            time.sleep(interval_sec)
+
+    def summary(self) -> Dict:
+        """これまでの割り当て件数と、平均の到着予定時間・割り当てまでの待ち時間（分）"""
+        assigned = self.stats['assigned']
+        return {
+            'runs': self.stats['runs'],
+            'assigned': assigned,
+            'mean_eta_min': self.stats['eta_total_min'] / assigned if assigned else math.nan,
+            'mean_wait_min': self.stats['wait_total_min'] / assigned if assigned else math.nan,
+        }
@@ -0,0 +1,346 @@
+"""
+タクシー配車アプリ（taxi_app.py）の位置計算
+- 2点間の距離（ハーバーサイン公式）。NumPyで多数の点への距離・距離行列をまとめて計算する版もある
+- 位置の空間インデックス（緯度・経度の格子。geohashと同様に近くの点を同じマスにまとめる）
+  k件の近傍検索と半径内の検索ができ、位置・状態の変わったものだけを更新する
+"""
+
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+# 緯度1度あたりの距離（km）
+KM_PER_DEG_LAT = math.pi * EARTH_RADIUS_KM / 180
+# 格子の1マスの大きさ（度）。0.01度は南北約1.1km・東京付近の東西約0.9km
+GRID_CELL_DEG = 0.01
+# これより少ない点への距離は、NumPyを使わずに1点ずつ計算する（配列を作る手間の方が大きいため）
+VECTOR_MIN_POINTS = 16
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """2点間の距離（km）"""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (math.sin(dlat / 2) ** 2 +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(dlon / 2) ** 2)
+    return EARTH_RADIUS_KM * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def haversine_vector(lat: float, lon: float, lat_rad: np.ndarray, lon_rad: np.ndarray,
+                     cos_lat: np.ndarray) -> np.ndarray:
+    """
+    1地点から多数の地点への距離（km）をまとめて計算する
+
+    Args:
+        lat, lon: 基準の地点（度）
+        lat_rad, lon_rad, cos_lat: 相手の地点の緯度・経度（ラジアン）と緯度のcos（事前に計算した配列）
+    """
+    q_lat = math.radians(lat)
+    q_lon = math.radians(lon)
+    a = (np.sin((lat_rad - q_lat) / 2) ** 2 +
+         math.cos(q_lat) * cos_lat * np.sin((lon_rad - q_lon) / 2) ** 2)
+    return EARTH_RADIUS_KM * 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def distance_matrix(lat_a, lon_a, lat_b, lon_b) -> np.ndarray:
+    """
+    地点の集まりAとBのすべての組み合わせの距離（km）
+
+    Args:
+        lat_a, lon_a: Aの緯度・経度（度）の配列（長さm）
+        lat_b, lon_b: Bの緯度・経度（度）の配列（長さn）
+
+    Returns:
+        np.ndarray: m行n列の距離行列
+    """
+    lat_a = np.radians(np.asarray(lat_a, dtype=float))[:, None]
+    lon_a = np.radians(np.asarray(lon_a, dtype=float))[:, None]
+    lat_b = np.radians(np.asarray(lat_b, dtype=float))[None, :]
+    lon_b = np.radians(np.asarray(lon_b, dtype=float))[None, :]
+    a = (np.sin((lat_b - lat_a) / 2) ** 2 +
+         np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2)
+    return EARTH_RADIUS_KM * 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class PointArray:
+    """
+    点の座標を、緯度・経度のラジアンと緯度のcosを計算済みの配列で持つ
+    （距離を求めるたびに同じ点のradians・cosを計算し直さない）
+
+    追加・移動・削除は1点ずつ行え、削除は末尾の点を空いた位置に移して詰める。
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.ids = []
+        self._slots = {}    # ID -> 配列上の位置
+        self.lat_rad = np.empty(capacity)
+        self.lon_rad = np.empty(capacity)
+        self.cos_lat = np.empty(capacity)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def upsert(self, item_id, lat: float, lon: float):
+        slot = self._slots.get(item_id)
+        if slot is None:
+            slot = len(self.ids)
+            if slot == len(self.lat_rad):
+                for name in ('lat_rad', 'lon_rad', 'cos_lat'):
+                    grown = np.empty(len(self.lat_rad) * 2)
+                    grown[:slot] = getattr(self, name)[:slot]
+                    setattr(self, name, grown)
+            self._slots[item_id] = slot
+            self.ids.append(item_id)
+        lat_rad = math.radians(lat)
+        self.lat_rad[slot] = lat_rad
+        self.lon_rad[slot] = math.radians(lon)
+        self.cos_lat[slot] = math.cos(lat_rad)
+
+    def remove(self, item_id):
+        slot = self._slots.pop(item_id, None)
+        if slot is None:
+            return
+        last = len(self.ids) - 1
+        if slot != last:
+            moved = self.ids[last]
+            self.ids[slot] = moved
+            self._slots[moved] = slot
+            for array in (self.lat_rad, self.lon_rad, self.cos_lat):
+                array[slot] = array[last]
+        self.ids.pop()
+
+    def distances(self, lat: float, lon: float, ids=None) -> np.ndarray:
+        """
+        基準の地点からの距離（km）
+
+        Args:
+            ids: 対象の点のID（省略時は全点。結果は self.ids の順）
+        """
+        if ids is None:
+            n = len(self.ids)
+            return haversine_vector(lat, lon, self.lat_rad[:n], self.lon_rad[:n], self.cos_lat[:n])
+        slots = [self._slots[item_id] for item_id in ids]
+        if len(slots) < VECTOR_MIN_POINTS:
+            q_lat = math.radians(lat)
+            q_lon = math.radians(lon)
+            q_cos = math.cos(q_lat)
+            lat_rad, lon_rad, cos_lat = self.lat_rad, self.lon_rad, self.cos_lat
+            result = []
+            for slot in slots:
+                a = (math.sin((lat_rad[slot] - q_lat) / 2) ** 2 +
+                     q_cos * cos_lat[slot] * math.sin((lon_rad[slot] - q_lon) / 2) ** 2)
+                result.append(EARTH_RADIUS_KM * 2 * math.asin(math.sqrt(min(1.0, a))))
+            return np.array(result)
+        slots = np.array(slots)
+        return haversine_vector(lat, lon, self.lat_rad[slots], self.lon_rad[slots], self.cos_lat[slots])
+
+
+class SpatialIndex:
+    """
+    緯度・経度の格子による空間インデックス
+
+    点はcell_deg度四方のマスに分けて持つ。検索は問い合わせ地点のマスから外側へ1周ずつ広げ、
+    まだ見ていないマスの点がそれ以上近くなりえなくなったところで打ち切る。
+    そのため検索の手間は、全体の点の数ではなく近くにある点の数で決まる。
+    距離はPointArrayの計算済みの配列からまとめて求める。
+    """
+
+    def __init__(self, cell_deg: float = GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._points = {}   # ID -> (緯度, 経度)
+        self._cells = {}    # (緯度のマス, 経度のマス) -> {ID, ...}
+        self._array = PointArray()
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, item_id) -> bool:
+        return item_id in self._points
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def upsert(self, item_id, lat: float, lon: float):
+        """点を追加・移動する"""
+        if self._points.get(item_id) == (lat, lon):
+            return
+        self.remove(item_id)
+        self._points[item_id] = (lat, lon)
+        self._cells.setdefault(self._cell(lat, lon), set()).add(item_id)
+        self._array.upsert(item_id, lat, lon)
+
+    def remove(self, item_id):
+        """点を取り除く（なければ何もしない）"""
+        point = self._points.pop(item_id, None)
+        if point is None:
+            return
+        cell = self._cell(*point)
+        members = self._cells[cell]
+        members.discard(item_id)
+        if not members:
+            del self._cells[cell]
+        self._array.remove(item_id)
+
+    def sync(self, records: Dict, position: Callable, include: Callable):
+        """
+        レコードの辞書に合わせて、位置・対象かどうかが変わったものだけを更新する
+
+        Args:
+            records (dict): ID -> レコード
+            position: レコードから (緯度, 経度) を返す関数（位置がなければNone）
+            include: レコードをインデックスに入れるかどうかを返す関数
+        """
+        keep = set()
+        for item_id, record in records.items():
+            point = position(record) if include(record) else None
+            if point is None:
+                continue
+            keep.add(item_id)
+            self.upsert(item_id, *point)
+        for item_id in [item_id for item_id in self._points if item_id not in keep]:
+            self.remove(item_id)
+
+    def _ring(self, center: Tuple[int, int], r: int):
+        """中心のマスからr周目のマス"""
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for dj in range(-r, r + 1):
+            yield (ci - r, cj + dj)
+            yield (ci + r, cj + dj)
+        for di in range(-r + 1, r):
+            yield (ci + di, cj - r)
+            yield (ci + di, cj + r)
+
+    def _covered_km(self, lat: float, r: int) -> float:
+        """r周目まで見たとき、それより外のマスの点までの最短距離（km）"""
+        cos_lat = math.cos(math.radians(min(89.9, abs(lat) + (r + 1) * self.cell_deg)))
+        # 東西方向は緯線に沿った長さで近似しているため、1%の余裕をとって短めに見積もる
+        return r * self.cell_deg * KM_PER_DEG_LAT * cos_lat * 0.99
+
+    def _distances(self, lat: float, lon: float, ids) -> List[Tuple[object, float]]:
+        ids = list(ids)
+        return list(zip(ids, self._array.distances(lat, lon, ids).tolist()))
+
+    def _all_nearest(self, lat: float, lon: float, k: Optional[int] = None) -> List[Tuple[object, float]]:
+        """全点への距離を1回で計算し、近い順にk件（省略時は全件）"""
+        distances = self._array.distances(lat, lon)
+        if k is not None and k < len(distances):
+            order = np.argpartition(distances, k)[:k]
+            order = order[np.argsort(distances[order], kind='stable')]
+        else:
+            order = np.argsort(distances, kind='stable')
+        ids = self._array.ids
+        return [(ids[i], float(distances[i])) for i in order]
+
+    def nearest(self, lat: float, lon: float, k: Optional[int] = None,
+                max_km: Optional[float] = None) -> List[Tuple[object, float]]:
+        """
+        近い順にk件（kを省略すると全件）
+
+        Returns:
+            list: [(ID, 距離km), ...]（近い順）
+        """
+        if max_km is not None:
+            found = self.within(lat, lon, max_km)
+            return found[:k] if k is not None else found
+        if k is None or k >= len(self._points):
+            return self._all_nearest(lat, lon)
+        if k <= 0:
+            return []
+
+        center = self._cell(lat, lon)
+        found = []
+        r = 0
+        while True:
+            # 見るマスの数が点のあるマスの数を超えたら、全点への距離をまとめて計算する
+            if (2 * r + 1) ** 2 > len(self._cells):
+                return self._all_nearest(lat, lon, k)
+            for cell in self._ring(center, r):
+                members = self._cells.get(cell)
+                if members:
+                    found.extend(self._distances(lat, lon, members))
+            if len(found) >= k:
+                found.sort(key=lambda x: x[1])
+                if found[k - 1][1] <= self._covered_km(lat, r):
+                    return found[:k]
+            r += 1
+
+    def within(self, lat: float, lon: float, radius_km: float) -> List[Tuple[object, float]]:
+        """
+        半径radius_km以内の点（近い順）
+
+        Returns:
+            list: [(ID, 距離km), ...]
+        """
+        dlat = radius_km / KM_PER_DEG_LAT
+        cos_lat = math.cos(math.radians(min(89.9, abs(lat) + dlat)))
+        dlon = radius_km / (KM_PER_DEG_LAT * max(cos_lat, 1e-6))
+        (i0, j0), (i1, j1) = self._cell(lat - dlat, lon - dlon), self._cell(lat + dlat, lon + dlon)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+            cells = [members for (i, j), members in self._cells.items() if i0 <= i <= i1 and j0 <= j <= j1]
+        else:
+            cells = [self._cells[(i, j)] for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)
+                     if (i, j) in self._cells]
+        candidates = [item_id for members in cells for item_id in members]
+        found = [(item_id, distance) for item_id, distance in self._distances(lat, lon, candidates)
+                 if distance <= radius_km]
+        found.sort(key=lambda x: x[1])
+        return found
+
+
+def _request_position(request) -> Optional[Tuple[float, float]]:
+    if request.get('front_lat') is None or request.get('front_lon') is None:
+        return None
+    return (request['front_lat'], request['front_lon'])
+
+
+def _driver_position(driver) -> Optional[Tuple[float, float]]:
+    if driver.get('lat') is None or driver.get('lon') is None:
+        return None
+    return (driver['lat'], driver['lon'])
+
+
+class MatchingIndex:
+    """
+    配車の照合に使う2つの空間インデックス（全セッションで共有する）
+    - requests: 待機中（pending）のリクエストの迎車地点
+    - drivers: 稼働可能（available）なドライバーの位置
+
+    sync_*() には保存先のキャッシュが共有している辞書を渡す。前回と同じ辞書（変更なし）なら何もせず、
+    変わっていれば位置・状態の変わったものだけを更新する。
+    """
+
+    def __init__(self, cell_deg: float = GRID_CELL_DEG):
+        self.requests = SpatialIndex(cell_deg)
+        self.drivers = SpatialIndex(cell_deg)
+        self._sources = {}
+        self.lock = threading.RLock()
+
+    def _sync(self, name: str, records: Dict, position: Callable, include: Callable):
+        with self.lock:
+            if self._sources.get(name) is records:
+                return
+            getattr(self, name).sync(records, position, include)
+            self._sources[name] = records
+
+    def sync_requests(self, requests: Dict):
+        self._sync('requests', requests, _request_position, lambda r: r.get('status') == 'pending')
+
+    def sync_drivers(self, drivers: Dict):
+        self._sync('drivers', drivers, _driver_position, lambda d: d.get('status') == 'available')
+
+    def nearest_requests(self, lat: float, lon: float, k: Optional[int] = None,
+                         max_km: Optional[float] = None) -> List[Tuple[str, float]]:
+        with self.lock:
+            return self.requests.nearest(lat, lon, k, max_km)
+
+    def nearest_drivers(self, lat: float, lon: float, k: Optional[int] = None,
+                        max_km: Optional[float] = None) -> List[Tuple[str, float]]:
+        with self.lock:
+            return self.drivers.nearest(lat, lon, k, max_km)
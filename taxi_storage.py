@@ -0,0 +1,1318 @@
+"""
+タクシー配車アプリ（taxi_app.py）のデータ保存
+- SQLiteStorage：SQLite（WALモード）に保存する標準のバックエンド
+  status・facility_id・assigned_driver にインデックスを張り、状態の変更は1行の更新で行う
+- EventLogStorage：状態の変更をイベントとして追記するファイルのバックエンド
+  現在の状態は最新のスナップショットとその後のイベントから組み立てる
+- JsonStorage：従来どおり taxi_data/*.json に保存する予備のバックエンド
+- 既存のJSONファイルは、SQLite・イベントログを初めて開いたときに1回だけ取り込む
+- SQLite・イベントログでは、すべての変更がイベント（request_created、assigned など）として残る
+
+使い方（コマンドラインからの移行・書き出し・履歴の表示）:
+    python taxi_storage.py migrate --data-dir taxi_data   # JSON → SQLite
+    python taxi_storage.py export --data-dir taxi_data    # SQLite → JSON（JSONバックエンドに戻す場合）
+    python taxi_storage.py history --id <リクエストID>     # 変更の履歴
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from types import MappingProxyType
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windowsではファイルロックを使わない（同じプロセス内の排他のみ）
+    fcntl = None
+
+# リクエストの状態の流れ
+REQUEST_STATUSES = ('pending', 'assigned', 'arrived', 'departed', 'completed')
+# ドライバーが担当中とみなす状態
+ACTIVE_STATUSES = ('assigned', 'arrived', 'departed')
+
+# 許可する状態の変更（変更前 -> 変更後）
+TRANSITIONS = {
+    'pending': 'assigned',
+    'assigned': 'arrived',
+    'arrived': 'departed',
+    'departed': 'completed',
+}
+
+# イベントの種類
+# request_created: リクエストの作成（data は全項目）
+# assigned / arrived / departed / completed: 状態の変更（data は変更した項目）
+# request_updated / driver_updated: 項目の上書き
+# requests_archived: 完了したリクエストのアーカイブへの移動（data は {'ids': [...]}）
+# requests_replaced / drivers_replaced / facilities_replaced: 全件の置き換え（data は全件）
+TRANSITION_EVENTS = tuple(TRANSITIONS.values())
+REPLACE_EVENTS = {
+    'requests_replaced': 'requests',
+    'drivers_replaced': 'drivers',
+    'facilities_replaced': 'facilities',
+}
+
+# JSONファイル（JsonStorage）の更新時刻の精度とみなす秒数（FATなどは2秒単位）
+# 更新時刻がこの秒数より新しいファイルは、同じ時刻・同じ大きさでの書き換えを見逃さないように内容のハッシュも比べる
+JSON_MTIME_TICK_SEC = 2.0
+
+# SQLite（SQLiteStorage）で使い回す接続の数（同時に使う接続がこれより多いときは、使い終わった分を閉じる）
+SQLITE_POOL_SIZE = int(os.getenv("TAXI_SQLITE_POOL_SIZE", "4"))
+
+# イベントログ（EventLogStorage）の設定
+# fsyncはこの秒数ごとにまとめて行う（0で毎回。プロセスが落ちても書き込んだイベントは残り、
+# OSごと落ちた場合に最大この秒数分が失われうる）
+EVENT_FSYNC_INTERVAL = float(os.getenv("TAXI_EVENT_FSYNC_INTERVAL", "0.2"))
+# この件数のイベントがたまったらスナップショットを書き、新しいログファイルに切り替える
+SNAPSHOT_EVERY = int(os.getenv("TAXI_SNAPSHOT_EVERY", "1000"))
+
+# datetimeとして扱う項目（保存時はISO形式の文字列）
+REQUEST_TIME_FIELDS = ('created_at', 'assigned_at', 'arrived_at', 'departed_at', 'completed_at')
+DRIVER_TIME_FIELDS = ('updated_at',)
+
+# SQLiteのテーブルの列（ここにない項目は extra 列にJSONでまとめて保存する）
+REQUEST_COLUMNS = (
+    'id', 'status', 'facility_id', 'facility_name', 'assigned_driver', 'driver_name', 'car_number',
+    'front_lat', 'front_lon', 'destination', 'passenger_name', 'special_requests', 'estimated_arrival',
+    'created_at', 'assigned_at', 'arrived_at', 'departed_at', 'completed_at',
+)
+DRIVER_COLUMNS = ('id', 'name', 'car_number', 'lat', 'lon', 'status', 'updated_at')
+FACILITY_COLUMNS = ('id', 'name', 'lat', 'lon')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    facility_id TEXT,
+    facility_name TEXT,
+    assigned_driver TEXT,
+    driver_name TEXT,
+    car_number TEXT,
+    front_lat REAL,
+    front_lon REAL,
+    destination TEXT,
+    passenger_name TEXT,
+    special_requests TEXT,
+    estimated_arrival INTEGER,
+    created_at TEXT,
+    assigned_at TEXT,
+    arrived_at TEXT,
+    departed_at TEXT,
+    completed_at TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_requests_status ON requests (status);
+CREATE INDEX IF NOT EXISTS idx_requests_facility ON requests (facility_id, status);
+CREATE INDEX IF NOT EXISTS idx_requests_driver ON requests (assigned_driver, status);
+
+CREATE TABLE IF NOT EXISTS drivers (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    car_number TEXT,
+    lat REAL,
+    lon REAL,
+    status TEXT,
+    updated_at TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_drivers_status ON drivers (status);
+
+CREATE TABLE IF NOT EXISTS facilities (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    lat REAL,
+    lon REAL,
+    extra TEXT
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    at TEXT NOT NULL,
+    type TEXT NOT NULL,
+    entity_id TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_entity ON events (entity_id, seq);
+
+-- 変更のたびに増える版番号（読み込みのキャッシュが変更の有無を確かめるのに使う）
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO versions (name, value) VALUES ('requests', 0), ('drivers', 0), ('facilities', 0);
+CREATE TRIGGER IF NOT EXISTS requests_insert_version AFTER INSERT ON requests
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'requests'; END;
+CREATE TRIGGER IF NOT EXISTS requests_update_version AFTER UPDATE ON requests
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'requests'; END;
+CREATE TRIGGER IF NOT EXISTS requests_delete_version AFTER DELETE ON requests
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'requests'; END;
+CREATE TRIGGER IF NOT EXISTS drivers_insert_version AFTER INSERT ON drivers
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'drivers'; END;
+CREATE TRIGGER IF NOT EXISTS drivers_update_version AFTER UPDATE ON drivers
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'drivers'; END;
+CREATE TRIGGER IF NOT EXISTS drivers_delete_version AFTER DELETE ON drivers
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'drivers'; END;
+CREATE TRIGGER IF NOT EXISTS facilities_insert_version AFTER INSERT ON facilities
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'facilities'; END;
+CREATE TRIGGER IF NOT EXISTS facilities_update_version AFTER UPDATE ON facilities
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'facilities'; END;
+CREATE TRIGGER IF NOT EXISTS facilities_delete_version AFTER DELETE ON facilities
+BEGIN UPDATE versions SET value = value + 1 WHERE name = 'facilities'; END;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class TransitionRejected(Exception):
+    """状態の変更が受け付けられなかった（他の端末が先に変更した、またはリクエストがない）"""
+
+    def __init__(self, request_id: str, expected_status: str, current_status: Optional[str]):
+        self.request_id = request_id
+        self.expected_status = expected_status
+        self.current_status = current_status  # リクエストがない場合はNone
+        super().__init__(
+            f"リクエスト {request_id} は {expected_status} ではありません（現在: {current_status or 'なし'}）"
+        )
+
+
+class DriverBusy(TransitionRejected):
+    """割り当てようとしたドライバーが、既に他のリクエストを担当している（自動配車と手動の受諾が重なった）"""
+
+    def __init__(self, request_id: str, driver_id: str, active_request_id: str):
+        self.request_id = request_id
+        self.expected_status = 'pending'
+        self.current_status = 'pending'
+        self.driver_id = driver_id
+        self.active_request_id = active_request_id
+        Exception.__init__(
+            self, f"ドライバー {driver_id} は既にリクエスト {active_request_id} を担当しています"
+        )
+
+
+@contextmanager
+def _exclusive(lock: threading.RLock, lock_file: str):
+    """
+    読み込み・確認・書き込みをまとめて排他する
+    同じプロセス内はRLock、別プロセス（複数のStreamlitサーバー）とはロックファイルのflockで排他する
+    """
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(lock_file, 'a') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+
+def _make_event(event_type: str, entity_id: Optional[str], data, seq: Optional[int] = None) -> Dict:
+    """イベントを作る（datetimeは文字列にする）"""
+    event = {'seq': seq, 'at': datetime.now().isoformat(), 'type': event_type, 'id': entity_id}
+    if isinstance(data, dict) and event_type in REPLACE_EVENTS:
+        data = {key: _serialize(record) for key, record in data.items()}
+    elif isinstance(data, dict):
+        data = _serialize(data)
+    event['data'] = data
+    return event
+
+
+def _apply_event(state: Dict, event: Dict):
+    """イベントを状態（requests・drivers・facilities の辞書。値は文字列のまま）に反映する"""
+    event_type, entity_id, data = event['type'], event['id'], event['data']
+    if event_type == 'request_created':
+        state['requests'][entity_id] = dict(data)
+    elif event_type in TRANSITION_EVENTS or event_type == 'request_updated':
+        state['requests'].setdefault(entity_id, {'id': entity_id}).update(data)
+    elif event_type == 'requests_archived':
+        for request_id in data['ids']:
+            state['requests'].pop(request_id, None)
+    elif event_type == 'driver_updated':
+        state['drivers'].setdefault(entity_id, {'id': entity_id}).update(data)
+    elif event_type in REPLACE_EVENTS:
+        state[REPLACE_EVENTS[event_type]] = {key: dict(record) for key, record in data.items()}
+
+
+def _check_transition(from_status: str, to_status: str):
+    if TRANSITIONS.get(from_status) != to_status:
+        raise ValueError(f"{from_status} から {to_status} には変更できません")
+
+
+def _active_request_of(requests: Dict, driver_id: str, exclude_id: str) -> Optional[str]:
+    """driver_id が担当中のリクエスト（exclude_id 以外）のID（なければNone）"""
+    for req_id, req_data in requests.items():
+        if req_id != exclude_id and _matches(req_data, ACTIVE_STATUSES, assigned_driver=driver_id):
+            return req_id
+    return None
+
+
+def _to_text(value):
+    """datetimeをISO形式の文字列にする（それ以外はそのまま）"""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _parse_times(record: Dict, fields: tuple) -> Dict:
+    """ISO形式の文字列の項目をdatetimeに変換する（空の項目はそのまま）"""
+    for field in fields:
+        if record.get(field) and isinstance(record[field], str):
+            record[field] = datetime.fromisoformat(record[field])
+    return record
+
+
+def _serialize(record: Dict) -> Dict:
+    """datetimeの項目を文字列にしたコピーを返す"""
+    return {key: _to_text(value) for key, value in record.items()}
+
+
+def _matches(record: Dict, status=None, facility_id: Optional[str] = None,
+             assigned_driver: Optional[str] = None) -> bool:
+    """リクエストが絞り込み条件に合うか（status は1つの状態または状態のリスト）"""
+    if status is not None:
+        statuses = (status,) if isinstance(status, str) else tuple(status)
+        if record.get('status') not in statuses:
+            return False
+    if facility_id is not None and record.get('facility_id') != facility_id:
+        return False
+    if assigned_driver is not None and record.get('assigned_driver') != assigned_driver:
+        return False
+    return True
+
+
+class JsonStorage:
+    """
+    taxi_data/*.json に保存するバックエンド（予備）
+
+    読み込み・書き込みのたびにファイル全体を読み書きする。
+    1件の更新もファイル全体の書き直しになるため、件数が増えると遅くなる。
+    """
+
+    name = "json"
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.requests_file = os.path.join(data_dir, "requests.json")
+        self.drivers_file = os.path.join(data_dir, "drivers.json")
+        self.facilities_file = os.path.join(data_dir, "facilities.json")
+        self.lock_file = os.path.join(data_dir, ".lock")
+        self._lock = threading.RLock()
+        self._writes = Counter()  # ファイルのパス -> このオブジェクトから書き込んだ回数
+        self._digests = {}        # ファイルのパス -> (ハッシュを計算したときの (inode, 更新時刻, 大きさ), ハッシュ)
+        os.makedirs(data_dir, exist_ok=True)
+
+    def _locked(self):
+        return _exclusive(self._lock, self.lock_file)
+
+    def _read(self, path: str) -> Dict:
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            # JSONファイルが壊れている場合は空の辞書を返す
+            return {}
+
+    def _write(self, path: str, data: Dict):
+        # 書き込み途中のファイルを他の端末が読まないように、一時ファイルに書いてから置き換える
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+        self._writes[path] += 1
+
+    # --- リクエスト ---
+
+    def load_requests(self, status=None, facility_id: Optional[str] = None,
+                      assigned_driver: Optional[str] = None) -> Dict:
+        data = self._read(self.requests_file)
+        return {
+            req_id: _parse_times(req_data, REQUEST_TIME_FIELDS)
+            for req_id, req_data in data.items()
+            if _matches(req_data, status, facility_id, assigned_driver)
+        }
+
+    def load_request(self, request_id: str) -> Optional[Dict]:
+        req_data = self._read(self.requests_file).get(request_id)
+        return _parse_times(req_data, REQUEST_TIME_FIELDS) if req_data else None
+
+    def save_requests(self, requests: Dict):
+        with self._locked():
+            self._write(self.requests_file, {req_id: _serialize(r) for req_id, r in requests.items()})
+
+    def add_request(self, request: Dict):
+        with self._locked():
+            data = self._read(self.requests_file)
+            data[request['id']] = _serialize(request)
+            self._write(self.requests_file, data)
+
+    def update_request(self, request_id: str, fields: Dict) -> bool:
+        with self._locked():
+            data = self._read(self.requests_file)
+            if request_id not in data:
+                return False
+            data[request_id].update(_serialize(fields))
+            self._write(self.requests_file, data)
+            return True
+
+    def delete_requests(self, request_ids) -> int:
+        with self._locked():
+            data = self._read(self.requests_file)
+            deleted = [request_id for request_id in request_ids if data.pop(request_id, None) is not None]
+            if deleted:
+                self._write(self.requests_file, data)
+            return len(deleted)
+
+    def transition(self, request_id: str, from_status: str, to_status: str,
+                   fields: Optional[Dict] = None, require_idle_driver: Optional[str] = None) -> Dict:
+        _check_transition(from_status, to_status)
+        with self._locked():
+            data = self._read(self.requests_file)
+            current = data.get(request_id)
+            if current is None or current.get('status') != from_status:
+                raise TransitionRejected(request_id, from_status, current.get('status') if current else None)
+            if require_idle_driver is not None:
+                active_id = _active_request_of(data, require_idle_driver, request_id)
+                if active_id is not None:
+                    raise DriverBusy(request_id, require_idle_driver, active_id)
+            current.update(_serialize(fields or {}))
+            current['status'] = to_status
+            self._write(self.requests_file, data)
+            return _parse_times(dict(current), REQUEST_TIME_FIELDS)
+
+    # --- ドライバー ---
+
+    def load_drivers(self, status: Optional[str] = None) -> Dict:
+        data = self._read(self.drivers_file)
+        return {
+            driver_id: _parse_times(driver_data, DRIVER_TIME_FIELDS)
+            for driver_id, driver_data in data.items()
+            if status is None or driver_data.get('status') == status
+        }
+
+    def save_drivers(self, drivers: Dict):
+        with self._locked():
+            self._write(self.drivers_file, {driver_id: _serialize(d) for driver_id, d in drivers.items()})
+
+    def put_driver(self, driver: Dict):
+        with self._locked():
+            data = self._read(self.drivers_file)
+            data[driver['id']] = _serialize(driver)
+            self._write(self.drivers_file, data)
+
+    def update_driver(self, driver_id: str, fields: Dict) -> bool:
+        with self._locked():
+            data = self._read(self.drivers_file)
+            if driver_id not in data:
+                return False
+            data[driver_id].update(_serialize(fields))
+            self._write(self.drivers_file, data)
+            return True
+
+    # --- 施設 ---
+
+    def load_facilities(self) -> Dict:
+        return self._read(self.facilities_file)
+
+    def save_facilities(self, facilities: Dict):
+        with self._locked():
+            self._write(self.facilities_file, {key: dict(value) for key, value in facilities.items()})
+
+    def data_version(self, kind: str):
+        """
+        kind（requests / drivers / facilities）の版（変更の検出用）
+        このオブジェクトからの書き込み回数と、ファイルのinode・更新時刻・大きさ（書き込みは置き換えなので
+        inodeが変わる）。更新時刻が JSON_MTIME_TICK_SEC より新しいときは、同じ時刻・同じ大きさの書き換え
+        （assigned → arrived など）を見分けるために内容のハッシュも加える
+        """
+        path = {'requests': self.requests_file, 'drivers': self.drivers_file,
+                'facilities': self.facilities_file}[kind]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if time.time_ns() - stat.st_mtime_ns < JSON_MTIME_TICK_SEC * 1e9:
+            try:
+                with open(path, 'rb') as f:
+                    digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+            except FileNotFoundError:
+                return None
+            self._digests[path] = (key, digest)
+        else:
+            # 時間が経ったファイルは、最後に計算したハッシュを使う（版が時間の経過だけで変わらないように）
+            hashed_key, digest = self._digests.get(path, (None, None))
+            if hashed_key != key:
+                digest = None
+        return (self._writes[path], *key, digest)
+
+    # --- 履歴 ---
+
+    def load_events(self, entity_id: Optional[str] = None) -> List[Dict]:
+        """JSONファイルには履歴を残さない（常に空）"""
+        return []
+
+
+class SQLiteStorage:
+    """
+    SQLite（WALモード）に保存するバックエンド
+
+    読み込みは条件に合う行だけをインデックスで取り出し、状態の変更は1行の更新で行う。
+    WALモードのため、書き込み中も他の端末の読み込みは待たされない。
+    変更は同じトランザクションで events テーブルにも追記する（履歴）。
+    接続はプロセス内で使い回す（Streamlitは実行のたびに別スレッドになるため、スレッドごとには作らない）。
+    使う間だけ1つの接続を借り、終わったら返す。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str, json_dir: Optional[str] = None, pool_size: int = SQLITE_POOL_SIZE):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self._pool_lock = threading.Lock()
+        self._idle = []  # 使われていない接続
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+        if json_dir:
+            self.migrate_from_json(json_dir)
+
+    def _connect(self) -> sqlite3.Connection:
+        # 自動コミットにして、トランザクションは必要な箇所で明示的に開始する
+        # 接続は借りたスレッドだけが使うので、作ったスレッド以外からの利用を許可する
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """接続を1つ借りる（空いている接続がなければ作る。返したときに pool_size を超える分は閉じる）"""
+        with self._pool_lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            with self._pool_lock:
+                if len(self._idle) < self.pool_size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def _query(self, sql: str, params=()) -> List[sqlite3.Row]:
+        """読み込み（結果をすべて取り出してから接続を返す）"""
+        with self._connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def close(self):
+        """使われていない接続を閉じる"""
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    # --- 行とdictの変換 ---
+
+    @staticmethod
+    def _to_row(record: Dict, columns: tuple) -> tuple:
+        extra = {key: _to_text(value) for key, value in record.items() if key not in columns}
+        return tuple(_to_text(record.get(column)) for column in columns) + (
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        )
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row, columns: tuple, time_fields: tuple) -> Dict:
+        record = {column: row[column] for column in columns}
+        if row['extra']:
+            record.update(json.loads(row['extra']))
+        return _parse_times(record, time_fields)
+
+    def _upsert(self, conn: sqlite3.Connection, table: str, columns: tuple, records):
+        placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}, extra) VALUES ({placeholders})",
+            [self._to_row(record, columns) for record in records]
+        )
+
+    @staticmethod
+    def _apply_fields(conn: sqlite3.Connection, table: str, columns: tuple, row: sqlite3.Row, fields: Dict):
+        """取得済みの1行に項目を書き込む（列にない項目は extra に追記する。トランザクション内で呼ぶ）"""
+        direct = {key: _to_text(value) for key, value in fields.items() if key in columns and key != 'id'}
+        extra = {key: _to_text(value) for key, value in fields.items() if key not in columns}
+        if extra:
+            merged = json.loads(row['extra']) if row['extra'] else {}
+            merged.update(extra)
+            direct['extra'] = json.dumps(merged, ensure_ascii=False)
+        if direct:
+            assignments = ", ".join(f"{column} = ?" for column in direct)
+            conn.execute(f"UPDATE {table} SET {assignments} WHERE id = ?", (*direct.values(), row['id']))
+
+    @staticmethod
+    def _append_event(conn: sqlite3.Connection, event_type: str, entity_id: Optional[str], data):
+        """イベントを追記する（トランザクション内で呼ぶ）"""
+        event = _make_event(event_type, entity_id, data)
+        conn.execute(
+            "INSERT INTO events (at, type, entity_id, data) VALUES (?, ?, ?, ?)",
+            (event['at'], event_type, entity_id, json.dumps(event['data'], ensure_ascii=False))
+        )
+
+    @contextmanager
+    def _transaction(self):
+        """書き込みのトランザクション（BEGIN IMMEDIATEで書き込みロックを先に取る）"""
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _update_row(self, table: str, columns: tuple, row_id: str, fields: Dict, event_type: str) -> bool:
+        """1行の一部の項目を更新する"""
+        with self._transaction() as conn:
+            row = conn.execute(f"SELECT id, extra FROM {table} WHERE id = ?", (row_id,)).fetchone()
+            if row is not None:
+                self._apply_fields(conn, table, columns, row, fields)
+                self._append_event(conn, event_type, row_id, fields)
+        return row is not None
+
+    def _replace_all(self, table: str, columns: tuple, records: Dict, event_type: str):
+        """テーブルの内容を全件置き換える"""
+        with self._transaction() as conn:
+            conn.execute(f"DELETE FROM {table}")
+            self._upsert(conn, table, columns, records.values())
+            self._append_event(conn, event_type, None, records)
+
+    # --- リクエスト ---
+
+    def load_requests(self, status=None, facility_id: Optional[str] = None,
+                      assigned_driver: Optional[str] = None) -> Dict:
+        conditions, params = [], []
+        if status is not None:
+            statuses = (status,) if isinstance(status, str) else tuple(status)
+            conditions.append(f"status IN ({', '.join('?' for _ in statuses)})")
+            params.extend(statuses)
+        if facility_id is not None:
+            conditions.append("facility_id = ?")
+            params.append(facility_id)
+        if assigned_driver is not None:
+            conditions.append("assigned_driver = ?")
+            params.append(assigned_driver)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._query(f"SELECT * FROM requests{where} ORDER BY created_at", params)
+        return {row['id']: self._from_row(row, REQUEST_COLUMNS, REQUEST_TIME_FIELDS) for row in rows}
+
+    def load_request(self, request_id: str) -> Optional[Dict]:
+        rows = self._query("SELECT * FROM requests WHERE id = ?", (request_id,))
+        return self._from_row(rows[0], REQUEST_COLUMNS, REQUEST_TIME_FIELDS) if rows else None
+
+    def save_requests(self, requests: Dict):
+        self._replace_all("requests", REQUEST_COLUMNS, requests, "requests_replaced")
+
+    def add_request(self, request: Dict):
+        with self._transaction() as conn:
+            self._upsert(conn, "requests", REQUEST_COLUMNS, [request])
+            self._append_event(conn, "request_created", request['id'], request)
+
+    def update_request(self, request_id: str, fields: Dict) -> bool:
+        return self._update_row("requests", REQUEST_COLUMNS, request_id, fields, "request_updated")
+
+    def delete_requests(self, request_ids) -> int:
+        request_ids = list(request_ids)
+        if not request_ids:
+            return 0
+        with self._transaction() as conn:
+            deleted = conn.executemany("DELETE FROM requests WHERE id = ?", [(i,) for i in request_ids]).rowcount
+            self._append_event(conn, "requests_archived", None, {'ids': request_ids})
+        return deleted
+
+    def transition(self, request_id: str, from_status: str, to_status: str,
+                   fields: Optional[Dict] = None, require_idle_driver: Optional[str] = None) -> Dict:
+        _check_transition(from_status, to_status)
+        changes = {**(fields or {}), 'status': to_status}
+        # 書き込みロックを先に取るため、状態の確認から更新までの間に他の端末は書き込めない
+        with self._transaction() as conn:
+            row = conn.execute("SELECT * FROM requests WHERE id = ?", (request_id,)).fetchone()
+            if row is None or row['status'] != from_status:
+                raise TransitionRejected(request_id, from_status, row['status'] if row else None)
+            if require_idle_driver is not None:
+                active = conn.execute(
+                    f"SELECT id FROM requests WHERE assigned_driver = ? AND id != ? "
+                    f"AND status IN ({', '.join('?' for _ in ACTIVE_STATUSES)}) LIMIT 1",
+                    (require_idle_driver, request_id, *ACTIVE_STATUSES)
+                ).fetchone()
+                if active is not None:
+                    raise DriverBusy(request_id, require_idle_driver, active['id'])
+            self._apply_fields(conn, "requests", REQUEST_COLUMNS, row, changes)
+            self._append_event(conn, to_status, request_id, changes)
+            row = conn.execute("SELECT * FROM requests WHERE id = ?", (request_id,)).fetchone()
+        return self._from_row(row, REQUEST_COLUMNS, REQUEST_TIME_FIELDS)
+
+    # --- ドライバー ---
+
+    def load_drivers(self, status: Optional[str] = None) -> Dict:
+        if status is None:
+            rows = self._query("SELECT * FROM drivers")
+        else:
+            rows = self._query("SELECT * FROM drivers WHERE status = ?", (status,))
+        return {row['id']: self._from_row(row, DRIVER_COLUMNS, DRIVER_TIME_FIELDS) for row in rows}
+
+    def save_drivers(self, drivers: Dict):
+        self._replace_all("drivers", DRIVER_COLUMNS, drivers, "drivers_replaced")
+
+    def put_driver(self, driver: Dict):
+        with self._transaction() as conn:
+            self._upsert(conn, "drivers", DRIVER_COLUMNS, [driver])
+            self._append_event(conn, "driver_updated", driver['id'], driver)
+
+    def update_driver(self, driver_id: str, fields: Dict) -> bool:
+        return self._update_row("drivers", DRIVER_COLUMNS, driver_id, fields, "driver_updated")
+
+    # --- 施設 ---
+
+    def load_facilities(self) -> Dict:
+        rows = self._query("SELECT * FROM facilities")
+        return {row['id']: self._from_row(row, FACILITY_COLUMNS, ()) for row in rows}
+
+    def save_facilities(self, facilities: Dict):
+        self._replace_all("facilities", FACILITY_COLUMNS, facilities, "facilities_replaced")
+
+    def data_version(self, kind: str):
+        """kind（requests / drivers / facilities）の版番号（トリガーで変更のたびに増える）"""
+        rows = self._query("SELECT value FROM versions WHERE name = ?", (kind,))
+        return rows[0]['value'] if rows else None
+
+    # --- 履歴 ---
+
+    def load_events(self, entity_id: Optional[str] = None) -> List[Dict]:
+        """変更の履歴（古い順。entity_idを指定するとそのリクエスト・ドライバーのものだけ）"""
+        if entity_id is None:
+            rows = self._query("SELECT * FROM events ORDER BY seq")
+        else:
+            rows = self._query("SELECT * FROM events WHERE entity_id = ? ORDER BY seq", (entity_id,))
+        return [
+            {'seq': row['seq'], 'at': row['at'], 'type': row['type'], 'id': row['entity_id'],
+             'data': json.loads(row['data']) if row['data'] else None}
+            for row in rows
+        ]
+
+    # --- JSONからの移行 ---
+
+    def migrate_from_json(self, json_dir: str, force: bool = False) -> Optional[Dict]:
+        """
+        既存のJSONファイルの内容を取り込む（1回だけ。force=Trueで再実行）
+
+        Returns:
+            dict: 取り込んだ件数（既に取り込み済みの場合はNone）
+        """
+        done = self._query("SELECT value FROM meta WHERE key = 'migrated_from_json'")
+        if done and not force:
+            return None
+        source = JsonStorage(json_dir)
+        requests = source.load_requests()
+        drivers = source.load_drivers()
+        facilities = source.load_facilities()
+        with self._transaction() as conn:
+            self._upsert(conn, "requests", REQUEST_COLUMNS, requests.values())
+            self._upsert(conn, "drivers", DRIVER_COLUMNS, drivers.values())
+            self._upsert(conn, "facilities", FACILITY_COLUMNS, facilities.values())
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                (datetime.now().isoformat(),)
+            )
+        return {'requests': len(requests), 'drivers': len(drivers), 'facilities': len(facilities)}
+
+
+class EventLogStorage:
+    """
+    状態の変更をイベントとして追記するファイルのバックエンド
+
+    - 書き込みはログファイル（events-<世代>.jsonl）への1行の追記だけ（件数によらず一定）
+    - fsyncは EVENT_FSYNC_INTERVAL 秒ごとにまとめて行う
+    - SNAPSHOT_EVERY 件ごとに、その時点の状態をスナップショット（snapshot-<世代>.json）に書き、
+      次の世代のログに切り替える。古いログは履歴として残す
+    - 現在の状態はメモリ上に持ち、読み込みのたびにログの続き（他のプロセスが追記した分）だけを反映する
+    """
+
+    name = "eventlog"
+
+    def __init__(self, log_dir: str, json_dir: Optional[str] = None,
+                 fsync_interval: float = EVENT_FSYNC_INTERVAL, snapshot_every: int = SNAPSHOT_EVERY):
+        self.log_dir = log_dir
+        self.lock_file = os.path.join(log_dir, ".lock")
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = max(1, snapshot_every)
+        self._lock = threading.RLock()
+        self._state = {'requests': {}, 'drivers': {}, 'facilities': {}}
+        self._generation = None
+        self._offset = 0                 # 反映済みのログのバイト数
+        self._seq = 0
+        self._events_since_snapshot = 0
+        self._log_fp = None              # 追記用（書き込むプロセスだけが開く）
+        self._unsynced = False
+        os.makedirs(log_dir, exist_ok=True)
+        with self._locked():
+            if json_dir and not glob.glob(os.path.join(log_dir, "*-*.json*")):
+                self._import_json(json_dir)
+            self._refresh()
+        if self.fsync_interval > 0:
+            threading.Thread(target=self._fsync_loop, daemon=True).start()
+
+    def _locked(self):
+        return _exclusive(self._lock, self.lock_file)
+
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.log_dir, f"events-{generation:06d}.jsonl")
+
+    def _snapshot_path(self, generation: int) -> str:
+        return os.path.join(self.log_dir, f"snapshot-{generation:06d}.json")
+
+    def _import_json(self, json_dir: str):
+        """既存のJSONファイルの内容を世代0のスナップショットにする（初回のみ）"""
+        source = JsonStorage(json_dir)
+        state = {
+            'requests': {req_id: _serialize(r) for req_id, r in source.load_requests().items()},
+            'drivers': {driver_id: _serialize(d) for driver_id, d in source.load_drivers().items()},
+            'facilities': source.load_facilities(),
+        }
+        if any(state.values()):
+            self._write_snapshot(0, 0, state)
+
+    def _write_snapshot(self, generation: int, seq: int, state: Dict):
+        path = self._snapshot_path(generation)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({'generation': generation, 'seq': seq, **state}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _load_snapshot(self, generation: int):
+        path = self._snapshot_path(generation)
+        snapshot = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        self._state = {key: snapshot.get(key, {}) for key in ('requests', 'drivers', 'facilities')}
+        self._seq = snapshot.get('seq', 0)
+        self._generation = generation
+        self._offset = 0
+        self._events_since_snapshot = 0
+        if self._log_fp:
+            self._log_fp.close()
+            self._log_fp = None
+
+    def _refresh(self):
+        """他のプロセスの変更（新しい世代・ログの続き）を反映する（self._lockを持って呼ぶ）"""
+        generation = self._generation
+        if generation is None:
+            snapshots = sorted(glob.glob(os.path.join(self.log_dir, "snapshot-*.json")))
+            generation = int(os.path.basename(snapshots[-1])[9:15]) if snapshots else 0
+        while os.path.exists(self._log_path(generation + 1)):
+            generation += 1
+        if generation != self._generation:
+            self._load_snapshot(generation)
+
+        path = self._log_path(generation)
+        if not os.path.exists(path) or os.path.getsize(path) <= self._offset:
+            return
+        with open(path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        # 書き込み途中の行は次回に回す
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            if line.strip():
+                event = json.loads(line)
+                _apply_event(self._state, event)
+                self._seq = event['seq']
+                self._events_since_snapshot += 1
+        self._offset += len(complete)
+
+    def _append(self, event_type: str, entity_id: Optional[str], data):
+        """イベントを1行追記して状態に反映する（self._locked()の中で、_refresh()の後に呼ぶ）"""
+        event = _make_event(event_type, entity_id, data, seq=self._seq + 1)
+        line = (json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8')
+        if self._log_fp is None:
+            self._log_fp = open(self._log_path(self._generation), 'ab')
+        self._log_fp.write(line)
+        self._log_fp.flush()
+        if self.fsync_interval <= 0:
+            os.fsync(self._log_fp.fileno())
+        else:
+            self._unsynced = True
+        self._offset += len(line)
+        self._seq = event['seq']
+        self._events_since_snapshot += 1
+        _apply_event(self._state, event)
+        if self._events_since_snapshot >= self.snapshot_every:
+            self._compact()
+
+    def _compact(self):
+        """現在の状態をスナップショットにして、次の世代のログに切り替える"""
+        if self._log_fp:
+            os.fsync(self._log_fp.fileno())
+        generation = self._generation + 1
+        # スナップショットを書いてからログを作る（ログがあればスナップショットは必ずある）
+        self._write_snapshot(generation, self._seq, self._state)
+        open(self._log_path(generation), 'ab').close()
+        previous = self._snapshot_path(self._generation)
+        if self._log_fp:
+            self._log_fp.close()
+            self._log_fp = None
+        self._generation = generation
+        self._offset = 0
+        self._events_since_snapshot = 0
+        self._unsynced = False
+        if os.path.exists(previous):
+            os.remove(previous)
+
+    def _fsync_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                if not (self._unsynced and self._log_fp):
+                    continue
+                # fsyncの間も書き込みを止めないように、複製したファイル記述子でロックの外で行う
+                fd = os.dup(self._log_fp.fileno())
+                self._unsynced = False
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _read_state(self, key: str) -> Dict:
+        with self._lock:
+            self._refresh()
+            return dict(self._state[key])
+
+    # --- リクエスト ---
+
+    def load_requests(self, status=None, facility_id: Optional[str] = None,
+                      assigned_driver: Optional[str] = None) -> Dict:
+        requests = self._read_state('requests')
+        return {
+            req_id: _parse_times(dict(req_data), REQUEST_TIME_FIELDS)
+            for req_id, req_data in requests.items()
+            if _matches(req_data, status, facility_id, assigned_driver)
+        }
+
+    def load_request(self, request_id: str) -> Optional[Dict]:
+        req_data = self._read_state('requests').get(request_id)
+        return _parse_times(dict(req_data), REQUEST_TIME_FIELDS) if req_data else None
+
+    def save_requests(self, requests: Dict):
+        with self._locked():
+            self._refresh()
+            self._append("requests_replaced", None, requests)
+
+    def add_request(self, request: Dict):
+        with self._locked():
+            self._refresh()
+            self._append("request_created", request['id'], request)
+
+    def update_request(self, request_id: str, fields: Dict) -> bool:
+        with self._locked():
+            self._refresh()
+            if request_id not in self._state['requests']:
+                return False
+            self._append("request_updated", request_id, fields)
+            return True
+
+    def delete_requests(self, request_ids) -> int:
+        with self._locked():
+            self._refresh()
+            request_ids = [i for i in request_ids if i in self._state['requests']]
+            if request_ids:
+                self._append("requests_archived", None, {'ids': request_ids})
+            return len(request_ids)
+
+    def transition(self, request_id: str, from_status: str, to_status: str,
+                   fields: Optional[Dict] = None, require_idle_driver: Optional[str] = None) -> Dict:
+        _check_transition(from_status, to_status)
+        with self._locked():
+            self._refresh()
+            current = self._state['requests'].get(request_id)
+            if current is None or current.get('status') != from_status:
+                raise TransitionRejected(request_id, from_status, current.get('status') if current else None)
+            if require_idle_driver is not None:
+                active_id = _active_request_of(self._state['requests'], require_idle_driver, request_id)
+                if active_id is not None:
+                    raise DriverBusy(request_id, require_idle_driver, active_id)
+            self._append(to_status, request_id, {**(fields or {}), 'status': to_status})
+            return _parse_times(dict(self._state['requests'][request_id]), REQUEST_TIME_FIELDS)
+
+    # --- ドライバー ---
+
+    def load_drivers(self, status: Optional[str] = None) -> Dict:
+        drivers = self._read_state('drivers')
+        return {
+            driver_id: _parse_times(dict(driver_data), DRIVER_TIME_FIELDS)
+            for driver_id, driver_data in drivers.items()
+            if status is None or driver_data.get('status') == status
+        }
+
+    def save_drivers(self, drivers: Dict):
+        with self._locked():
+            self._refresh()
+            self._append("drivers_replaced", None, drivers)
+
+    def put_driver(self, driver: Dict):
+        with self._locked():
+            self._refresh()
+            self._append("driver_updated", driver['id'], driver)
+
+    def update_driver(self, driver_id: str, fields: Dict) -> bool:
+        with self._locked():
+            self._refresh()
+            if driver_id not in self._state['drivers']:
+                return False
+            self._append("driver_updated", driver_id, fields)
+            return True
+
+    # --- 施設 ---
+
+    def load_facilities(self) -> Dict:
+        return {key: dict(value) for key, value in self._read_state('facilities').items()}
+
+    def save_facilities(self, facilities: Dict):
+        with self._locked():
+            self._refresh()
+            self._append("facilities_replaced", None, facilities)
+
+    def data_version(self, kind: str):
+        """反映済みのイベントの番号（どの種類の変更でも増える）"""
+        with self._lock:
+            self._refresh()
+            return (self._generation, self._seq)
+
+    # --- 履歴 ---
+
+    def load_events(self, entity_id: Optional[str] = None) -> List[Dict]:
+        """変更の履歴（古い順。切り替え前の世代のログも含む）"""
+        events = []
+        for path in sorted(glob.glob(os.path.join(self.log_dir, "events-*.jsonl"))):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    event = json.loads(line)
+                    if entity_id is None or event['id'] == entity_id:
+                        events.append(event)
+        return events
+
+
+class StatusAggregates:
+    """
+    リクエスト・ドライバーの件数の集計（状態別・施設別・ドライバー別）
+
+    レコードが変わるたびに apply_request / apply_driver で変更前と変更後を渡し、
+    その分だけ件数を増減する（全件を数え直さない）。
+    """
+
+    def __init__(self):
+        self.requests_total = 0
+        self.requests_by_status = Counter()
+        self.requests_by_facility = {}   # 施設ID -> Counter(状態 -> 件数)
+        self.requests_by_driver = {}     # 担当ドライバーID -> Counter(状態 -> 件数)
+        self.drivers_total = 0
+        self.drivers_by_status = Counter()
+        self.busy_available_drivers = 0  # 担当中のリクエストがある available のドライバーの数
+        self._driver_status = {}
+
+    @staticmethod
+    def _add(counters: Dict, key, status, delta: int):
+        counter = counters.setdefault(key, Counter())
+        counter[status] += delta
+        if not counter[status]:
+            del counter[status]
+        if not counter:
+            del counters[key]
+
+    def active_requests(self, driver_id: str) -> int:
+        """ドライバーが担当中（assigned / arrived / departed）のリクエストの数"""
+        counter = self.requests_by_driver.get(driver_id)
+        return sum(counter[status] for status in ACTIVE_STATUSES) if counter else 0
+
+    def facility_counts(self, facility_id: str) -> Counter:
+        """施設のリクエストの状態別の件数"""
+        return self.requests_by_facility.get(facility_id, Counter())
+
+    def _busy_available(self, driver_id) -> bool:
+        return self._driver_status.get(driver_id) == 'available' and self.active_requests(driver_id) > 0
+
+    def _count_request(self, record, delta: int):
+        status = record.get('status')
+        self.requests_total += delta
+        self.requests_by_status[status] += delta
+        if not self.requests_by_status[status]:
+            del self.requests_by_status[status]
+        self._add(self.requests_by_facility, record.get('facility_id'), status, delta)
+        if record.get('assigned_driver'):
+            self._add(self.requests_by_driver, record['assigned_driver'], status, delta)
+
+    def apply_request(self, before, after):
+        """リクエスト1件の変更を反映する（追加は before=None、削除は after=None）"""
+        drivers = {r.get('assigned_driver') for r in (before, after) if r and r.get('assigned_driver')}
+        busy_before = sum(self._busy_available(d) for d in drivers)
+        if before:
+            self._count_request(before, -1)
+        if after:
+            self._count_request(after, 1)
+        self.busy_available_drivers += sum(self._busy_available(d) for d in drivers) - busy_before
+
+    def apply_driver(self, before, after):
+        """ドライバー1人の変更を反映する（追加は before=None、削除は after=None）"""
+        driver_id = (after or before)['id']
+        busy_before = self._busy_available(driver_id)
+        if before:
+            self.drivers_total -= 1
+            self.drivers_by_status[before.get('status')] -= 1
+            if not self.drivers_by_status[before.get('status')]:
+                del self.drivers_by_status[before.get('status')]
+            self._driver_status.pop(driver_id, None)
+        if after:
+            self.drivers_total += 1
+            self.drivers_by_status[after.get('status')] += 1
+            self._driver_status[driver_id] = after.get('status')
+        self.busy_available_drivers += self._busy_available(driver_id) - busy_before
+
+
+class CachedStorage:
+    """
+    保存先の読み込みのキャッシュ（全セッションで共有する）
+
+    リクエスト・ドライバーは、保存先の版番号（data_version）が変わったときだけ全件を読み込み直し、
+    datetimeへの変換も含めて1回だけ行う。変わっていなければ保存先を読まずにキャッシュを返す。
+    読み込み直したときは、前回と変わったレコードの分だけ件数の集計（StatusAggregates）を更新する。
+    返す辞書は呼び出しごとに新しいが、中の各レコードは共有している読み取り専用のビュー
+    （MappingProxyType）なので、書き換える場合は dict(record) でコピーしてから変更する。
+    書き込みや施設の読み込みなど、それ以外の操作はそのまま保存先に渡す。
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.name = storage.name
+        self._lock = threading.Lock()
+        self._entries = {}   # kind -> (版番号, {ID: 読み取り専用のレコード})
+        self._aggregates = StatusAggregates()
+        self.stats = {'hits': 0, 'loads': 0}
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _records(self, kind: str) -> Dict:
+        # 読み込みより先に版番号を取る（読み込み中に変更されても、次の呼び出しで読み込み直す）
+        version = self.storage.data_version(kind)
+        with self._lock:
+            entry = self._entries.get(kind)
+            if entry is not None and entry[0] == version and version is not None:
+                self.stats['hits'] += 1
+                return entry[1]
+        records = self.storage.load_requests() if kind == 'requests' else self.storage.load_drivers()
+        records = {record_id: MappingProxyType(record) for record_id, record in records.items()}
+        with self._lock:
+            # 集計は、いま持っているレコードから新しいレコードへの差分だけを反映する
+            entry = self._entries.get(kind)
+            previous = entry[1] if entry is not None else {}
+            apply = self._aggregates.apply_request if kind == 'requests' else self._aggregates.apply_driver
+            for record_id, record in records.items():
+                before = previous.get(record_id)
+                if before != record:
+                    apply(before, record)
+            for record_id, before in previous.items():
+                if record_id not in records:
+                    apply(before, None)
+            self._entries[kind] = (version, records)
+            self.stats['loads'] += 1
+        return records
+
+    def records(self, kind: str) -> Dict:
+        """
+        キャッシュしている全件の辞書（requests / drivers）をそのまま返す（書き換えないこと）
+        保存先が変わらない間は同じ辞書が返るため、前回と同じかどうかで変更の有無が分かる
+        """
+        return self._records(kind)
+
+    def aggregates(self) -> StatusAggregates:
+        """
+        リクエスト・ドライバーの件数の集計（保存先が変わっていれば反映してから返す。書き換えないこと）
+        """
+        self._records('requests')
+        self._records('drivers')
+        return self._aggregates
+
+    def load_requests(self, status=None, facility_id: Optional[str] = None,
+                      assigned_driver: Optional[str] = None) -> Dict:
+        return {
+            req_id: req_data for req_id, req_data in self._records('requests').items()
+            if _matches(req_data, status, facility_id, assigned_driver)
+        }
+
+    def load_drivers(self, status: Optional[str] = None) -> Dict:
+        return {
+            driver_id: driver_data for driver_id, driver_data in self._records('drivers').items()
+            if status is None or driver_data.get('status') == status
+        }
+
+
+class RequestArchive:
+    """
+    完了したリクエストのアーカイブ
+
+    完了から一定時間が過ぎたリクエストを、完了日ごとの圧縮JSONL（requests-YYYY-MM-DD.jsonl.gz）に移し、
+    保存先（ホットストア）には進行中・完了直後のリクエストだけを残す。
+    アーカイブへの書き込みを先に行い、その後で保存先から削除する（途中で止まっても失われない。
+    同じリクエストが重複して書かれた場合、query() では後のものを採用する）。
+    """
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        self.lock_file = os.path.join(archive_dir, ".lock")
+        self._lock = threading.RLock()
+        self.last_run = 0.0  # 最後に archive() を実行した時刻（time.time()）
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def _path(self, day) -> str:
+        return os.path.join(self.archive_dir, f"requests-{day.isoformat()}.jsonl.gz")
+
+    def archive(self, storage, older_than: timedelta, now: Optional[datetime] = None) -> int:
+        """
+        completed_at が older_than より前の完了済みリクエストをアーカイブに移す
+
+        Returns:
+            int: 移したリクエストの数
+        """
+        self.last_run = time.time()
+        cutoff = (now or datetime.now()) - older_than
+        with _exclusive(self._lock, self.lock_file):
+            by_day = {}
+            for request_id, request in storage.load_requests(status='completed').items():
+                finished_at = request.get('completed_at') or request.get('created_at')
+                if isinstance(finished_at, datetime) and finished_at < cutoff:
+                    by_day.setdefault(finished_at.date(), []).append(request)
+            if not by_day:
+                return 0
+            for day, requests in by_day.items():
+                # gzipは追記するとメンバーが増えるだけで、読み込み時は続けて1つのファイルとして読める
+                with gzip.open(self._path(day), 'at', encoding='utf-8') as f:
+                    for request in requests:
+                        f.write(json.dumps(_serialize(request), ensure_ascii=False) + "\n")
+            return storage.delete_requests([r['id'] for requests in by_day.values() for r in requests])
+
+    def dates(self) -> List:
+        """アーカイブがある日付（古い順）"""
+        return sorted(
+            date.fromisoformat(os.path.basename(path)[9:19])
+            for path in glob.glob(os.path.join(self.archive_dir, "requests-*.jsonl.gz"))
+        )
+
+    def query(self, start: date, end: Optional[date] = None, facility_id: Optional[str] = None,
+              assigned_driver: Optional[str] = None) -> Dict:
+        """
+        アーカイブからリクエストを検索する（完了日が start〜end の範囲。end省略時は start の1日）
+
+        Returns:
+            dict: リクエストID -> リクエスト（datetimeに変換済み。完了時刻の順）
+        """
+        end = end or start
+        results = {}
+        day = start
+        while day <= end:
+            path = self._path(day)
+            if os.path.exists(path):
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        request = json.loads(line)
+                        if _matches(request, None, facility_id, assigned_driver):
+                            results[request['id']] = _parse_times(request, REQUEST_TIME_FIELDS)
+            day += timedelta(days=1)
+        return dict(sorted(results.items(), key=lambda item: _to_text(item[1].get('completed_at')) or ''))
+
+
+def open_storage(data_dir: str, backend: str = "sqlite"):
+    """
+    保存先を開く
+
+    Args:
+        data_dir (str): データを置くディレクトリ
+        backend (str): "sqlite"（標準）、"eventlog"（イベントログ）または "json"（従来のJSONファイル）
+    """
+    if backend == "json":
+        return JsonStorage(data_dir)
+    if backend == "sqlite":
+        return SQLiteStorage(os.path.join(data_dir, "taxi.db"), json_dir=data_dir)
+    if backend == "eventlog":
+        return EventLogStorage(os.path.join(data_dir, "events"), json_dir=data_dir)
+    raise ValueError(f"不明な保存方式です: {backend}（sqlite / eventlog / json）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="taxi_app.py のデータの移行・書き出し")
+    parser.add_argument("command", choices=["migrate", "export", "history", "archive", "archived"],
+                        help="migrate: JSON → SQLite / export: SQLite → JSON / history: 変更の履歴 / "
+                             "archive: 完了したリクエストをアーカイブに移す / archived: アーカイブの検索")
+    parser.add_argument("--data-dir", default="taxi_data")
+    parser.add_argument("--backend", default=os.getenv("TAXI_STORAGE", "sqlite"),
+                        help="history・archive で使う保存方式（sqlite / eventlog / json）")
+    parser.add_argument("--id", dest="entity_id", default=None, help="history で表示するリクエスト・ドライバーのID")
+    parser.add_argument("--older-than-hours", type=float, default=24.0,
+                        help="archive で移す、完了してからの経過時間")
+    parser.add_argument("--date", default=None, help="archived で検索する完了日（YYYY-MM-DD。省略時は全日付）")
+    parser.add_argument("--facility", default=None, help="archived で絞り込む施設ID")
+    args = parser.parse_args()
+
+    if args.command in ("archive", "archived"):
+        archive = RequestArchive(os.path.join(args.data_dir, "archive"))
+        if args.command == "archive":
+            moved = archive.archive(open_storage(args.data_dir, args.backend),
+                                    timedelta(hours=args.older_than_hours))
+            print(f"アーカイブに移しました: リクエスト {moved}件")
+        else:
+            days = [date.fromisoformat(args.date)] if args.date else archive.dates()
+            for day in days:
+                for request in archive.query(day, facility_id=args.facility).values():
+                    print(json.dumps(_serialize(request), ensure_ascii=False))
+        return
+
+    if args.command == "history":
+        for event in open_storage(args.data_dir, args.backend).load_events(args.entity_id):
+            print(json.dumps(event, ensure_ascii=False))
+        return
+
+    sqlite_storage = SQLiteStorage(os.path.join(args.data_dir, "taxi.db"))
+    if args.command == "migrate":
+        counts = sqlite_storage.migrate_from_json(args.data_dir, force=True)
+        print(f"JSONから取り込みました: リクエスト {counts['requests']}件 / "
+              f"ドライバー {counts['drivers']}件 / 施設 {counts['facilities']}件")
+    else:
+        json_storage = JsonStorage(args.data_dir)
+        requests = sqlite_storage.load_requests()
+        drivers = sqlite_storage.load_drivers()
+        facilities = sqlite_storage.load_facilities()
+        json_storage.save_requests(requests)
+        json_storage.save_drivers(drivers)
+        json_storage.save_facilities(facilities)
+        print(f"JSONに書き出しました: リクエスト {len(requests)}件 / "
+              f"ドライバー {len(drivers)}件 / 施設 {len(facilities)}件")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# テストはリポジトリ直下のモジュール（taxi_storage.py など）を読み込む
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
@@ -0,0 +1,95 @@
+"""llm_cache.py の回答キャッシュと同じ内容の呼び出しのまとめ（Streamlitなしで動かす）"""
+
+import threading
+import time
+
+import pytest
+
+from llm_cache import ResponseCache, SingleFlight, normalize_input
+
+
+def test_normalize_input_ignores_width_spaces_and_trailing_punctuation():
+    assert normalize_input("転職を考えているのですが？") == normalize_input("転職を考えているのですが ")
+    assert normalize_input("ＡＢＣ　ｄｅｆ!") == "abcdef"
+
+
+def test_exact_hit_is_per_character():
+    cache = ResponseCache(max_entries=10, ttl=60)
+    cache.put("テンシ", "転職したい", "応援します")
+    assert cache.get("テンシ", "転職したい？") == "応援します"
+    assert cache.get("アクマ", "転職したい") is None
+    assert cache.snapshot()['hits'] == 1
+    assert cache.snapshot()['misses'] == 1
+
+
+def test_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2, ttl=60)
+    cache.put("テンシ", "a", "1")
+    cache.put("テンシ", "b", "2")
+    cache.get("テンシ", "a")
+    cache.put("テンシ", "c", "3")
+    assert cache.get("テンシ", "b") is None
+    assert cache.get("テンシ", "a") == "1"
+    assert cache.get("テンシ", "c") == "3"
+
+
+def test_expired_entries_miss(monkeypatch):
+    cache = ResponseCache(max_entries=10, ttl=60)
+    cache.put("テンシ", "a", "1")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("テンシ", "a") is None
+    assert cache.snapshot()['entries'] == 0
+
+
+def test_similar_mode_matches_close_questions_only():
+    cache = ResponseCache(max_entries=10, ttl=60, mode="similar", similarity=0.8)
+    cache.put("テンシ", "仕事を辞めて転職するべきか迷っています", "応援します")
+    assert cache.get("テンシ", "仕事を辞めて転職するべきか迷っています、どうしよう") == "応援します"
+    assert cache.get("テンシ", "今日の晩ごはんは何がいい") is None
+    assert cache.snapshot()['similar_hits'] == 1
+
+
+def test_off_mode_stores_nothing():
+    cache = ResponseCache(max_entries=10, ttl=60, mode="off")
+    cache.put("テンシ", "a", "1")
+    assert cache.get("テンシ", "a") is None
+    assert cache.snapshot()['entries'] == 0
+
+
+def test_single_flight_joins_running_call():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def produce(on_wait):
+        calls.append(1)
+        on_wait({'position': 1})
+        yield "こん"
+        release.wait(5)
+        yield "にちは"
+
+    first, first_leader = flights.run("key", produce)
+    assert next(first) == ('status', {'position': 1})
+    second, second_leader = flights.run("key", produce)
+    release.set()
+    assert first_leader and not second_leader
+    assert list(second) == [('status', {'position': 1}), ('chunk', "こん"), ('chunk', "にちは")]
+    assert list(first) == [('chunk', "こん"), ('chunk', "にちは")]
+    assert calls == [1]
+    assert flights.snapshot() == {'started': 1, 'joined': 1, 'in_flight': 0}
+
+
+def test_single_flight_reraises_error_to_every_caller():
+    flights = SingleFlight()
+
+    def produce(on_wait):
+        yield "途中"
+        raise RuntimeError("upstream")
+
+    events, _ = flights.run("key", produce)
+    with pytest.raises(RuntimeError, match="upstream"):
+        list(events)
+    # 終わった呼び出しはまとめずに、次は新しく上流に送る
+    _, leader = flights.run("key", produce)
+    assert leader
@@ -0,0 +1,104 @@
+"""llm_client.py のレート制限と順番待ちキュー（Streamlitなしで動かす）"""
+
+import os
+import subprocess
+import sys
+import threading
+
+import httpx
+import openai
+import pytest
+
+from llm_client import LLMDispatcher, TokenBucket, describe_wait_status
+
+
+def _rate_limit_error() -> openai.RateLimitError:
+    response = httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+def _dispatcher(**options) -> LLMDispatcher:
+    settings = dict(max_concurrency=2, rpm=6000, tpm=1_000_000, max_retries=3, backoff_base=0, backoff_max=0)
+    settings.update(options)
+    return LLMDispatcher(**settings)
+
+
+def test_modules_import_without_streamlit():
+    code = ("import sys, llm_cache, llm_client, llm_memory, llm_tracing; "
+            "sys.exit('streamlit' in sys.modules)")
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=repo_root).returncode == 0
+
+
+def test_token_bucket_waits_once_capacity_is_used():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.reserve(60) == 0.0
+    # 1秒に1ずつ補充されるので、次の1件は約1秒待つ
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+    assert bucket.reserve(1) == pytest.approx(2.0, abs=0.05)
+
+
+def test_token_bucket_caps_single_reservation_at_capacity():
+    bucket = TokenBucket(per_minute=60)
+    bucket.reserve(60)
+    assert bucket.reserve(1000) == pytest.approx(60.0, abs=0.05)
+
+
+def test_retries_rate_limit_before_first_chunk():
+    dispatcher = _dispatcher()
+    attempts = []
+    statuses = []
+
+    def make_stream():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise _rate_limit_error()
+        return iter(["ok"])
+
+    assert list(dispatcher.stream(make_stream, 10, statuses.append)) == ["ok"]
+    assert [s['retry'] for s in statuses] == [1, 2]
+    assert dispatcher.snapshot()['retries'] == 2
+    assert dispatcher.snapshot()['completed'] == 1
+
+
+def test_does_not_retry_after_first_chunk_or_non_retryable_error():
+    dispatcher = _dispatcher()
+
+    def broken_stream():
+        yield "途中"
+        raise _rate_limit_error()
+
+    with pytest.raises(openai.RateLimitError):
+        list(dispatcher.stream(broken_stream, 10))
+    with pytest.raises(ValueError):
+        dispatcher.call(lambda: (_ for _ in ()).throw(ValueError("bad")), 10)
+    assert dispatcher.snapshot()['retries'] == 0
+    assert dispatcher.snapshot()['failed'] == 2
+
+
+def test_limits_concurrency_and_reports_queue_position():
+    dispatcher = _dispatcher(max_concurrency=1)
+    release = threading.Event()
+    running = threading.Event()
+    statuses = []
+
+    def slow():
+        running.set()
+        release.wait(5)
+        return "first"
+
+    first = threading.Thread(target=dispatcher.call, args=(slow, 10))
+    first.start()
+    running.wait(5)
+    second = threading.Thread(target=dispatcher.call, args=(lambda: "second", 10, statuses.append))
+    second.start()
+    while not statuses:
+        second.join(0.01)
+    assert dispatcher.snapshot()['active'] == 1
+    assert dispatcher.snapshot()['waiting'] == 1
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert statuses[0] == {'position': 1}
+    assert dispatcher.snapshot()['completed'] == 2
+    assert describe_wait_status(statuses[0]).endswith("1番目）")
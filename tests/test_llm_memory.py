@@ -0,0 +1,50 @@
+"""llm_memory.py の会話メモリ（トークン予算と要約。Streamlitなしで動かす）"""
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from llm_memory import ConversationMemory, estimate_tokens
+
+
+def test_estimate_tokens_counts_non_ascii_per_character():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("あいう") == 3
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+
+
+def test_keeps_recent_turns_within_budget_and_summarizes_the_rest():
+    calls = []
+
+    def summarizer(summary, turns):
+        calls.append((summary, list(turns)))
+        return summary + "".join(user for user, _ in turns)
+
+    memory = ConversationMemory(token_budget=10, summary_max_tokens=100, summarizer=summarizer)
+    memory.add_turn("一二三", "四五")
+    memory.add_turn("六七八", "九十")
+    assert calls == []
+    memory.add_turn("あい", "うえ")
+    assert calls == [("", [("一二三", "四五")])]
+    assert memory.history_tokens() <= 10
+    assert memory.summary == "一二三"
+    assert memory.stats()['summarized_turns'] == 1
+
+    messages = memory.history_messages()
+    assert isinstance(messages[0], SystemMessage) and "一二三" in messages[0].content
+    assert [type(m) for m in messages[1:]] == [HumanMessage, AIMessage, HumanMessage, AIMessage]
+
+
+def test_summary_is_truncated_and_failures_still_drop_old_turns():
+    memory = ConversationMemory(token_budget=4, summary_max_tokens=5, summarizer=lambda summary, turns: "長" * 50)
+    memory.add_turn("一二三", "四五")
+    assert estimate_tokens(memory.summary) <= 5
+
+    def failing(summary, turns):
+        raise RuntimeError("api down")
+
+    memory = ConversationMemory(token_budget=4, summary_max_tokens=5, summarizer=failing)
+    memory.add_turn("一二", "三")
+    memory.add_turn("四五", "六")
+    assert memory.turns == [("四五", "六")]
+    assert memory.summary == ""
+    assert memory.summarized_turns == 1
@@ -0,0 +1,97 @@
+"""llm_tracing.py のトレースとメトリクスの出力（Streamlitなしで動かす）"""
+
+import json
+import urllib.request
+
+from llm_tracing import LATENCY_BUCKETS, RequestTracer, TokenUsageStats, record_usage, serve_metrics, traced_request
+
+CHARACTERS = {'テンシ': {'slug': "tenshi", 'temperature': 0.7}}
+USAGE = {'input_tokens': 1200, 'output_tokens': 80, 'input_token_details': {'cache_read': 1024}}
+
+
+def _finished(tracer: RequestTracer, **phases) -> dict:
+    trace = tracer.start("テンシ")
+    trace['phases'].update(phases)
+    record_usage(trace, USAGE)
+    tracer.finish(trace)
+    return trace
+
+
+def test_finish_writes_log_and_counts_once(tmp_path):
+    log_path = tmp_path / "logs" / "trace.jsonl"
+    tracer = RequestTracer(str(log_path), "", model="gpt-4o-mini", characters=CHARACTERS)
+    trace = _finished(tracer, first_token=0.3)
+    tracer.finish(trace)
+
+    lines = log_path.read_text(encoding='utf-8').splitlines()
+    assert len(lines) == 1
+    logged = json.loads(lines[0])
+    assert logged['model'] == "gpt-4o-mini"
+    assert logged['temperature'] == 0.7
+    assert logged['cached_tokens'] == 1024
+    assert set(logged['phases']) == {'first_token', 'total'}
+    assert len(tracer.recent()) == 1
+
+
+def test_prometheus_text_uses_slug_labels_and_cumulative_buckets():
+    tracer = RequestTracer("", "", model="gpt-4o-mini", characters=CHARACTERS)
+    _finished(tracer, first_token=0.3)
+    _finished(tracer, first_token=3.0)
+    text = tracer.prometheus_text()
+
+    assert 'llm_requests_total{character="tenshi",model="gpt-4o-mini",status="ok",cache="miss"} 2' in text
+    assert 'llm_tokens_total{character="tenshi",type="cached"} 2048' in text
+    buckets = [line for line in text.splitlines()
+               if line.startswith('llm_phase_seconds_bucket{character="tenshi",phase="first_token"')]
+    assert len(buckets) == len(LATENCY_BUCKETS) + 1
+    assert buckets[LATENCY_BUCKETS.index(0.5)].endswith(" 1")
+    assert buckets[LATENCY_BUCKETS.index(4.0)].endswith(" 2")
+    assert buckets[-1].endswith(" 2")
+
+
+def test_write_metrics_only_when_changed(tmp_path):
+    metrics_path = tmp_path / "metrics.prom"
+    tracer = RequestTracer("", str(metrics_path), characters=CHARACTERS)
+    tracer.write_metrics()
+    assert not metrics_path.exists()
+
+    _finished(tracer)
+    tracer.write_metrics()
+    assert "llm_requests_total" in metrics_path.read_text(encoding='utf-8')
+    metrics_path.unlink()
+    tracer.write_metrics()
+    assert not metrics_path.exists()
+
+
+def test_serve_metrics():
+    tracer = RequestTracer("", "", characters=CHARACTERS)
+    _finished(tracer)
+    server = serve_metrics(tracer, "127.0.0.1", 0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert 'character="tenshi"' in response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_traced_request_records_attempts_and_queue_wait():
+    tracer = RequestTracer("", "")
+    trace = tracer.start("テンシ")
+    request = traced_request(trace, lambda: "ok")
+    assert request.sent_at is None
+    assert request() == "ok" and request() == "ok"
+    assert trace['attempts'] == 2
+    assert trace['phases']['queue_wait'] >= 0
+    assert request.sent_at is not None
+
+
+def test_token_usage_stats_cache_rate():
+    stats = TokenUsageStats()
+    stats.record("テンシ", USAGE)
+    stats.record("テンシ", None)
+    totals = stats.snapshot()["テンシ"]
+    assert totals['requests'] == 1
+    assert totals['uncached_input_tokens'] == 176
+    assert totals['cache_rate'] == 1024 / 1200
@@ -0,0 +1,127 @@
+"""taxi_app.py の操作1回あたりの実行回数と、操作結果のメッセージの表示"""
+
+import os
+from datetime import datetime, timedelta
+
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import taxi_storage
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "taxi_app.py")
+
+
+@pytest.fixture
+def app_dir(tmp_path, monkeypatch):
+    """一時ディレクトリの taxi_data/ を使い、ページ全体の実行回数（set_page_config の呼び出し）を数える"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("TAXI_STORAGE", "sqlite")
+    monkeypatch.setenv("TAXI_AUTO_DISPATCH", "0")
+    st.cache_resource.clear()
+    runs = []
+    set_page_config = st.set_page_config
+    monkeypatch.setattr(st, "set_page_config", lambda *args, **kwargs: (runs.append(1), set_page_config(*args, **kwargs)))
+    yield runs
+    st.cache_resource.clear()
+
+
+def _open_app() -> AppTest:
+    return AppTest.from_file(APP_PATH, default_timeout=30).run()
+
+
+def test_call_taxi_runs_script_twice(app_dir):
+    at = _open_app()
+    at.text_input(key="facility_id_input").input("f1")
+    at.text_input(key="facility_name_input").input("ホテルA")
+    at.button(key="save_facility_button").click().run()
+    assert not at.exception
+
+    app_dir.clear()
+    at.button(key="call_taxi_button").click().run()
+    # 押したときの実行と、st.rerun() による再実行の2回だけ（自分の保存で自動更新が再実行しない）
+    assert len(app_dir) == 2
+    assert any("リクエストを送信しました" in toast.value for toast in at.toast)
+    pending = taxi_storage.open_storage("taxi_data").load_requests("pending")
+    assert len(pending) == 1
+
+    app_dir.clear()
+    at.run()
+    assert len(app_dir) == 1
+
+
+def test_rejected_transition_error_survives_rerun(app_dir, monkeypatch):
+    storage = taxi_storage.open_storage("taxi_data")
+    now = datetime.now()
+    storage.put_driver({'id': 'd1', 'name': '運転手', 'car_number': '品川 1', 'lat': 35.68, 'lon': 139.76,
+                        'status': 'available', 'updated_at': now})
+    storage.add_request({'id': 'r1', 'status': 'assigned', 'assigned_driver': 'd1', 'driver_name': '運転手',
+                         'front_lat': 35.68, 'front_lon': 139.76, 'facility_id': 'f1', 'facility_name': 'ホテルA',
+                         'created_at': now, 'assigned_at': now})
+
+    at = _open_app()
+    at.sidebar.selectbox[0].select("ドライバー端末").run()
+    at.text_input(key="driver_id_input").input("d1").run()
+
+    # 画面を表示した後に、他の端末が先に状態を変えた
+    def rejected(self, request_id, from_status, to_status, fields, require_idle_driver=None):
+        raise taxi_storage.TransitionRejected(request_id, from_status, None)
+
+    monkeypatch.setattr(taxi_storage.SQLiteStorage, "transition", rejected)
+    app_dir.clear()
+    at.button(key="arrive_r1").click().run()
+    assert len(app_dir) == 2
+    assert any("既に処理済み" in error.value for error in at.error)
+
+    # メッセージは1回だけ表示される
+    at.run()
+    assert not any("既に処理済み" in error.value for error in at.error)
+
+
+def test_history_defaults_to_latest_archive_date(app_dir):
+    storage = taxi_storage.open_storage("taxi_data")
+    now = datetime.now()
+    for days in (2, 3):
+        finished_at = now - timedelta(days=days)
+        storage.add_request({'id': f"r{days}", 'status': 'completed', 'facility_id': 'f1', 'facility_name': 'ホテルA',
+                             'driver_name': '運転手', 'created_at': finished_at, 'completed_at': finished_at})
+
+    at = _open_app()
+    at.text_input(key="facility_id_input").input("f1")
+    at.text_input(key="facility_name_input").input("ホテルA")
+    at.button(key="save_facility_button").click().run()
+
+    # 初回の実行で保持期間を過ぎたリクエストがアーカイブに移り、その日付だけが新しい順に選べる
+    archive_date = at.selectbox(key="archive_date")
+    assert archive_date.options == [(now - timedelta(days=days)).strftime('%Y/%m/%d') for days in (2, 3)]
+    assert archive_date.value == (now - timedelta(days=2)).date()
+    assert len(at.dataframe) == 1 and len(at.dataframe[0].value) == 1
+
+
+def test_accept_rejected_when_auto_dispatch_assigned_driver(app_dir, monkeypatch):
+    storage = taxi_storage.open_storage("taxi_data")
+    now = datetime.now()
+    storage.put_driver({'id': 'd1', 'name': '運転手', 'car_number': '品川 1', 'lat': 35.68, 'lon': 139.76,
+                        'status': 'available', 'updated_at': now})
+    for request_id, lat in (('r1', 35.681), ('r2', 35.69)):
+        storage.add_request({'id': request_id, 'status': 'pending', 'front_lat': lat, 'front_lon': 139.76,
+                             'facility_id': 'f1', 'facility_name': 'ホテルA', 'created_at': now})
+
+    at = _open_app()
+    at.sidebar.selectbox[0].select("ドライバー端末").run()
+    at.text_input(key="driver_id_input").input("d1").run()
+    assert at.button(key="accept_selected_request")
+
+    # 画面を表示した後、受諾を保存する直前に自動配車が d1 に r2 を割り当てた
+    transition = taxi_storage.SQLiteStorage.transition
+
+    def dispatch_then_transition(self, request_id, *args, **kwargs):
+        if request_id == 'r1' and self.load_request('r2')['status'] == 'pending':
+            transition(self, 'r2', 'pending', 'assigned', {'assigned_driver': 'd1'}, require_idle_driver='d1')
+        return transition(self, request_id, *args, **kwargs)
+
+    monkeypatch.setattr(taxi_storage.SQLiteStorage, "transition", dispatch_then_transition)
+    at.button(key="accept_selected_request").click().run()
+    assert any("既に担当中のリクエストがあります" in error.value for error in at.error)
+    assert storage.load_request('r1')['status'] == 'pending'
+    assert list(storage.load_requests(taxi_storage.ACTIVE_STATUSES, assigned_driver='d1')) == ['r2']
@@ -0,0 +1,154 @@
+"""taxi_dispatch.py の割り当て（ハンガリアン法と総当たりの比較）と自動配車"""
+
+import itertools
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import taxi_storage
+from taxi_dispatch import Dispatcher, eta_minutes, solve_assignment
+from taxi_geo import haversine_km
+from taxi_storage import ACTIVE_STATUSES, CachedStorage
+
+CENTER = (35.681, 139.767)
+
+
+def _brute_force_cost(cost: np.ndarray) -> float:
+    """すべての割り当てを試した最小のコスト（min(m, n) 組）"""
+    rows, cols = cost.shape
+    if rows <= cols:
+        return min(sum(cost[i, j] for i, j in enumerate(perm)) for perm in itertools.permutations(range(cols), rows))
+    return min(sum(cost[i, j] for j, i in enumerate(perm)) for perm in itertools.permutations(range(rows), cols))
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_solve_assignment_matches_permutations(seed):
+    rng = np.random.default_rng(seed)
+    rows, cols = (int(x) for x in rng.integers(1, 7, size=2))
+    # 整数のコスト（同じ値が多い）と、負の値を含む実数のコストを交互に試す
+    cost = rng.integers(0, 5, size=(rows, cols)).astype(float) if seed % 2 else rng.normal(size=(rows, cols))
+    pairs = solve_assignment(cost)
+    assert len(pairs) == min(rows, cols)
+    assert len({i for i, _ in pairs}) == len(pairs) and len({j for _, j in pairs}) == len(pairs)
+    assert pairs == sorted(pairs)
+    assert sum(cost[i, j] for i, j in pairs) == pytest.approx(_brute_force_cost(cost))
+
+
+def test_solve_assignment_empty():
+    assert solve_assignment(np.zeros((0, 3))) == []
+    assert solve_assignment([]) == []
+
+
+def _request(request_id: str, lat: float, lon: float, waited_min: float, now: datetime) -> dict:
+    return {'id': request_id, 'status': 'pending', 'facility_id': 'f1', 'facility_name': "ホテル",
+            'front_lat': lat, 'front_lon': lon, 'created_at': now - timedelta(minutes=waited_min)}
+
+
+def _driver(driver_id: str, lat: float, lon: float, now: datetime) -> dict:
+    return {'id': driver_id, 'name': driver_id, 'car_number': "品川 1", 'lat': lat, 'lon': lon,
+            'status': 'available', 'updated_at': now}
+
+
+def test_plan_minimizes_total_eta_and_skips_far_pairs():
+    now = datetime(2026, 1, 1, 9, 0)
+    dispatcher = Dispatcher(storage=None, max_pickup_min=30, wait_weight=0, idle_weight=0)
+    # 古い順に一番近いドライバーを割り当てると、合計が大きくなる配置
+    pending = [_request("r1", CENTER[0], CENTER[1], 1, now),
+               _request("r2", CENTER[0] + 0.02, CENTER[1], 1, now),
+               _request("far", CENTER[0] + 1.0, CENTER[1], 1, now)]
+    drivers = [_driver("d1", CENTER[0] + 0.01, CENTER[1], now),
+               _driver("d2", CENTER[0] - 0.012, CENTER[1], now),
+               _driver("d3", CENTER[0] + 0.05, CENTER[1], now)]
+    plan = dispatcher.plan(pending, drivers, np.zeros(len(drivers)), now)
+    assigned = {request['id']: driver['id'] for request, driver, _ in plan}
+    assert "far" not in assigned
+    assert all(eta <= dispatcher.max_pickup_min for _, _, eta in plan)
+
+    etas = {(r['id'], d['id']): float(eta_minutes(haversine_km(r['front_lat'], r['front_lon'], d['lat'], d['lon'])))
+            for r in pending for d in drivers}
+    best = min(itertools.permutations(["d1", "d2", "d3"], 2),
+               key=lambda pair: etas[("r1", pair[0])] + etas[("r2", pair[1])])
+    assert assigned == {"r1": best[0], "r2": best[1]} == {"r1": "d2", "r2": "d1"}
+
+
+def test_plan_prefers_longest_waiting_request():
+    now = datetime(2026, 1, 1, 9, 0)
+    dispatcher = Dispatcher(storage=None, max_pickup_min=30, max_wait_min=10)
+    # ドライバー1人に対して、近いが来たばかりのリクエストと、少し遠いが長く待っているリクエスト
+    pending = [_request("new", CENTER[0] + 0.005, CENTER[1], 0, now),
+               _request("old", CENTER[0] + 0.03, CENTER[1], 12, now)]
+    plan = dispatcher.plan(pending, [_driver("d1", *CENTER, now)], np.zeros(1), now)
+    assert [request['id'] for request, _, _ in plan] == ["old"]
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "json"])
+def test_run_once_assigns_without_double_booking(tmp_path, backend):
+    rng = random.Random(0)
+    now = datetime.now()
+    storage = CachedStorage(taxi_storage.open_storage(str(tmp_path / "taxi_data"), backend))
+    for i in range(6):
+        storage.put_driver(_driver(f"d{i}", CENTER[0] + rng.uniform(-0.02, 0.02), CENTER[1] + rng.uniform(-0.02, 0.02), now))
+    for i in range(10):
+        storage.add_request(_request(f"r{i}", CENTER[0] + rng.uniform(-0.02, 0.02),
+                                     CENTER[1] + rng.uniform(-0.02, 0.02), rng.uniform(0, 5), now))
+    # d0 は手動で受諾済み（担当中のドライバーには割り当てない）
+    storage.transition("r0", "pending", "assigned", {'assigned_driver': "d0"})
+
+    dispatcher = Dispatcher(storage)
+    done = dispatcher.run_once()
+    assert len(done) == 5
+    assert "d0" not in {driver['id'] for _, driver, _ in done}
+
+    requests = storage.load_requests()
+    active = [r['assigned_driver'] for r in requests.values() if r['status'] in ACTIVE_STATUSES]
+    assert sorted(active) == [f"d{i}" for i in range(6)]
+    assert sum(r.get('dispatched_by') == 'auto' for r in requests.values()) == 5
+
+    # 空いているドライバーがいなければ何もしない
+    assert dispatcher.run_once() == []
+    assert dispatcher.summary()['assigned'] == 5
+
+
+def test_run_once_skips_requests_taken_after_planning(tmp_path, monkeypatch):
+    now = datetime.now()
+    storage = taxi_storage.open_storage(str(tmp_path / "taxi_data"), "sqlite")
+    storage.put_driver(_driver("d1", *CENTER, now))
+    storage.add_request(_request("r1", *CENTER, 1, now))
+    dispatcher = Dispatcher(CachedStorage(storage))
+
+    # 計画を立てた直後に、別のドライバーが手動で受諾した
+    plan = dispatcher.plan
+
+    def plan_then_accept(*args):
+        result = plan(*args)
+        storage.transition("r1", "pending", "assigned", {'assigned_driver': "d9"})
+        return result
+
+    monkeypatch.setattr(dispatcher, "plan", plan_then_accept)
+    assert dispatcher.run_once() == []
+    assert storage.load_request("r1")['assigned_driver'] == "d9"
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "eventlog", "json"])
+def test_run_once_skips_driver_who_accepted_another_request(tmp_path, backend):
+    now = datetime.now()
+    storage = taxi_storage.open_storage(str(tmp_path / "taxi_data"), backend)
+    storage.put_driver(_driver("d1", *CENTER, now))
+    storage.add_request(_request("r1", *CENTER, 5, now))
+    storage.add_request(_request("r2", CENTER[0] + 0.01, CENTER[1], 1, now))
+    dispatcher = Dispatcher(CachedStorage(storage))
+
+    # 自動配車が r1 → d1 を保存する直前に、d1 が手動で r2 を受諾した
+    transition = storage.transition
+
+    def accept_then_transition(request_id, *args, **kwargs):
+        if request_id == "r1" and storage.load_request("r2")['status'] == "pending":
+            transition("r2", "pending", "assigned", {'assigned_driver': "d1"}, require_idle_driver="d1")
+        return transition(request_id, *args, **kwargs)
+
+    storage.transition = accept_then_transition
+    assert dispatcher.run_once() == []
+    assert list(storage.load_requests(ACTIVE_STATUSES, assigned_driver="d1")) == ["r2"]
+    assert storage.load_request("r1")['status'] == "pending"
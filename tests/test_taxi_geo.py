@@ -0,0 +1,129 @@
+"""taxi_geo.py の距離計算と空間インデックス（1点ずつの計算・全点の距離との比較）"""
+
+import math
+import random
+
+import numpy as np
+import pytest
+
+from taxi_geo import (VECTOR_MIN_POINTS, MatchingIndex, PointArray, SpatialIndex, distance_matrix,
+                      haversine_km, haversine_vector)
+
+CENTER = (35.681, 139.767)
+
+
+def _points(rng: random.Random, n: int, spread_deg: float) -> dict:
+    return {f"p{i}": (CENTER[0] + rng.uniform(-spread_deg, spread_deg),
+                      CENTER[1] + rng.uniform(-spread_deg, spread_deg)) for i in range(n)}
+
+
+def _brute_force(points: dict, lat: float, lon: float) -> list:
+    """全点への距離（haversine_vector。近い順）"""
+    ids = list(points)
+    lat_rad = np.radians([points[i][0] for i in ids])
+    lon_rad = np.radians([points[i][1] for i in ids])
+    distances = haversine_vector(lat, lon, lat_rad, lon_rad, np.cos(lat_rad))
+    return sorted(zip(ids, distances.tolist()), key=lambda x: x[1])
+
+
+def _assert_same(found: list, expected: list):
+    # 同じ距離の点の順番は決まらないので、距離の並びと、同じ距離のものを除いたIDの組を比べる
+    assert np.allclose([d for _, d in found], [d for _, d in expected], atol=1e-9)
+    assert {i for i, _ in found} == {i for i, _ in expected}
+
+
+def test_vector_and_matrix_match_scalar():
+    rng = random.Random(0)
+    points = list(_points(rng, 200, 0.5).values())
+    origins = list(_points(rng, 5, 0.5).values())
+    lat_rad = np.radians([p[0] for p in points])
+    lon_rad = np.radians([p[1] for p in points])
+    matrix = distance_matrix([o[0] for o in origins], [o[1] for o in origins],
+                             [p[0] for p in points], [p[1] for p in points])
+    for row, (lat, lon) in enumerate(origins):
+        expected = [haversine_km(lat, lon, p_lat, p_lon) for p_lat, p_lon in points]
+        assert np.allclose(haversine_vector(lat, lon, lat_rad, lon_rad, np.cos(lat_rad)), expected, atol=1e-9)
+        assert np.allclose(matrix[row], expected, atol=1e-9)
+
+
+@pytest.mark.parametrize("subset", [VECTOR_MIN_POINTS - 1, VECTOR_MIN_POINTS, 100])
+def test_point_array_after_moves_and_removals(subset):
+    rng = random.Random(subset)
+    points = _points(rng, 150, 0.3)
+    array = PointArray(capacity=4)
+    for item_id, (lat, lon) in points.items():
+        array.upsert(item_id, lat, lon)
+    for item_id in rng.sample(sorted(points), 30):
+        array.remove(item_id)
+        del points[item_id]
+    for item_id in rng.sample(sorted(points), 30):
+        points[item_id] = (CENTER[0] + rng.uniform(-0.3, 0.3), CENTER[1] + rng.uniform(-0.3, 0.3))
+        array.upsert(item_id, *points[item_id])
+
+    lat, lon = CENTER
+    ids = rng.sample(sorted(points), subset)
+    expected = [haversine_km(lat, lon, *points[item_id]) for item_id in ids]
+    assert np.allclose(array.distances(lat, lon, ids), expected, atol=1e-9)
+    everything = [haversine_km(lat, lon, *points[item_id]) for item_id in array.ids]
+    assert np.allclose(array.distances(lat, lon), everything, atol=1e-9)
+
+
+@pytest.mark.parametrize("n, spread_deg", [(1, 0.05), (50, 0.02), (500, 0.3), (2000, 1.0)])
+def test_spatial_index_matches_brute_force(n, spread_deg):
+    rng = random.Random(n)
+    points = _points(rng, n, spread_deg)
+    index = SpatialIndex()
+    for item_id, (lat, lon) in points.items():
+        index.upsert(item_id, lat, lon)
+    # 一部の点を動かし、一部を消す（マスの移動・空いたマスの削除も確かめる）
+    for item_id in rng.sample(sorted(points), n // 10):
+        points[item_id] = (CENTER[0] + rng.uniform(-spread_deg, spread_deg),
+                           CENTER[1] + rng.uniform(-spread_deg, spread_deg))
+        index.upsert(item_id, *points[item_id])
+    for item_id in rng.sample(sorted(points), n // 10):
+        index.remove(item_id)
+        del points[item_id]
+
+    # 点の集まりの中・端・遠く離れた場所から探す
+    queries = list(_points(rng, 10, spread_deg).values()) + [
+        (CENTER[0] + 2 * spread_deg, CENTER[1]), (CENTER[0] - 1.5, CENTER[1] + 1.5)]
+    for lat, lon in queries:
+        expected = _brute_force(points, lat, lon)
+        for k in (1, 3, 10, len(points), len(points) + 5):
+            _assert_same(index.nearest(lat, lon, k), expected[:k])
+        _assert_same(index.nearest(lat, lon), expected)
+        for radius_km in (0.5, 2.0, 10.0, 200.0):
+            inside = [(i, d) for i, d in expected if d <= radius_km]
+            _assert_same(index.within(lat, lon, radius_km), inside)
+            _assert_same(index.nearest(lat, lon, 5, max_km=radius_km), inside[:5])
+
+
+def test_spatial_index_near_the_pole():
+    rng = random.Random(1)
+    points = {f"p{i}": (rng.uniform(88.0, 89.9), rng.uniform(-180, 180)) for i in range(200)}
+    index = SpatialIndex()
+    for item_id, (lat, lon) in points.items():
+        index.upsert(item_id, lat, lon)
+    lat, lon = 89.0, 10.0
+    expected = _brute_force(points, lat, lon)
+    _assert_same(index.nearest(lat, lon, 7), expected[:7])
+    _assert_same(index.within(lat, lon, 50.0), [(i, d) for i, d in expected if d <= 50.0])
+
+
+def test_matching_index_tracks_status_and_position():
+    index = MatchingIndex()
+    drivers = {
+        'd1': {'id': 'd1', 'status': 'available', 'lat': CENTER[0], 'lon': CENTER[1]},
+        'd2': {'id': 'd2', 'status': 'busy', 'lat': CENTER[0], 'lon': CENTER[1]},
+        'd3': {'id': 'd3', 'status': 'available', 'lat': None, 'lon': None},
+    }
+    index.sync_drivers(drivers)
+    assert [driver_id for driver_id, _ in index.nearest_drivers(*CENTER)] == ['d1']
+
+    # 保存先のキャッシュは変更があると新しい辞書を返す
+    drivers = {**drivers, 'd1': {**drivers['d1'], 'status': 'busy'},
+               'd2': {**drivers['d2'], 'status': 'available', 'lat': CENTER[0] + 0.1}}
+    index.sync_drivers(drivers)
+    found = index.nearest_drivers(*CENTER)
+    assert [driver_id for driver_id, _ in found] == ['d2']
+    assert math.isclose(found[0][1], haversine_km(*CENTER, CENTER[0] + 0.1, CENTER[1]), abs_tol=1e-9)
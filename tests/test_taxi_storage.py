@@ -0,0 +1,218 @@
+"""taxi_storage.py の保存先（3つのバックエンド）と、読み込みのキャッシュ・件数の集計"""
+
+import os
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+
+import pytest
+
+import taxi_storage
+from taxi_storage import (ACTIVE_STATUSES, TRANSITIONS, CachedStorage, DriverBusy, JsonStorage, SQLiteStorage,
+                          TransitionRejected)
+
+BACKENDS = ("sqlite", "eventlog", "json")
+
+
+@pytest.fixture(params=BACKENDS)
+def storage(request, tmp_path):
+    return taxi_storage.open_storage(str(tmp_path / "taxi_data"), request.param)
+
+
+def _request(request_id: str, facility_id: str = "f1", status: str = "pending") -> dict:
+    return {'id': request_id, 'status': status, 'facility_id': facility_id, 'facility_name': "ホテル",
+            'front_lat': 35.68, 'front_lon': 139.76, 'created_at': datetime.now()}
+
+
+def _driver(driver_id: str, status: str = "available") -> dict:
+    return {'id': driver_id, 'name': "運転手", 'car_number': "品川 1", 'lat': 35.68, 'lon': 139.76,
+            'status': status, 'updated_at': datetime.now()}
+
+
+def _recount(requests: dict, drivers: dict) -> dict:
+    """保存先の全件から数え直した集計（StatusAggregates と同じ項目）"""
+    by_facility, by_driver = {}, {}
+    for r in requests.values():
+        by_facility.setdefault(r.get('facility_id'), Counter())[r['status']] += 1
+        if r.get('assigned_driver'):
+            by_driver.setdefault(r['assigned_driver'], Counter())[r['status']] += 1
+    busy = {r['assigned_driver'] for r in requests.values() if r['status'] in ACTIVE_STATUSES}
+    return {
+        'requests_total': len(requests),
+        'requests_by_status': Counter(r['status'] for r in requests.values()),
+        'requests_by_facility': by_facility,
+        'requests_by_driver': by_driver,
+        'drivers_total': len(drivers),
+        'drivers_by_status': Counter(d['status'] for d in drivers.values()),
+        'busy_available_drivers': sum(1 for d in drivers.values() if d['status'] == 'available' and d['id'] in busy),
+    }
+
+
+def test_transition_updates_status_and_fields(storage):
+    storage.add_request(_request("r1"))
+    updated = storage.transition("r1", "pending", "assigned", {'assigned_driver': "d1"})
+    assert updated['status'] == "assigned" and updated['assigned_driver'] == "d1"
+    assert storage.load_request("r1")['status'] == "assigned"
+
+
+def test_transition_rejects_stale_from_status(storage):
+    storage.add_request(_request("r1"))
+    storage.transition("r1", "pending", "assigned", {'assigned_driver': "d1"})
+    # 画面を表示した時点では pending だったが、他の端末が先に受諾した
+    with pytest.raises(TransitionRejected) as rejected:
+        storage.transition("r1", "pending", "assigned", {'assigned_driver': "d2"})
+    assert rejected.value.current_status == "assigned"
+    assert storage.load_request("r1")['assigned_driver'] == "d1"
+
+    with pytest.raises(TransitionRejected) as rejected:
+        storage.transition("missing", "pending", "assigned", {})
+    assert rejected.value.current_status is None
+
+
+def test_transition_rejects_skipping_a_status(storage):
+    storage.add_request(_request("r1"))
+    with pytest.raises(ValueError):
+        storage.transition("r1", "pending", "arrived", {})
+    assert storage.load_request("r1")['status'] == "pending"
+
+
+def test_concurrent_accepts_have_one_winner(storage):
+    storage.add_request(_request("r1"))
+    winners = []
+    start = threading.Barrier(8)
+
+    def accept(driver_id: str):
+        start.wait()
+        try:
+            storage.transition("r1", "pending", "assigned", {'assigned_driver': driver_id})
+            winners.append(driver_id)
+        except TransitionRejected:
+            pass
+
+    threads = [threading.Thread(target=accept, args=(f"d{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
+    assert storage.load_request("r1")['assigned_driver'] == winners[0]
+
+
+def test_transition_rejects_driver_with_active_request(storage):
+    for request_id in ("r1", "r2"):
+        storage.add_request(_request(request_id))
+    storage.transition("r1", "pending", "assigned", {'assigned_driver': "d1"})
+    with pytest.raises(DriverBusy) as rejected:
+        storage.transition("r2", "pending", "assigned", {'assigned_driver': "d1"}, require_idle_driver="d1")
+    assert rejected.value.active_request_id == "r1"
+    assert storage.load_request("r2")['status'] == "pending"
+
+    # 担当中のリクエストが完了すれば割り当てられる
+    for from_status in ("assigned", "arrived", "departed"):
+        storage.transition("r1", from_status, TRANSITIONS[from_status], {})
+    updated = storage.transition("r2", "pending", "assigned", {'assigned_driver': "d1"}, require_idle_driver="d1")
+    assert updated['assigned_driver'] == "d1"
+
+
+def test_concurrent_assignments_of_one_driver_have_one_winner(storage):
+    for i in range(8):
+        storage.add_request(_request(f"r{i}"))
+    winners = []
+    start = threading.Barrier(8)
+
+    def assign(request_id: str):
+        start.wait()
+        try:
+            storage.transition(request_id, "pending", "assigned", {'assigned_driver': "d1"}, require_idle_driver="d1")
+            winners.append(request_id)
+        except DriverBusy:
+            pass
+
+    threads = [threading.Thread(target=assign, args=(f"r{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
+    assert list(storage.load_requests(ACTIVE_STATUSES, assigned_driver="d1")) == winners
+
+
+def test_sqlite_reuses_connections_across_threads(tmp_path, monkeypatch):
+    opened = []
+    connect = SQLiteStorage._connect
+    monkeypatch.setattr(SQLiteStorage, "_connect", lambda self: opened.append(1) or connect(self))
+    storage = SQLiteStorage(str(tmp_path / "taxi.db"), pool_size=2)
+    storage.add_request(_request("r1"))
+    # Streamlitのように実行ごとに別のスレッドから使っても、接続は作り直さない
+    for _ in range(20):
+        thread = threading.Thread(target=storage.load_requests)
+        thread.start()
+        thread.join()
+    assert len(opened) == 1
+    storage.close()
+    assert storage.load_request("r1")['status'] == "pending"
+
+
+def test_aggregates_match_recount_after_random_changes(storage):
+    rng = random.Random(0)
+    cached = CachedStorage(storage)
+    driver_ids = [f"d{i}" for i in range(5)]
+    for driver_id in driver_ids:
+        storage.put_driver(_driver(driver_id))
+    for step in range(200):
+        requests = storage.load_requests()
+        action = rng.random()
+        if action < 0.3 or not requests:
+            storage.add_request(_request(f"r{step}", rng.choice(["f1", "f2", "f3"])))
+        elif action < 0.8:
+            request = requests[rng.choice(sorted(requests))]
+            if request['status'] in TRANSITIONS:
+                fields = {'assigned_driver': rng.choice(driver_ids)} if request['status'] == 'pending' else {}
+                storage.transition(request['id'], request['status'], TRANSITIONS[request['status']], fields)
+        elif action < 0.9:
+            storage.update_driver(rng.choice(driver_ids), {'status': rng.choice(["available", "busy"])})
+        else:
+            storage.delete_requests([rng.choice(sorted(requests))])
+
+        # 何回かの変更ごとに確かめる（その間の変更はまとめて差分で反映される）
+        if step % 7 == 0:
+            aggregates = cached.aggregates()
+            expected = _recount(storage.load_requests(), storage.load_drivers())
+            assert {key: getattr(aggregates, key) for key in expected} == expected
+
+
+def test_json_version_changes_on_same_size_rewrite_in_same_tick(tmp_path):
+    data_dir = str(tmp_path / "taxi_data")
+    reader, writer = JsonStorage(data_dir), JsonStorage(data_dir)
+    writer.add_request({**_request("r1"), 'car_number': "A"})
+    cached = CachedStorage(reader)
+    assert cached.load_request("r1")['car_number'] == "A"
+    assert cached.records('requests')['r1']['car_number'] == "A"
+    path = reader.requests_file
+    stat = os.stat(path)
+
+    # 別のプロセスが、同じ大きさの内容で書き換え、更新時刻も変わらなかった
+    writer.update_request("r1", {'car_number': "B"})
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.path.getsize(path) == stat.st_size
+    assert cached.records('requests')['r1']['car_number'] == "B"
+
+    # inodeも変わらない書き換え（その場での上書き）は、内容のハッシュで分かる
+    stat = os.stat(path)
+    with open(path, 'r+b') as f:
+        content = f.read().replace(b'"B"', b'"C"')
+        f.seek(0)
+        f.write(content)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cached.records('requests')['r1']['car_number'] == "C"
+
+
+def test_json_version_is_stable_without_changes(tmp_path, monkeypatch):
+    storage = JsonStorage(str(tmp_path / "taxi_data"))
+    storage.add_request(_request("r1"))
+    version = storage.data_version('requests')
+    assert storage.data_version('requests') == version
+    # 更新時刻の精度の範囲を過ぎて、ハッシュを計算し直さなくなっても版は変わらない
+    monkeypatch.setattr(taxi_storage, "JSON_MTIME_TICK_SEC", 0)
+    assert storage.data_version('requests') == version